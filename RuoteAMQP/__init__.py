@@ -1,3 +1,47 @@
-from participant import Participant
-from workitem import FlowExpressionId, Workitem
-from launcher import Launcher
+"""
+Ruote participants and launchers over AMQP.
+
+The classes below are imported from their modules when first used, so
+that a tool which only needs a Workitem doesn't pay for importing
+amqplib and the participant machinery.
+"""
+
+import sys
+from types import ModuleType
+
+# Name: module it is imported from
+_EXPORTS = {
+    "Participant": "RuoteAMQP.participant",
+    "FlowExpressionId": "RuoteAMQP.workitem",
+    "Workitem": "RuoteAMQP.workitem",
+    "Launcher": "RuoteAMQP.launcher",
+}
+
+__all__ = sorted(_EXPORTS)
+
+
+class _LazyModule(ModuleType):
+    """The package, importing its exports on first access."""
+
+    def __getattr__(self, name):
+        module = _EXPORTS.get(name)
+        if module is None:
+            raise AttributeError("module %r has no attribute %r"
+                                 % (self.__name__, name))
+        value = getattr(__import__(module, None, None, [name]), name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_EXPORTS))
+
+
+try:
+    sys.modules[__name__].__class__ = _LazyModule
+except TypeError:
+    # Python 2 modules can't change class, so stand in for this one,
+    # keeping it alive as its globals would be cleared with it
+    _package = _LazyModule(__name__, __doc__)
+    _package.__dict__.update(globals())
+    _package._module = sys.modules[__name__]
+    sys.modules[__name__] = _package
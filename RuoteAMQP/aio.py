@@ -0,0 +1,495 @@
+# Copyright (C) 2010 Nokia Corporation and/or its subsidiary(-ies).
+# Contact: David Greaves <ext-david.greaves@nokia.com>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+asyncio versions of Participant and Launcher.
+
+This module needs Python 3.7 or later. Unless a connection is passed in,
+the aioamqp package is used to talk to the broker. A connection is any
+object with a channel() coroutine returning a channel which offers the
+aioamqp channel coroutines used here, so an in-process broker such as
+aiolocalbroker's AsyncLocalConnection can stand in for RabbitMQ.
+"""
+
+import asyncio
+import contextvars
+import logging
+import sys
+import traceback
+
+from RuoteAMQP import codec
+from RuoteAMQP.workitem import Workitem
+from RuoteAMQP.participant import CancelToken, error_reply, format_block, \
+        format_exception, format_ruby_backtrace, log_consume_exception
+from RuoteAMQP.launcher import launch_body
+from RuoteAMQP.dedup import reply_key
+from RuoteAMQP.metrics import Metrics, ParticipantMetrics, LauncherMetrics, \
+        clock
+
+
+# delivery_mode=2 is persistent
+PERSISTENT = {"delivery_mode": 2}
+
+
+def _properties(encoding):
+    """Returns the properties of a message with a content_encoding."""
+    if not encoding:
+        return PERSISTENT
+    return dict(PERSISTENT, content_encoding=encoding)
+
+
+_current_workitem = contextvars.ContextVar("workitem", default=None)
+_current_token = contextvars.ContextVar("cancelled", default=None)
+
+
+async def connect(host, user, password, vhost):
+    """Opens an aioamqp connection to the broker."""
+    import aioamqp
+    _, protocol = await aioamqp.connect(host=host, login=user,
+                                        password=password, virtualhost=vhost)
+    return protocol
+
+
+class AsyncParticipant(object):
+    """
+    A Participant for asyncio applications.
+
+    consume() may be a coroutine, in which case up to concurrency
+    workitems are consumed at once on the event loop. A plain consume()
+    is run in the loop's default executor. Each consume() sees its own
+    workitem in self.workitem.
+
+    With lazy_workitems the workitem fields are only decoded if consume()
+    uses them, and with stream_workitems they are decoded a chunk at a
+    time; see Workitem.
+
+    Like Participant, it records its counts and timings in metrics and
+    compresses replies as compression and compress_threshold ask.
+
+    When the engine cancels a workitem a coroutine consume() is
+    cancelled, getting CancelledError at its next await, and the
+    message is acknowledged without a reply. A plain consume() keeps
+    running in its thread, but should return early once the
+    self.cancelled CancelToken turns true, as with Participant.
+
+    Given a reply_cache, duplicate workitems are answered with the
+    cached reply as Participant does, and those received while the
+    first is being consumed get its reply once it is finished.
+    """
+
+    def __init__(self, ruote_queue,
+                 amqp_host="localhost", amqp_user="ruote",
+                 amqp_pass="ruote", amqp_vhost="ruote",
+                 concurrency=100, conn=None, lazy_workitems=False,
+                 metrics=None, compression=None,
+                 compress_threshold=codec.COMPRESS_THRESHOLD,
+                 stream_workitems=False, reply_cache=None):
+
+        if concurrency < 1:
+            raise ValueError("concurrency should be at least 1")
+        self._conn_params = (amqp_host, amqp_user, amqp_pass, amqp_vhost)
+        self._conn = conn
+        self._chan = None
+        self._queue = ruote_queue
+        self._consumer_tag = None
+        self._concurrency = concurrency
+        self._lazy_workitems = lazy_workitems
+        self._stream_workitems = stream_workitems
+        if compression:
+            # Fail now rather than when replying
+            codec.compressor(compression)
+        self._compression = compression
+        self._compress_threshold = compress_threshold
+        self._tasks = set()
+        # Storage ids of the workitems being consumed, mapped to the
+        # tokens cancelling them
+        self._in_flight = {}
+        self._reply_cache = reply_cache
+        # Reply cache keys of the workitems being consumed, mapped to the
+        # delivery tags of the duplicates waiting for their reply
+        self._duplicates = {}
+        self._finished = None
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self._metrics = ParticipantMetrics(metrics, ruote_queue)
+        self.log = logging.getLogger(__name__)
+
+    @property
+    def workitem(self):
+        "The workitem being handled by the current task."
+        return _current_workitem.get()
+
+    @workitem.setter
+    def workitem(self, workitem):
+        _current_workitem.set(workitem)
+
+    @property
+    def cancelled(self):
+        "The CancelToken of the workitem handled by the current task."
+        return _current_token.get()
+
+    async def _open_channel(self):
+        """Open and initialize the amqp channel."""
+        if self._conn is None:
+            self._conn = await connect(*self._conn_params)
+        self._chan = await self._conn.channel()
+        # prefetch one whole message of any size for each workitem we
+        # can consume concurrently
+        await self._chan.basic_qos(prefetch_size=0,
+                                   prefetch_count=self._concurrency,
+                                   connection_global=False)
+        # Declare a shareable queue for the participant
+        await self._chan.queue_declare(queue_name=self._queue, durable=True,
+                                       exclusive=False, auto_delete=False)
+        result = await self._chan.basic_consume(self.workitem_callback,
+                                                queue_name=self._queue,
+                                                no_ack=False)
+        self._consumer_tag = result["consumer_tag"]
+        return self._chan
+
+    async def workitem_callback(self, channel, body, envelope, properties):
+        """
+        This is where a workitem message is handled
+        """
+        tag = envelope.delivery_tag
+        metrics = self._metrics
+        metrics.received.inc()
+        metrics.received_bytes.observe(len(body))
+        try:
+            started = clock()
+            workitem = Workitem(body, lazy=self._lazy_workitems,
+                                content_encoding=getattr(
+                                    properties, "content_encoding", None),
+                                stream=self._stream_workitems)
+            metrics.decode.observe(clock() - started)
+        except ValueError:
+            # Reject and don't requeue the message
+            await channel.basic_reject(tag, requeue=False)
+            metrics.rejected.inc()
+            self.log.warning("Exception decoding incoming json\n%s" %
+                             format_block(body))
+            return
+
+        if getattr(envelope, "is_redeliver", False):
+            metrics.redelivered.inc()
+
+        metrics.in_flight.inc()
+        if workitem.is_cancel:
+            self._cancel_workitem(workitem.sid)
+            # The engine expects no reply to a cancel
+            await self._finish_workitem(workitem, tag, reply=False)
+            return
+
+        key = None
+        if self._reply_cache is not None:
+            key = reply_key(workitem)
+            if key is not None and await self._replay(key, tag):
+                return
+
+        sid = workitem.sid
+        token = CancelToken()
+        self._in_flight.setdefault(sid, []).append(token)
+        task = asyncio.ensure_future(self._handle(workitem, tag, token,
+                                                  key, clock()))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _cancel_workitem(self, sid):
+        """Cancels the workitems with storage id sid being consumed."""
+        tokens = self._in_flight.pop(sid, [])
+        for token in tokens:
+            token.cancel()
+        if tokens:
+            self._metrics.cancelled.inc(len(tokens))
+            self.log.info("Cancelled workitem %s" % sid)
+        else:
+            self.log.info("Workitem %s to cancel isn't being consumed here"
+                          % sid)
+
+    def _untrack(self, sid, token):
+        """Forgets a finished workitem's token."""
+        tokens = self._in_flight.get(sid)
+        if tokens and token in tokens:
+            tokens.remove(token)
+            if not tokens:
+                del self._in_flight[sid]
+
+    async def _replay(self, key, tag):
+        """
+        Finishes the message with tag if it is a duplicate of a workitem
+        consumed already or being consumed, with reply cache key key.
+        Returns False if the workitem should be consumed.
+        """
+        if key in self._duplicates:
+            self._duplicates[key].append(tag)
+            return True
+        try:
+            cached = self._reply_cache.get(key)
+        except Exception:
+            self.log.error("Failed to look up the reply to workitem %s\n%s"
+                           % (key, format_block(traceback.format_exc())))
+            cached = None
+        if cached is None:
+            self._duplicates[key] = []
+            return False
+        self.log.info("Replaying the reply to duplicate workitem %s" % key)
+        metrics = self._metrics
+        metrics.in_flight.dec()
+        metrics.replayed.inc()
+        await self._chan.basic_client_ack(tag)
+        metrics.acked.inc()
+        if cached[0] is not None:
+            await self._publish(*cached)
+        return True
+
+    async def _handle(self, workitem, tag, token, key, submitted):
+        """Runs consume() for workitem then acks and replies."""
+        # Each task runs in a copy of the context, so this is only seen
+        # by this workitem's consume()
+        self.workitem = workitem
+        _current_token.set(token)
+        metrics = self._metrics
+        started = clock()
+        metrics.wait.observe(started - submitted)
+        try:
+            if token:
+                # Cancelled before it started
+                pass
+            elif asyncio.iscoroutinefunction(self.consume):
+                consuming = asyncio.ensure_future(self.consume())
+                token.add_callback(consuming.cancel)
+                await consuming
+            else:
+                loop = asyncio.get_event_loop()
+                consuming = loop.run_in_executor(
+                        None, contextvars.copy_context().run, self.consume)
+                # The thread runs on, but the workitem is finished
+                token.add_callback(consuming.cancel)
+                await consuming
+        except asyncio.CancelledError:
+            if not token:
+                raise
+        except Exception as exobj:
+            if not token:
+                metrics.errored.inc()
+                log_consume_exception(self.log, workitem)
+                workitem.error = format_exception(exobj)
+                workitem.trace = format_ruby_backtrace(
+                        traceback.extract_tb(sys.exc_info()[2]))
+        metrics.consume.observe(clock() - started)
+        self._untrack(workitem.sid, token)
+        try:
+            await self._finish_workitem(workitem, tag, reply=not token,
+                                        key=key)
+        except Exception:
+            self.log.error("Failed to acknowledge and reply to workitem %s\n%s"
+                           % (workitem.sid,
+                              format_block(traceback.format_exc())))
+
+    async def _finish_workitem(self, workitem, tag, reply=True, key=None):
+        """
+        Acknowledges the workitem message and replies to the engine
+        unless reply is false. Given a reply cache key the reply is
+        cached first, and sent for the duplicates received meanwhile
+        too. If the reply can't be encoded an error reply is sent as
+        Participant does, and the messages are rejected if that can't be
+        encoded either.
+        """
+        metrics = self._metrics
+        metrics.in_flight.dec()
+        body = encoding = None
+        if reply and not workitem.forget:
+            try:
+                body, encoding = self._reply_body(workitem)
+            except Exception as exobj:
+                self.log.error("Failed to encode the reply to workitem %s, "
+                               "replying with the error\n%s"
+                               % (workitem.sid,
+                                  format_block(traceback.format_exc())))
+                try:
+                    body, encoding = codec.compress(
+                            error_reply(workitem, exobj), self._compression,
+                            self._compress_threshold)
+                except Exception:
+                    self.log.error(
+                            "Failed to encode an error reply to workitem "
+                            "%s, rejecting it\n%s"
+                            % (workitem.sid,
+                               format_block(traceback.format_exc())))
+                    await self._reject(tag, key)
+                    return
+        duplicates = []
+        if key is not None:
+            try:
+                self._reply_cache.put(key, body, encoding)
+            except Exception:
+                # The reply still goes out, it just won't be replayed
+                self.log.error("Failed to cache the reply to workitem %s\n%s"
+                               % (key, format_block(traceback.format_exc())))
+            duplicates = self._duplicates.pop(key, [])
+        await self._chan.basic_client_ack(tag)
+        metrics.acked.inc()
+        if body is not None:
+            await self._publish(body, encoding)
+        for duplicate in duplicates:
+            metrics.in_flight.dec()
+            metrics.replayed.inc()
+            await self._chan.basic_client_ack(duplicate)
+            metrics.acked.inc()
+            if body is not None:
+                await self._publish(body, encoding)
+
+    async def _reject(self, tag, key=None):
+        """
+        Rejects the message with tag without requeueing it, and the
+        duplicates waiting for its reply cache key.
+        """
+        tags = [tag]
+        if key is not None:
+            duplicates = self._duplicates.pop(key, [])
+            tags.extend(duplicates)
+            self._metrics.in_flight.dec(len(duplicates))
+        for tag in tags:
+            await self._chan.basic_reject(tag, requeue=False)
+            self._metrics.rejected.inc()
+
+    async def consume(self):
+        """
+        Override the consume() method in a subclass to do useful work.
+        The workitem attribute contains a Workitem.
+        It may be a coroutine or a plain method.
+        """
+        pass
+
+    async def run(self):
+        """
+        Consumes workitems until finish() is called.
+        """
+        if self._finished is not None:
+            raise RuntimeError("Participant already running")
+        self._finished = asyncio.Event()
+        try:
+            await self._open_channel()
+            await self._finished.wait()
+            # Let the workitems already received finish
+            if self._tasks:
+                await asyncio.wait(list(self._tasks))
+            await self._chan.close()
+        finally:
+            self._finished = None
+
+    async def finish(self):
+        """
+        Stops consuming; run() returns once in-flight workitems are done.
+        """
+        if self._chan is not None and self._chan.is_open:
+            # Cancel the consumer so that we don't receive more messages
+            await self._chan.basic_cancel(self._consumer_tag)
+        if self._finished is not None:
+            self._finished.set()
+
+    async def reply_to_engine(self, workitem=None):
+        """
+        When the job is complete the workitem is passed back to the
+        ruote engine.  The consume() method should set the
+        workitem.result() if required.
+        """
+        if not (self._chan and self._chan.is_open):
+            raise RuntimeError("AMQP channel not open")
+        if not workitem:
+            workitem = self.workitem
+        await self._publish(*self._reply_body(workitem))
+
+    def _reply_body(self, workitem):
+        """Returns the body and content_encoding of a workitem's reply."""
+        metrics = self._metrics
+        started = clock()
+        body, encoding = codec.compress(workitem.to_json(),
+                                        self._compression,
+                                        self._compress_threshold)
+        metrics.encode.observe(clock() - started)
+        metrics.reply_bytes.observe(len(body))
+        return body, encoding
+
+    async def _publish(self, body, encoding):
+        """Publishes a reply."""
+        started = clock()
+        await self._chan.basic_publish(body, exchange_name='',
+                                       routing_key='ruote_workitems',
+                                       properties=_properties(encoding))
+        self._metrics.publish.observe(clock() - started)
+
+
+class AsyncLauncher(object):
+    """
+    A Launcher for asyncio applications; launch() is a coroutine.
+    Launches are recorded in metrics and compressed as Launcher does.
+    """
+
+    def __init__(self,
+                 amqp_host="localhost", amqp_user="boss",
+                 amqp_pass="boss", amqp_vhost="boss",
+                 conn=None, metrics=None, compression=None,
+                 compress_threshold=codec.COMPRESS_THRESHOLD):
+        self._conn_params = (amqp_host, amqp_user, amqp_pass, amqp_vhost)
+        self.conn = conn
+        self.chan = None
+        if compression:
+            # Fail now rather than when launching
+            codec.compressor(compression)
+        self._compression = compression
+        self._compress_threshold = compress_threshold
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self._metrics = LauncherMetrics(metrics)
+
+    async def _open_channel(self):
+        """Opens the connection and channel on first use."""
+        if self.conn is None:
+            self.conn = await connect(*self._conn_params)
+        if self.chan is None or not self.chan.is_open:
+            self.chan = await self.conn.channel()
+        return self.chan
+
+    async def launch(self, process, fields=None, variables=None):
+        """
+        Launch a process definition
+        """
+        metrics = self._metrics
+        started = clock()
+        body, encoding = codec.compress(
+                launch_body(process, fields, variables),
+                self._compression, self._compress_threshold)
+        metrics.encode.observe(clock() - started)
+        metrics.launch_bytes.observe(len(body))
+        chan = await self._open_channel()
+        started = clock()
+        try:
+            await chan.basic_publish(body, exchange_name='',
+                                     routing_key='ruote_workitems',
+                                     properties=_properties(encoding))
+        except Exception:
+            metrics.failed.inc()
+            raise
+        metrics.publish.observe(clock() - started)
+        metrics.launched.inc()
+
+    async def close(self):
+        """Closes the channel."""
+        if self.chan is not None and self.chan.is_open:
+            await self.chan.close()
+        self.chan = None
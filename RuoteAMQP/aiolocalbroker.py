@@ -0,0 +1,210 @@
+# Copyright (C) 2010 Nokia Corporation and/or its subsidiary(-ies).
+# Contact: David Greaves <ext-david.greaves@nokia.com>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+aioamqp style access to a LocalBroker.
+
+AsyncLocalConnection offers the part of the aioamqp protocol and channel
+API which AsyncParticipant and AsyncLauncher use, so they can be run and
+tested without RabbitMQ:
+
+    broker = LocalBroker()
+    participant = MyParticipant("builder",
+                                conn=AsyncLocalConnection(broker))
+    launcher = AsyncLauncher(conn=AsyncLocalConnection(broker))
+
+The queues are the LocalBroker's, so amqplib style clients of the same
+broker see the same messages. As with aioamqp, the consumer callbacks of
+a channel are awaited one delivery at a time, in a task of the event
+loop the channel was opened in. Like aio, this module needs Python 3.7
+or later.
+"""
+
+import asyncio
+import logging
+
+from RuoteAMQP.localbroker import LocalChannel, LocalMessage
+
+
+class Envelope(object):
+    """The delivery details aioamqp passes to consumer callbacks."""
+
+    def __init__(self, consumer_tag, delivery_tag, exchange_name,
+                 routing_key, is_redeliver):
+        self.consumer_tag = consumer_tag
+        self.delivery_tag = delivery_tag
+        self.exchange_name = exchange_name
+        self.routing_key = routing_key
+        self.is_redeliver = is_redeliver
+
+
+class Properties(object):
+    """
+    The message properties aioamqp passes to consumer callbacks, with
+    None for those the message doesn't have.
+    """
+
+    NAMES = ("content_type", "content_encoding", "headers", "delivery_mode",
+             "priority", "correlation_id", "reply_to", "expiration",
+             "message_id", "timestamp", "message_type", "user_id", "app_id",
+             "cluster_id")
+
+    def __init__(self, properties):
+        for name in self.NAMES:
+            setattr(self, name, properties.get(name))
+
+
+class _WakingChannel(LocalChannel):
+    """
+    A LocalChannel calling wake() after queueing each delivery and once
+    it is closed.
+    """
+
+    def __init__(self, connection, channel_id, wake):
+        LocalChannel.__init__(self, connection, channel_id)
+        self._wake = wake
+
+    def _deliver(self, *args):
+        LocalChannel._deliver(self, *args)
+        self._wake()
+
+    def close(self):
+        LocalChannel.close(self)
+        self._wake()
+
+
+class AsyncLocalConnection(object):
+    """
+    A connection to a LocalBroker, used like an aioamqp protocol.
+    """
+
+    def __init__(self, broker):
+        self._conn = broker.connect()
+
+    async def channel(self):
+        """Opens a channel."""
+        conn = self._conn
+        chan = AsyncLocalChannel(conn, next(conn._ids))
+        conn.channels[chan.channel_id] = chan._chan
+        return chan
+
+    async def close(self):
+        """Closes the connection and its channels."""
+        self._conn.close()
+
+
+class AsyncLocalChannel(object):
+    """
+    A channel to a LocalBroker with the aioamqp channel coroutines used
+    by RuoteAMQP.
+    """
+
+    def __init__(self, connection, channel_id):
+        self._loop = asyncio.get_running_loop()
+        self._delivered = asyncio.Event()
+        self._chan = _WakingChannel(connection, channel_id, self._wake)
+        self.channel_id = channel_id
+        self.log = logging.getLogger(__name__)
+        self._task = self._loop.create_task(self._run())
+
+    @property
+    def is_open(self):
+        return self._chan.is_open
+
+    def _wake(self):
+        """Has _run() look for deliveries or stop, from any thread."""
+        try:
+            self._loop.call_soon_threadsafe(self._delivered.set)
+        except RuntimeError:
+            # The loop is closed, and nothing will consume them
+            pass
+
+    async def _run(self):
+        """Awaits the consumer callbacks of each delivery in turn."""
+        chan = self._chan
+        lock = chan._broker._lock
+        while chan.is_open:
+            await self._delivered.wait()
+            self._delivered.clear()
+            while True:
+                with lock:
+                    if not (chan.is_open and chan._deliveries):
+                        break
+                    callback, msg = chan._deliveries.popleft()
+                info = msg.delivery_info
+                envelope = Envelope(info["consumer_tag"],
+                                    info["delivery_tag"], info["exchange"],
+                                    info["routing_key"], info["redelivered"])
+                try:
+                    await callback(self, msg.body, envelope,
+                                   Properties(msg.properties))
+                except Exception:
+                    self.log.exception("Consumer callback failed")
+
+    async def basic_qos(self, prefetch_size=0, prefetch_count=0,
+                        connection_global=False):
+        """Limits the unacknowledged messages delivered on the channel."""
+        self._chan.basic_qos(prefetch_size, prefetch_count,
+                             connection_global)
+
+    async def queue_declare(self, queue_name=None, passive=False,
+                            durable=False, exclusive=False,
+                            auto_delete=False, no_wait=False,
+                            arguments=None):
+        """Declares a queue, returning its name and counts."""
+        queue, messages, consumers = self._chan.queue_declare(
+                queue_name or "", passive=passive, durable=durable,
+                exclusive=exclusive, auto_delete=auto_delete)
+        return {"queue": queue, "message_count": messages,
+                "consumer_count": consumers}
+
+    async def basic_consume(self, callback, queue_name="", consumer_tag="",
+                            no_local=False, no_ack=False, exclusive=False,
+                            no_wait=False, arguments=None):
+        """Starts delivering messages from a queue to callback."""
+        consumer_tag = self._chan.basic_consume(
+                queue_name, consumer_tag, no_ack=no_ack, callback=callback)
+        return {"consumer_tag": consumer_tag}
+
+    async def basic_cancel(self, consumer_tag, no_wait=False):
+        """
+        Stops a consumer. Messages already delivered to it are still
+        passed to its callback.
+        """
+        self._chan.basic_cancel(consumer_tag)
+
+    async def basic_publish(self, payload, exchange_name, routing_key,
+                            properties=None, mandatory=False,
+                            immediate=False):
+        """Publishes payload, encoding it as UTF-8 if it is a str."""
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        self._chan.basic_publish(LocalMessage(payload, properties),
+                                 exchange_name, routing_key)
+
+    async def basic_client_ack(self, delivery_tag, multiple=False):
+        """Acknowledges a message, or with multiple all up to it."""
+        self._chan.basic_ack(delivery_tag, multiple)
+
+    async def basic_reject(self, delivery_tag, requeue=False):
+        """Rejects a message, dropping it unless requeue is set."""
+        self._chan.basic_reject(delivery_tag, requeue)
+
+    async def close(self, reply_code=0, reply_text="Normal Shutdown"):
+        """
+        Closes the channel, requeueing the messages it didn't
+        acknowledge.
+        """
+        self._chan.close()
@@ -0,0 +1,410 @@
+# Copyright (C) 2010 Nokia Corporation and/or its subsidiary(-ies).
+# Contact: David Greaves <ext-david.greaves@nokia.com>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+JSON encoding and decoding of workitems and launch messages.
+
+The first available backend out of orjson, ujson, simplejson (with its
+C speedups) and the standard json module is used, unless one is named in
+the RUOTE_AMQP_JSON environment variable or passed to set_codec(). A
+backend is only used if it round trips what the ruote engine emits and
+encodes what the json module does. What orjson and ujson refuse to
+encode, such as integers beyond 64 bits, is encoded by the json module
+instead, which also decodes the json holding such integers that orjson
+would decode as floats.
+
+Message bodies may also be compressed with zlib, or zstd and lz4 when
+the zstandard and lz4 packages are installed. The algorithm is named in
+the AMQP content_encoding property: "deflate", "zstd" or "lz4".
+
+With ijson installed, load() parses a document as it reads it, so large
+bodies can be decompressed and decoded a chunk at a time.
+"""
+
+import io
+import os
+import zlib
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+# The ijson module once get_ijson() has looked for it, None if unusable
+_ijson = False
+
+
+# A workitem as the ruote engine encodes it, with the awkward bits:
+# escapes, non-ascii text, big and negative numbers, integers beyond 64
+# bits, floats and nulls.
+SAMPLE = (
+    '{"fields":{"params":{"ref":"toto","task":"x","forget":false},'
+    '"dispatched_at":"2010-05-07 10:11:12.123456 UTC",'
+    '"image":{"size":512,"name":"caf\\u00e9 \\"latte\\"\\n","tags":[]},'
+    '"packages":["a/b","c\\\\d","\\u20ac",null,true],'
+    '"stats":{"big":9007199254740993,"neg":-42,"ratio":0.1,'
+    '"huge":1180591620717411303424,"low":-9223372036854775809,'
+    '"exp":1.5e-07,"empty":{}}},'
+    '"fei":{"engine_id":"engine","wfid":"20100507-wagamama",'
+    '"subid":"6f7b2b0c4f3e4b3a8a2bd5f1e5b1e2d4","expid":"0_0_1"},'
+    '"participant_name":"sizer","wf_name":"test","wf_revision":null,'
+    '"re_dispatch_count":0}')
+
+# Values the json module encodes which a backend may refuse: keys which
+# aren't strings, and integers beyond 64 bits. Some ujson builds leave
+# those out of the json they return if an unsigned 64 bit one follows.
+AWKWARD = {"keys": {1: "one"}, "huge": [2 ** 70, -2 ** 70, 2 ** 63]}
+
+# Digits mapped to "0", and the run of them an integer beyond 64 bits
+# takes at least
+_DIGITS = bytes(bytearray(48 if 48 <= c <= 57 else c for c in range(256)))
+_BIG_INT = b"0" * 19
+
+
+def _same(a, b):
+    """Returns whether a and b are equal, down to the types of numbers."""
+    return json.dumps(a, sort_keys=True) == json.dumps(b, sort_keys=True)
+
+
+class Codec(object):
+    """A named pair of json loads() and dumps() functions."""
+
+    def __init__(self, name, loads, dumps):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+    def __repr__(self):
+        return "<Codec %s>" % self.name
+
+    def compatible(self, sample=SAMPLE):
+        """
+        Checks the backend decodes sample like the json module does,
+        that everything it encodes decodes back to the same thing and
+        that it encodes AWKWARD as the json module does.
+        """
+        try:
+            expected = json.loads(sample)
+            decoded = self.loads(sample)
+            encoded = self.dumps(expected)
+            return (_same(decoded, expected) and
+                    _same(json.loads(encoded), expected) and
+                    _same(self.loads(encoded), expected) and
+                    _same(json.loads(self.dumps(AWKWARD)),
+                          json.loads(json.dumps(AWKWARD))))
+        except Exception:
+            return False
+
+
+def _falling_back(dumps):
+    """
+    Returns dumps() encoding with the json module what the backend's
+    dumps refuses.
+    """
+    def falling_back(obj):
+        try:
+            return dumps(obj)
+        except (TypeError, OverflowError):
+            # Raises too if json can't encode it either
+            return json.dumps(obj)
+    return falling_back
+
+
+def _exact_loads(loads):
+    """
+    Returns loads() decoding with the json module text holding a run of
+    digits as long as an integer beyond 64 bits, which the backend's
+    loads decodes as a float.
+    """
+    def exact_loads(s):
+        data = s if isinstance(s, bytes) else s.encode("utf-8")
+        if data.translate(_DIGITS).find(_BIG_INT) >= 0:
+            return json.loads(s)
+        return loads(s)
+    return exact_loads
+
+
+def _orjson():
+    import orjson
+
+    def dumps(obj):
+        return orjson.dumps(obj).decode("utf-8")
+    return Codec("orjson", _exact_loads(orjson.loads), _falling_back(dumps))
+
+
+def _ujson():
+    import ujson
+
+    def dumps(obj):
+        return ujson.dumps(obj, escape_forward_slashes=False)
+    return Codec("ujson", ujson.loads, _falling_back(dumps))
+
+
+def _simplejson():
+    import simplejson
+    if not simplejson._import_c_make_encoder():
+        raise ImportError("simplejson has no C speedups")
+    return Codec("simplejson", simplejson.loads, simplejson.dumps)
+
+
+def _json():
+    return Codec("json", json.loads, json.dumps)
+
+
+# In order of preference
+BACKENDS = [("orjson", _orjson), ("ujson", _ujson),
+            ("simplejson", _simplejson), ("json", _json)]
+
+_codec = None
+
+
+def available():
+    """Returns the backends which can be imported and are compatible."""
+    codecs = []
+    for _, factory in BACKENDS:
+        try:
+            codec = factory()
+        except ImportError:
+            continue
+        if codec.compatible():
+            codecs.append(codec)
+    return codecs
+
+
+def set_codec(name=None):
+    """
+    Selects the named backend, or the preferred available one if name
+    is None. Raises ValueError if the backend can't be used.
+    """
+    global _codec
+    for backend, factory in BACKENDS:
+        if name is not None and name != backend:
+            continue
+        try:
+            codec = factory()
+        except ImportError:
+            continue
+        if codec.compatible():
+            _codec = codec
+            return codec
+    raise ValueError("JSON backend %s is not available" % name)
+
+
+def get_codec():
+    """Returns the backend in use, selecting it on first use."""
+    if _codec is None:
+        set_codec(os.environ.get("RUOTE_AMQP_JSON") or None)
+    return _codec
+
+
+def loads(s):
+    "Decodes a json string."
+    return (_codec or get_codec()).loads(s)
+
+
+def dumps(obj):
+    "Encodes obj as a json string."
+    return (_codec or get_codec()).dumps(obj)
+
+
+def get_ijson():
+    """
+    Returns the ijson module, imported on first use, or None if it isn't
+    installed or can't be used.
+    """
+    global _ijson
+    if _ijson is False:
+        try:
+            import ijson
+            # Integers beyond 64 bits must be decoded exactly
+            if next(ijson.items(io.BytesIO(b"[%d]" % 2 ** 70), "")) != \
+                    [2 ** 70]:
+                ijson = None
+        except Exception:
+            ijson = None
+        _ijson = ijson
+    return _ijson
+
+
+def load(fileobj):
+    """
+    Decodes the json document read from a binary file object. With ijson
+    it is parsed as it is read, and the text is never held whole.
+    """
+    ijson = get_ijson()
+    if ijson is None:
+        return loads(fileobj.read())
+    from decimal import Decimal
+    builder = ijson.ObjectBuilder()
+    # Share repeated keys between objects as the json module does
+    keys = {}
+    try:
+        # Floats are decoded as Decimals: ijson's use_float fails on
+        # integers beyond 64 bits
+        for event, value in ijson.basic_parse(fileobj):
+            if event == "map_key":
+                value = keys.setdefault(value, value)
+            elif event == "number" and isinstance(value, Decimal):
+                value = float(value)
+            builder.event(event, value)
+    except ijson.JSONError as exobj:
+        raise ValueError(str(exobj))
+    if not hasattr(builder, "value"):
+        raise ValueError("No JSON object could be decoded")
+    return builder.value
+
+
+class Compressor(object):
+    """
+    A named pair of compress() and decompress() functions, and reader()
+    returning a binary file object which decompresses as it is read.
+    """
+
+    def __init__(self, name, compress, decompress, reader):
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+        self.reader = reader
+
+    def __repr__(self):
+        return "<Compressor %s>" % self.name
+
+
+def _zstd():
+    import zstandard
+
+    # Compressor objects can't be shared between threads
+    def compress(data):
+        return zstandard.ZstdCompressor(level=3).compress(data)
+
+    def decompress(data):
+        return zstandard.ZstdDecompressor().decompress(data)
+
+    def reader(data):
+        return zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data))
+    return Compressor("zstd", compress, decompress, reader)
+
+
+def _lz4():
+    import lz4.frame
+    return Compressor("lz4", lz4.frame.compress, lz4.frame.decompress,
+                      lambda data: lz4.frame.LZ4FrameFile(io.BytesIO(data)))
+
+
+class _DeflateReader(object):
+    """A binary file object decompressing zlib data as it is read."""
+
+    # Compressed bytes fed to zlib at a time
+    CHUNK = 64 * 1024
+
+    def __init__(self, data):
+        self._data = data
+        self._pos = 0
+        self._zlib = zlib.decompressobj()
+
+    def read(self, size=-1):
+        "Returns up to size decompressed bytes, or all the rest."
+        chunks = []
+        wanted = size if size > 0 else 0
+        while size < 0 or wanted > 0:
+            if self._zlib.unconsumed_tail:
+                data = self._zlib.unconsumed_tail
+            elif self._pos < len(self._data):
+                data = self._data[self._pos:self._pos + self.CHUNK]
+                self._pos += self.CHUNK
+            else:
+                chunks.append(self._zlib.flush())
+                break
+            chunk = self._zlib.decompress(data, wanted)
+            chunks.append(chunk)
+            if size > 0:
+                wanted -= len(chunk)
+        return b"".join(chunks)
+
+
+def _deflate():
+    return Compressor("deflate", lambda data: zlib.compress(data, 6),
+                      zlib.decompress, _DeflateReader)
+
+
+# In order of preference
+COMPRESSORS = [("zstd", _zstd), ("lz4", _lz4), ("deflate", _deflate)]
+
+# Bodies smaller than this many bytes are sent as they are
+COMPRESS_THRESHOLD = 64 * 1024
+
+_compressors = {}
+
+
+def compressor(name=True):
+    """
+    Returns the named Compressor, or the preferred available one if name
+    is True. Raises ValueError if it can't be used.
+    """
+    if name in _compressors:
+        return _compressors[name]
+    for algorithm, factory in COMPRESSORS:
+        if name is not True and name != algorithm:
+            continue
+        try:
+            _compressors[name] = factory()
+        except ImportError:
+            continue
+        return _compressors[name]
+    raise ValueError("Compression %s is not available" % name)
+
+
+def compress(body, compression=True, threshold=COMPRESS_THRESHOLD):
+    """
+    Returns (body, content_encoding): body compressed as compression asks
+    and the name of the algorithm, or body and None if it is below
+    threshold bytes, compression is None or it wouldn't shrink.
+    """
+    if not compression or len(body) < threshold:
+        return body, None
+    if not isinstance(body, bytes):
+        body = body.encode("utf-8")
+    algorithm = compressor(compression)
+    compressed = algorithm.compress(body)
+    if len(compressed) >= len(body):
+        return body, None
+    return compressed, algorithm.name
+
+
+def decompress(body, content_encoding):
+    """
+    Returns body decompressed as content_encoding says. A body whose
+    content_encoding names no compression, like a charset, is returned
+    as it is.
+    """
+    if content_encoding:
+        name = content_encoding.lower()
+        if name in ("deflate", "zstd", "lz4"):
+            return compressor(name).decompress(body)
+    return body
+
+
+def reader(body, content_encoding=None):
+    """
+    Returns a binary file object reading body, decompressed as its
+    content_encoding says.
+    """
+    if not isinstance(body, bytes):
+        body = body.encode("utf-8")
+    if content_encoding:
+        name = content_encoding.lower()
+        if name in ("deflate", "zstd", "lz4"):
+            return compressor(name).reader(body)
+    return io.BytesIO(body)
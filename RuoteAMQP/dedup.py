@@ -0,0 +1,175 @@
+# Copyright (C) 2010 Nokia Corporation and/or its subsidiary(-ies).
+# Contact: David Greaves <ext-david.greaves@nokia.com>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Replaying the replies to workitems delivered more than once.
+
+A workitem message is only acknowledged once consume() has returned, so
+the broker delivers it again if the participant dies or loses its
+connection in between. Given a reply cache a participant remembers the
+reply to each workitem and sends it again for a duplicate instead of
+consuming it twice.
+
+A workitem is known by its storage id and the time it was dispatched:
+the engine dispatches it anew, with a new dispatched_at, when a process
+is replayed at an error or an expression re-applied, and that is
+consumed again.
+"""
+
+from __future__ import with_statement
+import time
+from threading import Lock
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+
+def reply_key(workitem):
+    """
+    Returns the key the reply to workitem is cached under, or None if it
+    has no dispatched_at to tell a duplicate from a new dispatch.
+    """
+    dispatched_at = workitem.dispatched_at
+    if dispatched_at is None:
+        return None
+    return "%s|%s" % (workitem.sid, dispatched_at)
+
+
+class ReplyCache(object):
+    """
+    Remembers the replies to the latest max_entries workitems in memory,
+    each for ttl seconds.
+
+    A reply is the (body, content_encoding) of the message sent to the
+    engine, or (None, None) when nothing was sent.
+    """
+
+    def __init__(self, max_entries=10000, ttl=24 * 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = Lock()
+        # key: (expires, body, content_encoding), least recently used first
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns the reply cached under key, or None."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                return None
+            self._entries[key] = entry
+            return entry[1:]
+
+    def put(self, key, body, content_encoding=None):
+        """Caches a reply under key."""
+        with self._lock:
+            self._entries.pop(key, None)
+            while len(self._entries) >= self.max_entries:
+                self._entries.popitem(last=False)
+            self._entries[key] = (time.time() + self.ttl, body,
+                                  content_encoding)
+
+
+class SQLiteReplyCache(object):
+    """
+    A ReplyCache kept in an SQLite database at path, so that replies are
+    still replayed after the participant is restarted. Each reply is
+    committed before its workitem is acknowledged.
+
+    Once it holds more than max_entries replies the oldest are dropped,
+    a few hundred at a time.
+    """
+
+    # Puts between pruning expired and surplus replies
+    PRUNE_INTERVAL = 256
+
+    def __init__(self, path, max_entries=100000, ttl=7 * 24 * 3600):
+        try:
+            import sqlite3
+        except ImportError:
+            raise ValueError("SQLiteReplyCache needs the sqlite3 module")
+        self._sqlite3 = sqlite3
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = Lock()
+        self._puts = 0
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS replies ("
+                             "key TEXT PRIMARY KEY, expires REAL, "
+                             "body BLOB, content_encoding TEXT)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS replies_expires "
+                             "ON replies (expires)")
+            self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute(
+                    "SELECT COUNT(*) FROM replies").fetchone()[0]
+
+    def get(self, key):
+        """Returns the reply cached under key, or None."""
+        with self._lock:
+            row = self._db.execute(
+                    "SELECT body, content_encoding FROM replies "
+                    "WHERE key = ? AND expires >= ?",
+                    (key, time.time())).fetchone()
+        if row is None:
+            return None
+        body, content_encoding = row
+        if body is not None:
+            body = bytes(body)
+        return body, content_encoding
+
+    def put(self, key, body, content_encoding=None):
+        """Caches a reply under key."""
+        if body is not None:
+            if not isinstance(body, bytes):
+                body = body.encode("utf-8")
+            body = self._sqlite3.Binary(body)
+        with self._lock:
+            self._db.execute(
+                    "INSERT OR REPLACE INTO replies VALUES (?, ?, ?, ?)",
+                    (key, time.time() + self.ttl, body, content_encoding))
+            self._puts += 1
+            if self._puts % self.PRUNE_INTERVAL == 0:
+                self._prune()
+            self._db.commit()
+
+    def _prune(self):
+        """Drops expired replies, then the oldest beyond max_entries."""
+        self._db.execute("DELETE FROM replies WHERE expires < ?",
+                         (time.time(),))
+        surplus = self._db.execute(
+                "SELECT COUNT(*) FROM replies").fetchone()[0] - \
+            self.max_entries
+        if surplus > 0:
+            # Replies all live as long, so the oldest expire first
+            self._db.execute(
+                    "DELETE FROM replies WHERE key IN (SELECT key FROM "
+                    "replies ORDER BY expires LIMIT ?)", (surplus,))
+
+    def close(self):
+        """Closes the database."""
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,253 @@
+# Copyright (C) 2010 Nokia Corporation and/or its subsidiary(-ies).
+# Contact: David Greaves <ext-david.greaves@nokia.com>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Serving many participants from one process """
+
+from __future__ import with_statement
+import logging
+import select
+
+from RuoteAMQP.pool import ConnectionPool
+from RuoteAMQP.participant import configure_logging
+
+
+def connection_reader(conn):
+    """
+    Returns what ParticipantHost reads a connection through: the reader()
+    of a connection which has one, such as a LocalConnection, or else an
+    AmqplibReader. A reader has these methods:
+
+    dispatch_set_aside(chan)
+        Dispatches a method set aside for one of its channels while an
+        earlier call waited for its reply, returning whether there was
+        one.
+    buffered()
+        Returns whether it holds methods it can dispatch without blocking.
+    dispatch()
+        Reads one method from the connection and dispatches it.
+    wait(readers, timeout)
+        Returns those of readers, all of the same kind, which have a
+        method to read within timeout seconds.
+    """
+    reader = getattr(conn, "reader", None)
+    if reader is not None:
+        return reader()
+    return AmqplibReader(conn)
+
+
+class AmqplibReader(object):
+    """
+    Reads the methods of an amqplib connection one at a time, which
+    amqplib has no public API for. This is the only code depending on
+    amqplib's internals.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def dispatch_set_aside(self, chan):
+        if not chan.method_queue:
+            return False
+        chan.dispatch_method(*chan.method_queue.pop(0))
+        return True
+
+    def buffered(self):
+        # amqplib reads the socket ahead into its own buffer, which
+        # select() knows nothing of
+        conn = self.conn
+        return (not conn.method_reader.queue.empty() or
+                bool(getattr(conn.transport, "_read_buffer", None)))
+
+    def dispatch(self):
+        conn = self.conn
+        channel, method_sig, args, content = conn.method_reader.read_method()
+        if channel == 0:
+            # Most likely the broker closing the connection, which raises
+            conn.dispatch_method(method_sig, args, content)
+        elif channel in conn.channels:
+            conn.channels[channel].dispatch_method(method_sig, args, content)
+        else:
+            logging.getLogger(__name__).warning(
+                    "Dropping method %s for closed channel %d" %
+                    (method_sig, channel))
+
+    @staticmethod
+    def wait(readers, timeout):
+        socks = dict((reader.conn.transport.sock, reader)
+                     for reader in readers)
+        readable = select.select(list(socks), [], [], timeout)[0]
+        return [socks[sock] for sock in readable]
+
+
+class ParticipantHost(object):
+    """
+    A ParticipantHost runs many participants in one process. Each one
+    consumes its own queue with its own concurrency and prefetch, while
+    their channels share the connections of a ConnectionPool and are all
+    read by the thread calling run().
+
+    Methods are read one at a time from each connection and channel in
+    turn, and consume() runs in each participant's own consumer threads,
+    so a busy or slow queue doesn't hold up the others.
+
+    finish() stops the host; a participant's own finish() only cancels
+    its consumer. The host doesn't reconnect: run() raises if a
+    connection is lost.
+    """
+
+    # Seconds to wait for a message before checking for finish()
+    POLL_INTERVAL = 1.0
+
+    def __init__(self, connection_pool=None,
+                 amqp_host="localhost", amqp_user="ruote",
+                 amqp_pass="ruote", amqp_vhost="ruote"):
+        self._own_pool = connection_pool is None
+        if self._own_pool:
+            connection_pool = ConnectionPool(amqp_host, amqp_user,
+                                             amqp_pass, amqp_vhost)
+        self.pool = connection_pool
+        self.participants = []
+        self._running = False
+        self._next = 0
+        self._readers = {}
+        self.log = logging.getLogger(__name__)
+
+    def register(self, participant_class, ruote_queue, concurrency=1,
+                 prefetch=None, **kwargs):
+        """
+        Creates a participant_class participant consuming ruote_queue on
+        the host's connections and adds it. Other keyword arguments are
+        passed on to participant_class.
+        """
+        participant = participant_class(ruote_queue, concurrency=concurrency,
+                                        prefetch=prefetch,
+                                        connection_pool=self.pool, **kwargs)
+        self.add(participant)
+        return participant
+
+    def add(self, participant):
+        """Adds a participant created on the host's ConnectionPool."""
+        if self._running:
+            raise RuntimeError("Can't add participants to a running host")
+        if participant._conn_pool is not self.pool:
+            raise ValueError("Participant doesn't use the host's "
+                             "connection pool")
+        participant._hosted = True
+        self.participants.append(participant)
+
+    def run(self):
+        """
+        Consumes the queues of all the participants until finish() is
+        called or they have all finished.
+        """
+        if self._running:
+            raise RuntimeError("ParticipantHost already running")
+        configure_logging()
+        self._running = True
+        try:
+            # Open every channel before dispatching anything, as waiting
+            # for the broker's replies isn't safe once consumer threads
+            # write to the connections
+            for participant in self.participants:
+                participant._open_channel(self.pool)
+            # Every participant's worker processes are forked before any
+            # consumer thread runs; see ForkServer
+            for participant in self.participants:
+                participant._start_pool(threads=False)
+            for participant in self.participants:
+                participant._start_pool()
+                participant._running = True
+            while self._running:
+                consuming = [participant
+                             for participant in self.participants
+                             if participant._consumer_tag is not None]
+                if not consuming:
+                    break
+                for participant in consuming:
+                    if not participant._running:
+                        self._cancel(participant)
+                self._poll(consuming)
+            for participant in self.participants:
+                self._cancel(participant)
+            # Finish the workitems already received while the channels
+            # are still open to acknowledge them
+            for participant in self.participants:
+                participant._stop_pool()
+        finally:
+            self._running = False
+            for participant in self.participants:
+                participant._running = False
+                participant._stop_pool()
+                self._close(participant)
+            self._readers = {}
+            if self._own_pool:
+                self.pool.close()
+
+    def _poll(self, participants):
+        """
+        Dispatches the next method of each channel and connection, waiting
+        up to POLL_INTERVAL if there are none yet.
+        """
+        # Start with the next participant each time round
+        self._next = (self._next + 1) % len(participants)
+        participants = participants[self._next:] + participants[:self._next]
+        dispatched = False
+        readers = []
+        for participant in participants:
+            reader = self._reader(participant._chan.connection)
+            if reader.dispatch_set_aside(participant._chan):
+                dispatched = True
+            if reader not in readers:
+                readers.append(reader)
+        ready = [reader for reader in readers if reader.buffered()]
+        if not (ready or dispatched):
+            ready = readers[0].wait(readers, self.POLL_INTERVAL)
+        for reader in ready:
+            reader.dispatch()
+
+    def _reader(self, conn):
+        "Returns the reader of a connection, made on first use."
+        reader = self._readers.get(id(conn))
+        if reader is None or reader.conn is not conn:
+            reader = self._readers[id(conn)] = connection_reader(conn)
+        return reader
+
+    def _cancel(self, participant):
+        """Stops a participant's consumer receiving more messages."""
+        participant._running = False
+        chan = participant._chan
+        if participant._consumer_tag is None or chan is None:
+            return
+        if chan.is_open:
+            with participant._chan_lock:
+                chan.basic_cancel(participant._consumer_tag)
+        participant._consumer_tag = None
+
+    def _close(self, participant):
+        """Closes a participant's channel."""
+        chan, participant._chan = participant._chan, None
+        if chan is None or not chan.is_open:
+            return
+        try:
+            with participant._chan_lock:
+                chan.close()
+        except Exception:
+            # The connection was lost already
+            self.log.warning("Failed to close the channel of %s" %
+                             participant._queue)
+
+    def finish(self):
+        """Stops run() once the workitems being consumed are finished."""
+        self._running = False
@@ -13,12 +13,57 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from amqplib import client_0_8 as amqp
+from __future__ import with_statement
+import time
+from threading import RLock
+from RuoteAMQP import codec
+from RuoteAMQP.pool import ConnectionPool
+from RuoteAMQP.metrics import Metrics, LauncherMetrics, clock
+from RuoteAMQP.lazy import LazyModule
+from RuoteAMQP.localbroker import new_message
+from RuoteAMQP.schema import compile_schema
 
-try:
-    import json
-except ImportError:
-    import simplejson as json
+amqp = LazyModule("amqplib.client_0_8")
+
+
+def launch_body(process, fields=None, variables=None):
+    """
+    Returns the json message body which asks the engine to launch a
+    process definition with the given fields and variables.
+    """
+    if fields and not isinstance(fields, dict):
+        raise TypeError("fields should be type dict")
+    if variables and not isinstance(variables, dict):
+        raise TypeError("variables should be type dict")
+    pdef = {
+        "definition": process,
+        "fields" : fields,
+        "variables" : variables
+        }
+    return codec.dumps(pdef)
+
+
+class LaunchReport(object):
+    """
+    The outcome of Launcher.launch_many().
+
+    failed holds an (index, exception) pair for every definition which
+    was not published. unreached is the index of the first definition
+    left unread when a publishing error stopped the run, or None.
+    """
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = []
+        self.unreached = None
+        self.elapsed = 0.0
+
+    @property
+    def rate(self):
+        "Launches published per second"
+        if not self.elapsed:
+            return 0.0
+        return self.sent / self.elapsed
 
 
 class Launcher(object):
@@ -27,15 +72,57 @@ class Launcher(object):
 
     Workitems arrive via AMQP, are processed and returned to the Ruote engine.
 
+    Given a connection_pool the launcher takes its channels from that
+    ConnectionPool; close() gives them back.
+
+    With compression set, launch messages of compress_threshold bytes or
+    more are compressed, as codec.compress() does; the engine must
+    understand their content_encoding.
+
+    Launches are counted and timed in the metrics registry, a new one
+    unless a shared RuoteAMQP.metrics.Metrics is passed in.
+
+    Given an outbox, a RuoteAMQP.outbox.Outbox, launches are stored there
+    for it to publish, and no connection is opened unless conn or
+    connection_pool is passed too.
+
+    Given a fields_schema, a JSON schema or a RuoteAMQP.schema.Schema,
+    the fields of each launch are checked against it before they are
+    encoded, and a launch which doesn't match raises a SchemaError.
+
     Cancel is not yet implemented.
     """
 
     def __init__(self,
                  amqp_host="localhost", amqp_user="boss",
                  amqp_pass="boss", amqp_vhost="boss",
-                 conn=None):
-        if conn is not None:
+                 conn=None, connection_pool=None, metrics=None,
+                 compression=None,
+                 compress_threshold=codec.COMPRESS_THRESHOLD, outbox=None,
+                 fields_schema=None):
+        if compression:
+            # Fail now rather than when launching
+            codec.compressor(compression)
+        self._compression = compression
+        self._compress_threshold = compress_threshold
+        self._fields_schema = compile_schema(fields_schema)
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self._metrics = LauncherMetrics(metrics)
+        self._outbox = outbox
+        self.chan = None
+        self._lock = RLock()
+        # The channel launch_many() commits on, and its lock
+        self._tx_chan = None
+        self._tx_lock = None
+        if connection_pool is not None:
+            self.conn = connection_pool
+        elif conn is not None:
             self.conn = conn
+        elif outbox is not None:
+            self.conn = None
+            return
         else:
             self.host = amqp_host
             self.user = amqp_user
@@ -51,6 +138,9 @@ class Launcher(object):
         self.chan = self.conn.channel()
         if self.chan is None:
             raise Exception("No channel")
+        if connection_pool is not None:
+            # Other channels share the connection, and its lock
+            self._lock = connection_pool.lock(self.chan)
 
 #        # Currently ruote-amqp uses the anonymous direct exchange
 #        self.chan.exchange_declare(exchange="", type="direct", durable=True,
@@ -60,20 +150,161 @@ class Launcher(object):
         """
         Launch a process definition
         """
-        if fields and not isinstance(fields, dict):
-            raise TypeError("fields should be type dict")
-        if variables and not isinstance(variables, dict):
-            raise TypeError("variables should be type dict")
-        pdef = {
-            "definition": process,
-            "fields" : fields,
-            "variables" : variables
-            }
+        msg = self._message(process, fields, variables)
+        # Publish the message.
+        try:
+            if self._outbox is not None:
+                self._store([msg])
+            else:
+                with self._lock:
+                    started = clock()
+                    self.chan.basic_publish(msg, exchange='',
+                                            routing_key='ruote_workitems')
+                    self._metrics.publish.observe(clock() - started)
+        except Exception:
+            self._metrics.failed.inc()
+            raise
+        self._metrics.launched.inc()
+
+    def close(self):
+        """
+        Closes the channel, or returns it to the ConnectionPool it came from.
+        """
+        if self._tx_chan is not None:
+            # A channel in transaction mode can't be handed out again
+            self._tx_chan.close()
+            self._tx_chan = None
+        if self.chan is None:
+            return
+        if isinstance(self.conn, ConnectionPool):
+            self.conn.release(self.chan)
+        else:
+            self.chan.close()
+
+    def launch_many(self, definitions, batch_size=100, confirm=False):
+        """
+        Launch many process definitions.
+
+        definitions is an iterable of (process, fields, variables) tuples.
+        It is consumed a batch at a time, so it may be a generator.
+        Definitions which can't be encoded, or whose fields fail the
+        fields_schema, are recorded in the returned LaunchReport and
+        don't stop the others; a publishing error fails the current batch
+        and stops the run, leaving the rest of definitions unread from
+        report.unreached on.
+
+        With confirm set each batch is published in a transaction on a
+        channel kept for it and committed before the next batch is
+        encoded, so report.sent only counts launches the broker accepted.
+        With an outbox each batch is stored in it in one transaction
+        instead, whether or not confirm is set.
+        """
+        report = LaunchReport()
+        start = time.time()
+        chan, lock = self.chan, self._lock
+        if self._outbox is not None:
+            confirm = False
+        elif confirm:
+            chan, lock = self._transaction_channel()
+        try:
+            batch = []
+            for index, definition in enumerate(definitions):
+                try:
+                    batch.append((index, self._message(*definition)))
+                except (TypeError, ValueError) as exobj:
+                    report.failed.append((index, exobj))
+                    self._metrics.failed.inc()
+                if len(batch) >= batch_size:
+                    if not self._publish_batch(chan, lock, batch, confirm,
+                                               report):
+                        report.unreached = index + 1
+                        break
+                    batch = []
+            else:
+                if batch:
+                    self._publish_batch(chan, lock, batch, confirm, report)
+        finally:
+            report.elapsed = time.time() - start
+        return report
+
+    def _transaction_channel(self):
+        """
+        Returns the channel in transaction mode launch_many() commits on,
+        and the lock of its connection, opening it if need be.
+        """
+        if self._tx_chan is None:
+            chan = self.conn.channel()
+            lock = self._lock
+            if isinstance(self.conn, ConnectionPool):
+                lock = self.conn.lock(chan)
+            with lock:
+                chan.tx_select()
+            self._tx_chan, self._tx_lock = chan, lock
+        return self._tx_chan, self._tx_lock
+
+    def _drop_transaction_channel(self):
+        """Drops the channel in transaction mode after a failure."""
+        chan, self._tx_chan = self._tx_chan, None
+        if isinstance(self.conn, ConnectionPool):
+            # Most likely its connection failed too
+            self.conn.discard(chan)
+        elif chan.is_open:
+            try:
+                chan.close()
+            except Exception:
+                # The connection was lost already
+                pass
+
+    def _message(self, process, fields=None, variables=None):
+        """Returns the amqp message launching a process definition."""
+        if self._fields_schema is not None:
+            self._fields_schema.validate({} if fields is None else fields)
         # Encode the message as json
-        msg = amqp.Message(json.dumps(pdef))
+        started = clock()
+        body, encoding = codec.compress(
+                launch_body(process, fields, variables),
+                self._compression, self._compress_threshold)
+        self._metrics.encode.observe(clock() - started)
+        self._metrics.launch_bytes.observe(len(body))
+        msg = new_message(body)
+        if encoding:
+            msg.properties["content_encoding"] = encoding
         # delivery_mode=2 is persistent
         msg.properties["delivery_mode"] = 2
+        return msg
 
-        # Publish the message.
-        self.chan.basic_publish(msg, exchange='',
-                                routing_key='ruote_workitems')
+    def _publish_batch(self, chan, lock, batch, confirm, report):
+        """
+        Publishes a batch of (index, message) pairs on chan while holding
+        lock, recording the outcome in report. Returns False if the batch
+        failed.
+        """
+        try:
+            if self._outbox is not None:
+                self._store([msg for _, msg in batch])
+            else:
+                with lock:
+                    started = clock()
+                    for _, msg in batch:
+                        chan.basic_publish(msg, exchange='',
+                                           routing_key='ruote_workitems')
+                    if confirm:
+                        chan.tx_commit()
+                    self._metrics.publish.observe(clock() - started)
+        except Exception as exobj:
+            report.failed.extend((index, exobj) for index, _ in batch)
+            self._metrics.failed.inc(len(batch))
+            if confirm:
+                self._drop_transaction_channel()
+            return False
+        report.sent += len(batch)
+        self._metrics.launched.inc(len(batch))
+        return True
+
+    def _store(self, msgs):
+        """Stores launch messages in the outbox in one transaction."""
+        started = clock()
+        self._outbox.put_many([
+                (msg.body, msg.properties.get("content_encoding"))
+                for msg in msgs])
+        self._metrics.publish.observe(clock() - started)
@@ -0,0 +1,43 @@
+# Copyright (C) 2010 Nokia Corporation and/or its subsidiary(-ies).
+# Contact: David Greaves <ext-david.greaves@nokia.com>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Deferred imports of heavy dependencies.
+
+    amqp = LazyModule("amqplib.client_0_8")
+
+binds amqp as the module would be, but amqplib is only imported once an
+attribute such as amqp.Connection is first used, so a script which
+never talks to a broker doesn't pay for importing it.
+"""
+
+
+class LazyModule(object):
+    """Stands in for the module name until one of its attributes is used."""
+
+    def __init__(self, name):
+        self.__name = name
+
+    def __repr__(self):
+        return "<LazyModule %s>" % self.__name
+
+    def __getattr__(self, attr):
+        if attr.startswith("_LazyModule__"):
+            raise AttributeError(attr)
+        module = __import__(self.__name, None, None, ["__name__"])
+        value = getattr(module, attr)
+        # Later lookups don't come here
+        setattr(self, attr, value)
+        return value
@@ -0,0 +1,435 @@
+# Copyright (C) 2010 Nokia Corporation and/or its subsidiary(-ies).
+# Contact: David Greaves <ext-david.greaves@nokia.com>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+An in-process stand-in for the AMQP broker.
+
+LocalBroker offers the part of the amqplib connection and channel API
+which Participant, Launcher and ReplyPipeline use, so they can be run,
+tested and benchmarked without RabbitMQ, or amqplib:
+
+    broker = LocalBroker()
+    participant = MyParticipant("builder", connect=broker.connect)
+    launcher = Launcher(conn=broker.connect())
+
+Only the anonymous exchange is routed, to the queue named by the
+routing key; a message for a queue nobody declared is dropped, as the
+broker would. Deliveries respect the prefetch count set by basic_qos(),
+and unacknowledged messages are requeued as redelivered when their
+channel is closed. A ConnectionPool, and so a ParticipantHost, can use
+it given connect:
+
+    pool = ConnectionPool(connect=broker.connect)
+    host = ParticipantHost(connection_pool=pool)
+"""
+
+from __future__ import with_statement
+import itertools
+from collections import deque
+from threading import Condition, Lock
+
+# amqplib's Message class once new_message() has looked for it, None if
+# amqplib isn't installed
+_message_class = False
+
+
+class LocalMessage(object):
+    """A message as amqplib delivers it."""
+
+    def __init__(self, body, properties=None, delivery_info=None):
+        self.body = body
+        self.properties = properties or {}
+        self.delivery_info = delivery_info or {}
+
+
+def new_message(body):
+    """
+    Returns an amqplib Message with body, or a LocalMessage if amqplib
+    isn't installed, which a LocalBroker carries as well.
+    """
+    global _message_class
+    if _message_class is False:
+        try:
+            from amqplib.client_0_8 import Message
+        except ImportError:
+            Message = None
+        _message_class = Message
+    if _message_class is None:
+        return LocalMessage(body)
+    return _message_class(body)
+
+
+class _Queue(object):
+    """A queue's ready messages and its consumers."""
+
+    def __init__(self, name):
+        self.name = name
+        # (body, properties, redelivered)
+        self.messages = deque()
+        # [channel, consumer_tag, callback, no_ack]
+        self.consumers = []
+
+
+class LocalBroker(object):
+    """
+    An in-memory broker holding named queues. connect() opens a
+    LocalConnection to it.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        # Notified of every delivery, on any channel
+        self._delivered = Condition(self._lock)
+        self._queues = {}
+        self._tags = itertools.count(1)
+
+    def connect(self, *args, **kwargs):
+        """
+        Returns a new connection; the arguments amqplib's Connection
+        takes are ignored.
+        """
+        return LocalConnection(self)
+
+    def queue_size(self, name):
+        """The number of ready messages in a queue."""
+        with self._lock:
+            queue = self._queues.get(name)
+            return len(queue.messages) if queue else 0
+
+    def _route(self, routing_key, body, properties):
+        """Queues a published message. Call with the lock held."""
+        queue = self._queues.get(routing_key)
+        if queue is None:
+            return
+        queue.messages.append((body, dict(properties), False))
+        self._dispatch(queue)
+
+    def _dispatch(self, queue):
+        """
+        Hands a queue's ready messages to its consumers, in turn, while
+        they have prefetch to spare. Call with the lock held.
+        """
+        consumers = queue.consumers
+        while queue.messages and consumers:
+            for _ in range(len(consumers)):
+                consumer = consumers.pop(0)
+                consumers.append(consumer)
+                if consumer[0]._ready():
+                    break
+            else:
+                return
+            channel, consumer_tag, callback, no_ack = consumer
+            body, properties, redelivered = queue.messages.popleft()
+            channel._deliver(queue, consumer_tag, callback, no_ack, body,
+                             properties, redelivered)
+
+
+class LocalConnection(object):
+    """A connection to a LocalBroker."""
+
+    def __init__(self, broker):
+        self.broker = broker
+        # As with amqplib, channel 0 is the connection itself and the
+        # transport is None once it is closed
+        self.channels = {0: self}
+        self.transport = broker
+        self._ids = itertools.count(1)
+
+    def channel(self):
+        """Opens a channel."""
+        if self.transport is None:
+            raise IOError("Connection is closed")
+        chan = LocalChannel(self, next(self._ids))
+        self.channels[chan.channel_id] = chan
+        return chan
+
+    def reader(self):
+        """Returns a reader for ParticipantHost; see connection_reader()."""
+        return _LocalReader(self)
+
+    def close(self):
+        """Closes the connection and its channels."""
+        for channel_id, chan in list(self.channels.items()):
+            if channel_id:
+                chan.close()
+        self.transport = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _LocalReader(object):
+    """
+    Runs the consumer callbacks of a LocalConnection's deliveries for
+    ParticipantHost, one delivery at a time and its channels in turn.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._last = 0
+
+    def dispatch_set_aside(self, chan):
+        # Nothing is set aside: deliveries wait in their channel
+        return False
+
+    def _channels(self):
+        """The open channels with deliveries. Call with the lock held."""
+        return [chan for channel_id, chan in self.conn.channels.items()
+                if channel_id and chan.is_open and chan._deliveries]
+
+    def buffered(self):
+        with self.conn.broker._lock:
+            return bool(self._channels())
+
+    def dispatch(self):
+        with self.conn.broker._lock:
+            chans = sorted(self._channels(), key=lambda chan: (
+                    chan.channel_id <= self._last, chan.channel_id))
+            if not chans:
+                return None
+            chan = chans[0]
+            self._last = chan.channel_id
+            callback, msg = chan._deliveries.popleft()
+        return callback(msg)
+
+    @staticmethod
+    def wait(readers, timeout):
+        broker = readers[0].conn.broker
+        with broker._lock:
+            ready = [reader for reader in readers if reader._channels()]
+            if not ready:
+                broker._delivered.wait(timeout)
+                ready = [reader for reader in readers if reader._channels()]
+        return ready
+
+
+class LocalChannel(object):
+    """
+    A channel to a LocalBroker, with the amqplib channel methods used by
+    RuoteAMQP. wait() runs the consumer callbacks of the next delivery
+    in the calling thread, like amqplib's.
+    """
+
+    def __init__(self, connection, channel_id):
+        self.connection = connection
+        self.channel_id = channel_id
+        self.is_open = True
+        self._broker = connection.broker
+        self._ready_cond = Condition(self._broker._lock)
+        self._prefetch = 0
+        self._next_tag = itertools.count(1)
+        # delivery_tag: (queue, body, properties), in delivery order
+        self._unacked = {}
+        # (callback, message) delivered but not yet passed to wait()
+        self._deliveries = deque()
+        self._consumers = {}
+        # Cancelled consumers not yet noticed by wait(), like amqplib's
+        # cancel-ok methods
+        self._cancels = 0
+        self._tx = None
+
+    def _ready(self):
+        """Can the channel take another message?"""
+        return (self.is_open and
+                not (self._prefetch and len(self._unacked) >= self._prefetch))
+
+    def _deliver(self, queue, consumer_tag, callback, no_ack, body,
+                 properties, redelivered):
+        """Delivers a message to a consumer. Call with the lock held."""
+        tag = next(self._next_tag)
+        if not no_ack:
+            self._unacked[tag] = (queue, body, properties)
+        msg = LocalMessage(body, dict(properties), {
+                "consumer_tag": consumer_tag, "delivery_tag": tag,
+                "redelivered": redelivered, "exchange": "",
+                "routing_key": queue.name})
+        self._deliveries.append((callback, msg))
+        self._ready_cond.notify()
+        self._broker._delivered.notify_all()
+
+    def _check(self):
+        "Raises as amqplib would if the channel was closed."
+        if not self.is_open:
+            raise IOError("Channel %d is closed" % self.channel_id)
+
+    def basic_qos(self, prefetch_size, prefetch_count, a_global):
+        """Limits the unacknowledged messages delivered on the channel."""
+        with self._broker._lock:
+            self._check()
+            self._prefetch = prefetch_count
+
+    def queue_declare(self, queue="", passive=False, durable=False,
+                      exclusive=False, auto_delete=True, nowait=False,
+                      arguments=None, ticket=None):
+        """
+        Declares a queue and returns its name, message count and
+        consumer count.
+        """
+        broker = self._broker
+        with broker._lock:
+            self._check()
+            if not queue:
+                queue = "amq.gen-%d" % next(broker._tags)
+            declared = broker._queues.get(queue)
+            if declared is None:
+                if passive:
+                    raise IOError("No queue %s" % queue)
+                declared = broker._queues[queue] = _Queue(queue)
+            return (queue, len(declared.messages), len(declared.consumers))
+
+    def basic_consume(self, queue="", consumer_tag="", no_local=False,
+                      no_ack=False, exclusive=False, nowait=False,
+                      callback=None, ticket=None):
+        """Starts delivering messages from a queue to callback."""
+        broker = self._broker
+        with broker._lock:
+            self._check()
+            if queue not in broker._queues:
+                raise IOError("No queue %s" % queue)
+            if not consumer_tag:
+                consumer_tag = "amq.ctag-%d" % next(broker._tags)
+            declared = broker._queues[queue]
+            declared.consumers.append([self, consumer_tag, callback, no_ack])
+            self._consumers[consumer_tag] = declared
+            broker._dispatch(declared)
+        return consumer_tag
+
+    def basic_cancel(self, consumer_tag, nowait=False):
+        """
+        Stops a consumer. Messages already delivered to it stay with the
+        channel, and a wait() in progress returns.
+        """
+        with self._broker._lock:
+            queue = self._consumers.pop(consumer_tag, None)
+            if queue is not None:
+                queue.consumers = [consumer for consumer in queue.consumers
+                                   if consumer[1] != consumer_tag]
+            self._cancels += 1
+            self._ready_cond.notify_all()
+
+    def basic_publish(self, msg, exchange="", routing_key="",
+                      mandatory=False, immediate=False, ticket=None):
+        """Publishes msg, or keeps it for tx_commit() in a transaction."""
+        with self._broker._lock:
+            self._check()
+            if self._tx is not None:
+                self._tx.append((routing_key, msg.body,
+                                 dict(msg.properties)))
+            else:
+                self._broker._route(routing_key, msg.body, msg.properties)
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        """Acknowledges a message, or with multiple all up to it."""
+        self._settle(delivery_tag, multiple, None)
+
+    def basic_reject(self, delivery_tag, requeue):
+        """Rejects a message, dropping it unless requeue is set."""
+        self._settle(delivery_tag, False, requeue)
+
+    def _settle(self, delivery_tag, multiple, requeue):
+        """Acknowledges, requeues or drops delivered messages."""
+        broker = self._broker
+        with broker._lock:
+            self._check()
+            if multiple:
+                tags = [tag for tag in self._unacked if tag <= delivery_tag]
+            elif delivery_tag in self._unacked:
+                tags = [delivery_tag]
+            else:
+                raise IOError("Unknown delivery tag %d" % delivery_tag)
+            queues = set()
+            for tag in sorted(tags):
+                queue, body, properties = self._unacked.pop(tag)
+                if requeue:
+                    queue.messages.appendleft((body, properties, True))
+                queues.add(queue)
+            # Prefetch was freed, here and maybe in the queue too
+            for queue in queues:
+                broker._dispatch(queue)
+            for queue in self._consumers.values():
+                broker._dispatch(queue)
+
+    def tx_select(self):
+        """Holds back publishes until tx_commit()."""
+        with self._broker._lock:
+            self._check()
+            self._tx = []
+
+    def tx_commit(self):
+        """Publishes the messages held back since the last commit."""
+        with self._broker._lock:
+            self._check()
+            published, self._tx = self._tx or [], []
+            for routing_key, body, properties in published:
+                self._broker._route(routing_key, body, properties)
+
+    def tx_rollback(self):
+        """Drops the messages held back since the last commit."""
+        with self._broker._lock:
+            self._check()
+            self._tx = []
+
+    def wait(self, allowed_methods=None):
+        """
+        Waits for the next delivery and runs its consumer's callback.
+        Returns instead once for each consumer cancelled, and raises
+        IOError once the channel is closed.
+        """
+        with self._broker._lock:
+            while (self.is_open and not self._deliveries and
+                   not self._cancels):
+                self._ready_cond.wait()
+            self._check()
+            if not self._deliveries:
+                self._cancels = max(0, self._cancels - 1)
+                return None
+            callback, msg = self._deliveries.popleft()
+        return callback(msg)
+
+    def close(self):
+        """
+        Closes the channel, requeueing the messages it didn't
+        acknowledge.
+        """
+        broker = self._broker
+        with broker._lock:
+            if not self.is_open:
+                return
+            self.is_open = False
+            for queue in self._consumers.values():
+                queue.consumers = [consumer for consumer in queue.consumers
+                                   if consumer[0] is not self]
+            queues = set()
+            for tag in sorted(self._unacked, reverse=True):
+                queue, body, properties = self._unacked[tag]
+                queue.messages.appendleft((body, properties, True))
+                queues.add(queue)
+            self._unacked = {}
+            self._deliveries.clear()
+            self._consumers = {}
+            self._tx = None
+            self._ready_cond.notify_all()
+            for queue in queues:
+                broker._dispatch(queue)
+        self.connection.channels.pop(self.channel_id, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
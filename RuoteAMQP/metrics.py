@@ -0,0 +1,463 @@
+# Copyright (C) 2010 Nokia Corporation and/or its subsidiary(-ies).
+# Contact: David Greaves <ext-david.greaves@nokia.com>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Counters, gauges and histograms for participants and launchers.
+
+Instruments are looked up once and then updated with a lock held for a
+couple of additions, so they can stay on in production. Exporters read
+a Metrics registry: PrometheusExporter renders the Prometheus text
+format, optionally over HTTP, StatsdExporter sends what changed to a
+statsd daemon over UDP every few seconds and MemoryExporter reads values
+back for tests.
+"""
+
+from __future__ import with_statement
+import socket
+import time
+from bisect import bisect_left
+from threading import Lock, Thread, Event
+
+# The most precise clock for measuring durations
+clock = getattr(time, "perf_counter", time.time)
+
+# Upper bounds of histogram buckets
+SECONDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1, 2.5, 5, 10, 30, 60, 300)
+BYTES = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304,
+         16777216)
+
+
+class Counter(object):
+    """A value which only goes up."""
+    kind = "counter"
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = Lock()
+
+    def inc(self, amount=1):
+        "Adds amount to the counter."
+        with self._lock:
+            self.value += amount
+
+
+class Gauge(object):
+    """A value which goes up and down."""
+    kind = "gauge"
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = Lock()
+
+    def inc(self, amount=1):
+        "Adds amount to the gauge."
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        "Subtracts amount from the gauge."
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        "Sets the gauge."
+        self.value = value
+
+
+class Histogram(object):
+    """
+    Counts observations in buckets by upper bound, along with their
+    number and sum.
+    """
+    kind = "histogram"
+    __slots__ = ("buckets", "counts", "count", "sum", "_lock")
+
+    def __init__(self, buckets=SECONDS):
+        self.buckets = tuple(buckets)
+        # The last count is for observations above every bound
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self._lock = Lock()
+
+    def observe(self, value):
+        "Records an observation."
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def cumulative(self):
+        """
+        Returns (upper bound, count of observations up to it) pairs,
+        ending with infinity and the total count.
+        """
+        with self._lock:
+            counts = list(self.counts)
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Metrics(object):
+    """
+    A registry of instruments, each named and labelled.
+
+    Asking for the same name and labels again returns the same
+    instrument, so participants and launchers may share a registry.
+    """
+
+    def __init__(self, prefix="ruote_amqp"):
+        self.prefix = prefix
+        self._lock = Lock()
+        # name -> (kind, help, {labels: instrument})
+        self._families = {}
+
+    def _get(self, cls, name, help, labels, *args):
+        """Returns the instrument of a name and labels, creating it."""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            family = self._families.setdefault(name, (cls.kind, help, {}))
+            if family[0] != cls.kind:
+                raise ValueError("%s is a %s" % (name, family[0]))
+            instruments = family[2]
+            if key not in instruments:
+                instruments[key] = cls(*args)
+            return instruments[key]
+
+    def counter(self, name, help="", **labels):
+        "Returns a Counter."
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help="", **labels):
+        "Returns a Gauge."
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help="", buckets=SECONDS, **labels):
+        "Returns a Histogram with the given bucket upper bounds."
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def collect(self):
+        """
+        Returns (name, kind, help, [(labels, instrument)]) for every
+        family of instruments, sorted by name. Names are prefixed and
+        labels are sorted (name, value) tuples.
+        """
+        with self._lock:
+            families = sorted((name, kind, help, sorted(instruments.items()))
+                              for name, (kind, help, instruments)
+                              in self._families.items())
+        return [("%s_%s" % (self.prefix, name) if self.prefix else name,
+                 kind, help, instruments)
+                for name, kind, help, instruments in families]
+
+
+class ParticipantMetrics(object):
+    """The instruments a Participant updates, labelled with its queue."""
+
+    def __init__(self, metrics, queue):
+        labels = {"queue": queue}
+        self._metrics = metrics
+        self._labels = labels
+        self.received = metrics.counter(
+                "workitems_received_total", "Workitems received", **labels)
+        self.acked = metrics.counter(
+                "workitems_acked_total", "Workitems acknowledged", **labels)
+        self.rejected = metrics.counter(
+                "workitems_rejected_total",
+                "Messages rejected as undecodable", **labels)
+        self.errored = metrics.counter(
+                "workitems_errored_total",
+                "Workitems whose consume() raised", **labels)
+        self.cancelled = metrics.counter(
+                "workitems_cancelled_total",
+                "Workitems cancelled by the engine", **labels)
+        self.replayed = metrics.counter(
+                "workitems_replayed_total",
+                "Duplicate workitems answered with a cached reply",
+                **labels)
+        self.expired = metrics.counter(
+                "workitems_expired_total",
+                "Workitems past their deadline before consume()", **labels)
+        self.invalid = metrics.counter(
+                "workitems_invalid_total",
+                "Workitems whose fields or params failed their schema",
+                **labels)
+        self.redelivered = metrics.counter(
+                "workitems_redelivered_total",
+                "Workitems delivered more than once", **labels)
+        self.reconnects = metrics.counter(
+                "reconnects_total", "Reconnections to the broker", **labels)
+        self.downtime = metrics.counter(
+                "disconnected_seconds_total",
+                "Seconds spent reconnecting to the broker", **labels)
+        self.in_flight = metrics.gauge(
+                "workitems_in_flight",
+                "Workitems received and not yet acknowledged", **labels)
+        self.wait = metrics.histogram(
+                "consume_wait_seconds",
+                "Time from delivery to the start of consume()", **labels)
+        self.consume = metrics.histogram(
+                "consume_seconds", "Duration of consume()", **labels)
+        self.publish = metrics.histogram(
+                "reply_publish_seconds", "Time to publish a reply", **labels)
+        self.decode = metrics.histogram(
+                "decode_seconds", "Time to decode a workitem", **labels)
+        self.encode = metrics.histogram(
+                "encode_seconds", "Time to encode a workitem", **labels)
+        self.received_bytes = metrics.histogram(
+                "received_bytes", "Size of workitems received", BYTES,
+                **labels)
+        self.reply_bytes = metrics.histogram(
+                "reply_bytes", "Size of replies", BYTES, **labels)
+
+    def priority_wait(self, priority):
+        """The wait before consume() of workitems of a priority."""
+        return self._metrics.histogram(
+                "consume_wait_by_priority_seconds",
+                "Time from delivery to the start of consume(), by priority",
+                priority=priority, **self._labels)
+
+
+class LauncherMetrics(object):
+    """The instruments a Launcher updates."""
+
+    def __init__(self, metrics, queue="ruote_workitems"):
+        labels = {"queue": queue}
+        self.launched = metrics.counter(
+                "launches_total", "Process launches published", **labels)
+        self.failed = metrics.counter(
+                "launch_failures_total", "Process launches not published",
+                **labels)
+        self.encode = metrics.histogram(
+                "launch_encode_seconds", "Time to encode a launch", **labels)
+        self.publish = metrics.histogram(
+                "launch_publish_seconds",
+                "Time to publish a launch or a launch_many() batch",
+                **labels)
+        self.launch_bytes = metrics.histogram(
+                "launch_bytes", "Size of launch messages", BYTES, **labels)
+
+
+def _format_labels(labels, extra=()):
+    """Formats labels as in the Prometheus text format."""
+    labels = list(extra) + list(labels)
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+            '%s="%s"' % (name, str(value).replace("\\", "\\\\")
+                         .replace('"', '\\"').replace("\n", "\\n"))
+            for name, value in labels)
+
+
+def _format_value(value):
+    """Formats a number as in the Prometheus text format."""
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class PrometheusExporter(object):
+    """Exposes a Metrics registry in the Prometheus text format."""
+
+    content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self._server = None
+
+    def render(self):
+        """Returns the current values in the Prometheus text format."""
+        lines = []
+        for name, kind, help, instruments in self.metrics.collect():
+            if help:
+                lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, instrument in instruments:
+                if kind != "histogram":
+                    lines.append("%s%s %s" % (name, _format_labels(labels),
+                                              _format_value(instrument.value)))
+                    continue
+                for bound, count in instrument.cumulative():
+                    lines.append("%s_bucket%s %d" % (
+                            name, _format_labels(
+                                labels, [("le", _format_value(bound))]),
+                            count))
+                lines.append("%s_sum%s %s" % (name, _format_labels(labels),
+                                              _format_value(instrument.sum)))
+                lines.append("%s_count%s %d" % (name, _format_labels(labels),
+                                                instrument.count))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, address=""):
+        """
+        Serves the metrics over HTTP from a daemon thread and returns the
+        server.
+        """
+        try:
+            from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        except ImportError:
+            from http.server import HTTPServer, BaseHTTPRequestHandler
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            "Answers every GET with the metrics."
+
+            def do_GET(self):
+                body = exporter.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", exporter.content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                # Scrapes are too frequent to log
+                pass
+
+        self._server = HTTPServer((address, port), Handler)
+        thread = Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self._server
+
+    def close(self):
+        """Stops serving."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+class StatsdExporter(object):
+    """
+    Sends a Metrics registry to a statsd daemon over UDP.
+
+    Every interval seconds counters are sent as the increase since the
+    last flush, gauges as their value and histograms as the increase of
+    their count and sum. Labels are appended to the name, dot separated.
+    """
+
+    # Keep datagrams below a typical MTU
+    MAX_DATAGRAM = 1400
+
+    def __init__(self, metrics, host="localhost", port=8125, interval=10):
+        self.metrics = metrics
+        self.address = (host, port)
+        self.interval = interval
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._last = {}
+        self._stop = Event()
+        self._thread = None
+
+    def lines(self):
+        """Returns the statsd lines describing what changed."""
+        lines = []
+        for name, kind, _, instruments in self.metrics.collect():
+            for labels, instrument in instruments:
+                stat = ".".join([name] + [str(value).replace(".", "_")
+                                          for _, value in labels])
+                if kind == "gauge":
+                    lines.append("%s:%s|g" % (stat, instrument.value))
+                elif kind == "counter":
+                    lines.extend(self._delta(stat, instrument.value))
+                else:
+                    lines.extend(self._delta(stat + ".count",
+                                             instrument.count))
+                    lines.extend(self._delta(stat + ".sum", instrument.sum))
+        return lines
+
+    def _delta(self, stat, value):
+        """Returns a counter line for the increase of value, if any."""
+        delta = value - self._last.get(stat, 0)
+        self._last[stat] = value
+        if not delta:
+            return []
+        return ["%s:%s|c" % (stat, delta)]
+
+    def flush(self):
+        """Sends what changed since the last flush."""
+        packet = []
+        size = 0
+        for line in self.lines():
+            if packet and size + len(line) + 1 > self.MAX_DATAGRAM:
+                self._send(packet)
+                packet, size = [], 0
+            packet.append(line)
+            size += len(line) + 1
+        if packet:
+            self._send(packet)
+
+    def _send(self, lines):
+        """Sends one datagram, ignoring errors as statsd does."""
+        try:
+            self._sock.sendto("\n".join(lines).encode("utf-8"), self.address)
+        except socket.error:
+            pass
+
+    def start(self):
+        """Flushes every interval seconds from a daemon thread."""
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._stop.wait(self.interval)
+            if not self._stop.is_set():
+                self.flush()
+
+    def stop(self):
+        """Stops the flushing thread after a last flush."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+
+class MemoryExporter(object):
+    """Reads values back from a Metrics registry, for tests."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def samples(self):
+        """
+        Returns {(name, labels): value} with labels as sorted (name, value)
+        tuples. A histogram's value is its (count, sum).
+        """
+        samples = {}
+        for name, kind, _, instruments in self.metrics.collect():
+            for labels, instrument in instruments:
+                if kind == "histogram":
+                    value = (instrument.count, instrument.sum)
+                else:
+                    value = instrument.value
+                samples[(name, labels)] = value
+        return samples
+
+    def value(self, name, **labels):
+        """Returns the value of the named instrument, or None."""
+        if self.metrics.prefix:
+            name = "%s_%s" % (self.metrics.prefix, name)
+        return self.samples().get((name, tuple(sorted(labels.items()))))
@@ -0,0 +1,247 @@
+# Copyright (C) 2010 Nokia Corporation and/or its subsidiary(-ies).
+# Contact: David Greaves <ext-david.greaves@nokia.com>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A local outbox for messages to the engine while the broker is away.
+
+Participants and Launchers given an Outbox write their replies and
+launches to an SQLite database instead of publishing them. A thread of
+the outbox's own publishes them, oldest first and in transactions of up
+to batch_size, whenever the broker can be reached, and deletes them once
+committed. A participant acknowledges a workitem only once its reply is
+in the outbox, so a reply survives the broker, the connection and the
+participant going away, and consume() need never be run again for it.
+
+Messages are delivered at least once: one published just before the
+participant dies is published again when it restarts. The engine
+ignores a second reply to the same workitem.
+
+    outbox = Outbox("/var/lib/builder/outbox", connect)
+    participant = Builder("builder", outbox=outbox)
+    participant.run()
+    outbox.close(timeout=10)
+"""
+
+from __future__ import with_statement
+import logging
+import traceback
+from threading import Condition, Lock, Thread
+from RuoteAMQP.localbroker import new_message
+from RuoteAMQP.metrics import Metrics, clock
+from RuoteAMQP.pool import reconnect_delay
+
+
+class Outbox(object):
+    """
+    Messages to the engine kept in an SQLite database at path until they
+    have been published.
+
+    connect is called from the outbox's thread whenever it needs a
+    connection to the broker, such as a ConnectionPool's or LocalBroker's
+    connect. The messages waiting and published are counted in metrics.
+    """
+
+    # Bounds in seconds of the delay before reconnecting
+    RETRY_MIN_DELAY = 1
+    RETRY_MAX_DELAY = 60
+
+    def __init__(self, path, connect, batch_size=100, metrics=None):
+        try:
+            import sqlite3
+        except ImportError:
+            raise ValueError("Outbox needs the sqlite3 module")
+        self._sqlite3 = sqlite3
+        self.path = path
+        self.batch_size = batch_size
+        self._connect = connect
+        self._conn = None
+        self._chan = None
+        self.log = logging.getLogger(__name__)
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self._pending = metrics.gauge(
+                "outbox_pending", "Messages waiting in the outbox", path=path)
+        self._published = metrics.counter(
+                "outbox_published_total",
+                "Messages published from the outbox", path=path)
+        self._publish_time = metrics.histogram(
+                "outbox_publish_seconds",
+                "Time to publish and commit a batch from the outbox",
+                path=path)
+        # Guards the database, and is waited on by the thread
+        self._lock = Lock()
+        self._cond = Condition(self._lock)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            # A message must survive a power cut once its workitem is
+            # acknowledged
+            self._db.execute("PRAGMA synchronous=FULL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS outbox ("
+                             "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                             "routing_key TEXT, body BLOB, "
+                             "content_encoding TEXT)")
+            self._db.commit()
+            self._count = self._db.execute(
+                    "SELECT COUNT(*) FROM outbox").fetchone()[0]
+            self._pending.set(self._count)
+        self._running = True
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __len__(self):
+        with self._lock:
+            return self._count
+
+    def put(self, body, content_encoding=None,
+            routing_key="ruote_workitems"):
+        """
+        Stores a message for publishing, and returns once it is
+        committed to disk.
+        """
+        self.put_many([(body, content_encoding)], routing_key)
+
+    def put_many(self, messages, routing_key="ruote_workitems"):
+        """
+        Stores (body, content_encoding) messages in one transaction, and
+        returns once it is committed to disk.
+        """
+        rows = []
+        for body, content_encoding in messages:
+            if not isinstance(body, bytes):
+                body = body.encode("utf-8")
+            rows.append((routing_key, self._sqlite3.Binary(body),
+                         content_encoding))
+        with self._lock:
+            if not self._running:
+                raise RuntimeError("Outbox closed")
+            self._db.executemany(
+                    "INSERT INTO outbox (routing_key, body, content_encoding) "
+                    "VALUES (?, ?, ?)", rows)
+            self._db.commit()
+            self._count += len(rows)
+            self._pending.set(self._count)
+            self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Waits up to timeout seconds, or for ever if it is None, for the
+        messages stored so far to be published. Returns whether they were.
+        """
+        with self._lock:
+            waited = 0.0
+            while self._count and self._running:
+                if timeout is not None and waited >= timeout:
+                    break
+                started = clock()
+                self._cond.wait(None if timeout is None
+                                else timeout - waited)
+                waited += clock() - started
+            return not self._count
+
+    def close(self, timeout=0):
+        """
+        Waits up to timeout seconds for the messages to be published,
+        then stops the thread. Those left are published once an Outbox is
+        opened on path again.
+        """
+        if timeout:
+            self.flush(timeout)
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join()
+        self._disconnect()
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _run(self):
+        """Publishes the stored messages until close()."""
+        attempt = 0
+        while True:
+            with self._lock:
+                while self._running and not self._count:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                rows = self._db.execute(
+                        "SELECT id, routing_key, body, content_encoding "
+                        "FROM outbox ORDER BY id LIMIT ?",
+                        (self.batch_size,)).fetchall()
+            try:
+                self._publish(rows)
+            except Exception:
+                self._disconnect()
+                delay = reconnect_delay(attempt, self.RETRY_MIN_DELAY,
+                                        self.RETRY_MAX_DELAY)
+                attempt += 1
+                self.log.warning("Failed to publish from outbox %s, "
+                                 "retrying in %.1fs\n%s" % (
+                                     self.path, delay,
+                                     traceback.format_exc()))
+                with self._lock:
+                    if self._running:
+                        self._cond.wait(delay)
+                continue
+            attempt = 0
+            with self._lock:
+                self._db.execute("DELETE FROM outbox WHERE id <= ?",
+                                 (rows[-1][0],))
+                self._db.commit()
+                self._count -= len(rows)
+                self._pending.set(self._count)
+                self._cond.notify_all()
+            self._published.inc(len(rows))
+
+    def _publish(self, rows):
+        """Publishes a batch of rows in a transaction."""
+        if self._chan is None or not self._chan.is_open:
+            self._disconnect()
+            self._conn = self._connect()
+            self._chan = self._conn.channel()
+            self._chan.tx_select()
+        started = clock()
+        for _, routing_key, body, content_encoding in rows:
+            msg = new_message(bytes(body))
+            if content_encoding:
+                msg.properties["content_encoding"] = content_encoding
+            # delivery_mode=2 is persistent
+            msg.properties["delivery_mode"] = 2
+            self._chan.basic_publish(msg, exchange="",
+                                     routing_key=routing_key)
+        self._chan.tx_commit()
+        self._publish_time.observe(clock() - started)
+
+    def _disconnect(self):
+        """Closes the outbox's connection, ignoring errors."""
+        chan, conn = self._chan, self._conn
+        self._chan = self._conn = None
+        for closable in (chan, conn):
+            if closable is None:
+                continue
+            try:
+                closable.close()
+            except Exception:
+                pass
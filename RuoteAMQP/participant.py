@@ -17,21 +17,32 @@
 """ Abstract participant class """
 
 from __future__ import with_statement
+import os
+import select
+import signal
 import sys
+import time
 import traceback
-from threading import Thread
-from urllib2 import HTTPError
-from amqplib import client_0_8 as amqp
+from threading import Event, Lock, Thread, RLock, local
+from RuoteAMQP import codec
 from RuoteAMQP.workitem import Workitem
+from RuoteAMQP.pool import ConnectionPool, reconnect_delay
+from RuoteAMQP.metrics import Metrics, ParticipantMetrics, clock
+from RuoteAMQP.pipeline import ReplyPipeline
+from RuoteAMQP.dedup import reply_key
+from RuoteAMQP.scheduler import Expired, JobQueue, Scheduling, deadline_of, \
+        priority_of
+from RuoteAMQP.schema import SchemaError
+from RuoteAMQP.lazy import LazyModule
+from RuoteAMQP.localbroker import new_message
 import logging
 
-logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s: %(message)s',
-                    level=logging.INFO)
+amqp = LazyModule("amqplib.client_0_8")
 
 try:
-    import json
+    from Queue import Queue
 except ImportError:
-    import simplejson as json
+    from queue import Queue
 
 
 def format_ruby_backtrace(trace):
@@ -41,9 +52,30 @@ def format_ruby_backtrace(trace):
             for item in trace]
 
 
+def configure_logging():
+    """
+    Logs INFO messages and above to stderr, as participant scripts have
+    always done, unless the application has configured logging already.
+    Called by run() rather than on import.
+    """
+    logging.basicConfig(
+            format='%(asctime)s %(name)s %(levelname)s: %(message)s',
+            level=logging.INFO)
+
+
+def _http_error():
+    """
+    Returns urllib's HTTPError class, or None if urllib isn't imported and
+    nothing can have raised one.
+    """
+    module = sys.modules.get("urllib2") or sys.modules.get("urllib.error")
+    return getattr(module, "HTTPError", None)
+
+
 def format_exception(exc):
     """Formats exception to more informative string based on exception type."""
-    if isinstance(exc, HTTPError):
+    http_error = _http_error()
+    if http_error is not None and isinstance(exc, http_error):
         # Python bug, HTTPError does not always have url attribute and geturl()
         # fails
         exc_str = "HTTPError: %d %s" % (exc.getcode(), exc.filename)
@@ -74,32 +106,555 @@ def format_block(msg):
     return "\n%s\n%s\n%s\n" % ("-" * 78,  msg, "-" * 78)
 
 
+def log_consume_exception(log, workitem):
+    """Logs the exception being handled for a failed consume()."""
+    # This should be configureable:
+    log.error("Exception in participant %s\n"
+              "while handling instance %s of process %s\n"
+              "Note: for information only. Participant remains"
+              " functional.\n"
+              "Error is being signalled to the workflow (unless"
+              " this workitem is 'forgotten').\n" %
+              (workitem.participant_name, workitem.wfid, workitem.wf_name))
+    log.error(format_block(traceback.format_exc()))
+
+
+def error_reply(workitem, exception):
+    """
+    Returns the json of a reply reporting that the reply to workitem
+    couldn't be encoded, with exception, keeping the fields which can be.
+    """
+    h = workitem.to_h()
+    reply = dict((key, value) for key, value in h.items()
+                 if key != "fields")
+    fields = {}
+    dropped = []
+    for name, value in (h.get("fields") or {}).items():
+        try:
+            codec.dumps(value)
+        except Exception:
+            dropped.append(name)
+        else:
+            fields[name] = value
+    reply["fields"] = fields
+    error = "%s; fields dropped from the reply: %s" % (
+            format_exception(exception), ", ".join(sorted(dropped)))
+    if h.get("error"):
+        error = "%s; %s" % (h["error"], error)
+    reply["error"] = error
+    return codec.dumps(reply)
+
+
+class Cancelled(Exception):
+    """Raised by CancelToken.check() once the workitem is cancelled."""
+    pass
+
+
+class CancelToken(object):
+    """
+    Tells a running consume() that the engine cancelled its workitem.
+
+    consume() should stop early once the token is true: it can test it
+    between steps, call check() to raise Cancelled, sleep in wait()
+    instead of time.sleep(), or have add_callback() stop what it waits
+    on. Nothing is replied for a cancelled workitem whatever consume()
+    does next.
+    """
+
+    def __init__(self):
+        self._event = Event()
+        self._lock = Lock()
+        self._callbacks = []
+
+    def __bool__(self):
+        return self._event.is_set()
+    __nonzero__ = __bool__
+
+    def add_callback(self, callback):
+        """
+        Has callback() called from the cancelling thread when the
+        workitem is cancelled, or now if it already is.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def cancel(self):
+        """Cancels the workitem."""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def check(self):
+        """Raises Cancelled if the workitem was cancelled."""
+        if self._event.is_set():
+            raise Cancelled()
+
+    def wait(self, timeout=None):
+        """
+        Waits up to timeout seconds for the workitem to be cancelled and
+        returns whether it was.
+        """
+        self._event.wait(timeout)
+        return self._event.is_set()
+
+
+def _serve(participant, conn):
+    """
+    The loop of a WorkerProcess: consumes the workitem of each message
+    body received on conn and sends back whether consume() raised and
+    the workitem's json, until it receives None.
+    """
+    # Interrupting is up to the parent process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Worker processes are killed rather than cancelled
+    participant._local.cancelled = CancelToken()
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        encoding = job[0]
+        body = conn.recv_bytes()
+        workitem = Workitem(body, lazy=participant._lazy_workitems,
+                            content_encoding=encoding,
+                            stream=participant._stream_workitems)
+        body = None
+        participant.workitem = workitem
+        errored = False
+        try:
+            participant.consume()
+        except Exception as exobj:
+            log_consume_exception(participant.log, workitem)
+            workitem.error = format_exception(exobj)
+            workitem.trace = format_ruby_backtrace(
+                    traceback.extract_tb(sys.exc_info()[2]))
+            errored = True
+        reply = workitem.to_json()
+        participant.workitem = workitem = None
+        if not isinstance(reply, bytes):
+            reply = reply.encode("utf-8")
+        conn.send(errored)
+        conn.send_bytes(reply)
+
+
+def _fork_server(participant, conn):
+    """
+    The loop of a ForkServer: for each ("fork", address, authkey)
+    request received on conn forks a worker process which connects to
+    address and runs _serve(), sending back its pid, and for each
+    ("wait", pid) sends back the exit code of the worker with pid once
+    it exits, until it receives None.
+    """
+    from multiprocessing.connection import Client
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        if request[0] == "wait":
+            _, status = os.waitpid(request[1], 0)
+            if os.WIFSIGNALED(status):
+                conn.send(-os.WTERMSIG(status))
+            else:
+                conn.send(os.WEXITSTATUS(status))
+            continue
+        _, address, authkey = request
+        pid = os.fork()
+        if pid:
+            conn.send(pid)
+            continue
+        exitcode = 1
+        try:
+            conn.close()
+            _serve(participant, Client(address, authkey=authkey))
+            exitcode = 0
+        except Exception:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(exitcode)
+
+
+class Processes(object):
+    """
+    How a Participant runs consume() in worker processes: each worker
+    must connect back within connect_timeout seconds of being forked.
+    """
+
+    def __init__(self, connect_timeout=30):
+        try:
+            import multiprocessing
+        except ImportError:
+            raise ValueError("Worker processes need the multiprocessing "
+                             "module")
+        self.connect_timeout = connect_timeout
+
+
+class ForkServer(object):
+    """
+    A process forked from the participant, before any consumer thread
+    starts, to fork its WorkerProcesses.
+
+    A process forked while other threads run may inherit locks they
+    held, such as the logging module's, locked forever. Workers forked
+    from this process instead are copies of the participant as it was
+    before its threads started. They connect back through a socket
+    within connect_timeout seconds.
+    """
+
+    def __init__(self, participant, connect_timeout=30):
+        try:
+            import multiprocessing
+            from multiprocessing.connection import Listener
+        except ImportError:
+            raise ValueError("Worker processes need the multiprocessing "
+                             "module")
+        self._multiprocessing = multiprocessing
+        self._listener_class = Listener
+        self.__participant = participant
+        self._lock = Lock()
+        self._process = None
+        self._conn = None
+        self._listener = None
+        self._authkey = None
+        self.connect_timeout = connect_timeout
+
+    def start(self):
+        """Forks the process."""
+        context = self._multiprocessing
+        if hasattr(context, "get_context"):
+            # The participant and its consume() are inherited, not pickled
+            context = context.get_context("fork")
+        conn, child_conn = context.Pipe()
+        process = context.Process(target=_fork_server,
+                                  args=(self.__participant, child_conn))
+        process.daemon = True
+        process.start()
+        child_conn.close()
+        self._process = process
+        self._conn = conn
+        # Opened once the process is forked so it doesn't inherit it
+        self._authkey = os.urandom(20)
+        self._listener = self._listener_class(family="AF_UNIX",
+                                              authkey=self._authkey)
+
+    def stop(self):
+        """Lets the process exit; stop the workers first."""
+        if self._process is None:
+            return
+        try:
+            self._conn.send(None)
+        except (IOError, OSError):
+            pass
+        self._conn.close()
+        self._process.join()
+        self._process = None
+        self._listener.close()
+
+    def fork(self):
+        """
+        Forks a worker process and returns its pid and a connection to
+        it.
+        """
+        with self._lock:
+            self._conn.send(("fork", self._listener.address, self._authkey))
+            pid = self._conn.recv()
+            if not self._connecting():
+                os.kill(pid, signal.SIGKILL)
+                self._conn.send(("wait", pid))
+                self._conn.recv()
+                raise RuntimeError("Worker process %d didn't connect within "
+                                   "%ss" % (pid, self.connect_timeout))
+            return pid, self._listener.accept()
+
+    def _connecting(self):
+        """
+        Waits up to connect_timeout for a worker to connect, returning
+        whether one did. Listener.accept() has no timeout of its own.
+        """
+        sock = self._listener._listener._socket
+        return bool(select.select([sock], [], [], self.connect_timeout)[0])
+
+    def wait(self, pid):
+        """Waits for the worker with pid to exit, returning its exit code."""
+        with self._lock:
+            self._conn.send(("wait", pid))
+            return self._conn.recv()
+
+
+class WorkerProcess(object):
+    """
+    A process forked by a ForkServer to run consume() for the workitems
+    a ConsumerThread hands it.
+
+    The message body is passed on as it was received and the json the
+    worker sends back is relayed to the engine, so only the worker
+    decodes the fields. If the workitem is cancelled the process is
+    killed, and it is started again for the next one.
+    """
+
+    def __init__(self, server):
+        self._server = server
+        self._lock = Lock()
+        self._pid = None
+        self._conn = None
+        # The token of the workitem being consumed
+        self._token = None
+        self._killed = False
+
+    def start(self):
+        """Has the ForkServer fork the process."""
+        self._pid, self._conn = self._server.fork()
+
+    def stop(self):
+        """Lets the process exit once its workitem is consumed."""
+        if self._pid is None:
+            return
+        try:
+            self._conn.send(None)
+        except (IOError, OSError):
+            pass
+        self._conn.close()
+        self._server.wait(self._pid)
+        self._pid = None
+
+    def consume(self, body, encoding, token):
+        """
+        Consumes the workitem in the message body with content_encoding
+        encoding. Returns the workitem's json and whether consume()
+        raised, or None if the workitem was cancelled.
+        """
+        if not isinstance(body, bytes):
+            body = body.encode("utf-8")
+        if self._pid is None or self._killed:
+            self._restart()
+        with self._lock:
+            self._token = token
+        token.add_callback(lambda: self._kill(token))
+        try:
+            try:
+                self._conn.send((encoding,))
+                self._conn.send_bytes(body)
+                errored = self._conn.recv()
+                return self._conn.recv_bytes(), errored
+            finally:
+                with self._lock:
+                    self._token = None
+        except (EOFError, IOError, OSError):
+            exitcode = self._restart()
+            if token:
+                return None
+            raise RuntimeError("Worker process died with exit code %s"
+                               % exitcode)
+
+    def _restart(self):
+        """
+        Replaces a dead or killed process with a new one and returns the
+        exit code of the old one.
+        """
+        exitcode = None
+        if self._pid is not None:
+            self._conn.close()
+            exitcode = self._server.wait(self._pid)
+            self._pid = None
+        self._killed = False
+        self.start()
+        return exitcode
+
+    def _kill(self, token):
+        """Kills the process if it is consuming the workitem of token."""
+        with self._lock:
+            if self._token is token:
+                self._killed = True
+                os.kill(self._pid, signal.SIGTERM)
+
+
 class ConsumerThread(Thread):
-    """Thread for running the Participant.consume()"""
-    def __init__(self, participant):
+    """
+    Long-lived thread running Participant.consume() for queued workitems.
+
+    consume() runs here rather than in the main thread so it doesn't get
+    interrupted by signals. Each job is a (workitem, token, done,
+    submitted, message, priority, deadline) tuple and done(workitem,
+    exception, trace) is called once consume() returns. A workitem
+    cancelled while queued isn't consumed, and one whose deadline passed
+    is finished with an Expired exception instead.
+
+    Given a WorkerProcess, consume() is run there on the workitem of the
+    job's message, a (body, content_encoding) tuple, and done() gets the
+    workitem sent back.
+    """
+    def __init__(self, participant, jobs, worker=None):
         super(ConsumerThread, self).__init__()
+        self.daemon = True
         self.__participant = participant
-        self.exception = None
-        self.trace = None
-        self.log = logging.getLogger(__name__)
+        self.__jobs = jobs
+        self.__worker = worker
+        self.log = participant.log
 
     def run(self):
+        while True:
+            job = self.__jobs.get()
+            if job is None:
+                break
+            workitem, token, done, submitted, message, priority, \
+                deadline = job
+            if token:
+                done(workitem, None, None)
+                continue
+            metrics = self.__participant._metrics
+            if deadline is not None and time.time() > deadline:
+                metrics.expired.inc()
+                self.log.warning("Workitem %s expired before being "
+                                 "consumed" % workitem.sid)
+                done(workitem, Expired("Deadline passed %.1fs before "
+                                       "consume()" %
+                                       (time.time() - deadline)), [])
+                continue
+            started = clock()
+            metrics.wait.observe(started - submitted)
+            if priority is not None:
+                metrics.priority_wait(priority).observe(started - submitted)
+            if self.__worker is not None:
+                workitem, exception, trace = self.consume_in_worker(
+                        workitem, token, message)
+            else:
+                exception, trace = self.consume(workitem, token)
+            metrics.consume.observe(clock() - started)
+            if exception is not None:
+                metrics.errored.inc()
+            done(workitem, exception, trace)
+
+    def consume(self, workitem, token):
+        """
+        Runs the participant's consume() on workitem and returns the
+        exception raised and its trace, or (None, None). Exceptions
+        raised once the workitem is cancelled are ignored.
+        """
+        self.__participant.workitem = workitem
+        self.__participant._local.cancelled = token
         try:
             self.__participant.consume()
         except Exception as exobj:
-            # This should be configureable:
-            self.log.error("Exception in participant %s\n"
-                           "while handling instance %s of process %s\n"
-                           "Note: for information only. Participant remains"
-                           " functional.\n"
-                           "Error is being signalled to the workflow (unless"
-                           " this workitem is 'forgotten').\n" %
-                           (self.__participant.workitem.participant_name,
-                            self.__participant.workitem.wfid,
-                            self.__participant.workitem.wf_name))
-            self.log.error(format_block(traceback.format_exc()))
-            self.exception = exobj
-            self.trace = traceback.extract_tb(sys.exc_traceback)
+            if token:
+                return None, None
+            log_consume_exception(self.log, workitem)
+            return exobj, traceback.extract_tb(sys.exc_info()[2])
+        return None, None
+
+    def consume_in_worker(self, workitem, token, message):
+        """
+        Runs consume() in the thread's WorkerProcess and returns workitem,
+        relaying the json the worker sent back if any, along with the
+        exception and trace to record in it, or (None, None).
+        """
+        body, encoding = message
+        try:
+            result = self.__worker.consume(body, encoding, token)
+        except Exception as exobj:
+            self.log.error("Failed to consume workitem %s in a worker "
+                           "process: %s" % (workitem.sid,
+                                            format_exception(exobj)))
+            return workitem, exobj, traceback.extract_tb(sys.exc_info()[2])
+        if result is None:
+            return workitem, None, None
+        body, errored = result
+        if errored:
+            # Recorded in the workitem by the worker
+            self.__participant._metrics.errored.inc()
+        workitem._relay(body)
+        return workitem, None, None
+
+
+class ConsumerPool(object):
+    """
+    A fixed set of ConsumerThreads fed from a shared job queue.
+
+    The threads are started once and reused for every workitem. Given
+    processes, a Processes, each thread hands consume() to a
+    WorkerProcess of its own, forked by a ForkServer started before the
+    threads. With
+    scheduled set queued workitems are taken by priority and deadline;
+    see JobQueue.
+    """
+
+    def __init__(self, participant, size, processes=None, scheduled=False):
+        self.__participant = participant
+        self.size = size
+        self.processes = processes
+        self.scheduled = scheduled
+        self._jobs = JobQueue() if scheduled else Queue()
+        self._threads = []
+        self._server = None
+        self._workers = []
+
+    def start(self, threads=True):
+        """
+        Starts the worker processes, then the pool threads unless threads
+        is false. Either is only started once.
+        """
+        if self.processes is not None and self._server is None:
+            self._server = ForkServer(self.__participant,
+                                      self.processes.connect_timeout)
+            self._server.start()
+            for _ in range(self.size):
+                worker = WorkerProcess(self._server)
+                worker.start()
+                self._workers.append(worker)
+        if not threads or self._threads:
+            return
+        for index in range(self.size):
+            worker = self._workers[index] if self._workers else None
+            thread = ConsumerThread(self.__participant, self._jobs, worker)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, workitem, token, done, message=None, priority=0,
+               deadline=None):
+        """
+        Queues a workitem for consume(), which can be cancelled through
+        token; done(workitem, exception, trace) is called from the pool
+        thread when it has been processed. Worker processes need the
+        (body, content_encoding) message the workitem came in. A
+        scheduled pool orders workitems by priority and deadline, in
+        epoch seconds; any pool expires them at their deadline.
+        """
+        if not self.scheduled:
+            self._jobs.put((workitem, token, done, clock(), message, None,
+                            deadline))
+            return
+        job = (workitem, token, done, clock(), message, priority, deadline)
+        self._jobs.put((job, priority, deadline))
+
+    def stop(self):
+        """
+        Lets the pool threads finish their current work and exit, then
+        the worker processes.
+        """
+        for _ in self._threads:
+            self._jobs.put((None, 0, None) if self.scheduled else None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        for worker in self._workers:
+            worker.stop()
+        self._workers = []
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
 
 
 class Participant(object):
@@ -110,30 +665,213 @@ class Participant(object):
 
     Workitems arrive via AMQP, are processed and returned to the Ruote engine.
 
-    Cancel is not yet implemented.
+    consume() is run by a pool of long-lived threads started in run().
+    With concurrency greater than 1 up to that many workitems are
+    prefetched and consumed in parallel; each thread sees its own
+    workitem in self.workitem. prefetch sets how many workitems may be
+    received and not yet acknowledged. It defaults to concurrency, plus
+    reply_batch when replies are batched as finished workitems wait
+    for their batch to be acknowledged, plus CANCEL_WINDOW.
+
+    With lazy_workitems the workitem fields are only decoded if consume()
+    uses them; see Workitem.
+
+    With reconnect set, run() survives losing the broker: it reconnects
+    after an exponentially growing, jittered delay, redeclares the queue
+    and resumes consuming. The reconnects and the seconds spent
+    disconnected are counted in metrics, and read back by stats.
+
+    Given a connection_pool the participant takes its channel from that
+    ConnectionPool instead of opening a connection of its own. Given
+    connect, a callable returning a new connection such as
+    LocalBroker.connect, it is called instead of opening an amqplib
+    Connection to amqp_host.
+
+    By default each workitem is acknowledged and replied to as soon as
+    it is consumed. With reply_batch set, acknowledgements and replies
+    are sent in batches of up to that many, or every REPLY_DELAY seconds,
+    by a ReplyPipeline. With confirm_replies messages are only
+    acknowledged once the broker has committed their replies. A reply
+    which can't be encoded is replaced by an error reply keeping the
+    fields which can be, and the message is rejected if even that
+    fails, so it never holds a prefetch slot.
+
+    With stream_workitems workitems are decompressed and decoded a chunk
+    at a time where ijson allows; see Workitem. Either way the message
+    body is dropped as soon as it is decoded.
+
+    With compression set, replies of compress_threshold bytes or more are
+    compressed: it names the algorithm, or is True for the best
+    available; see codec.compress(). The engine must understand the
+    content_encoding. Compressed workitems are always accepted.
+
+    Counts, timings and sizes are recorded in the metrics registry, a
+    new one unless a shared RuoteAMQP.metrics.Metrics is passed in.
+
+    When the engine cancels a workitem, self.cancelled turns true while
+    consume() runs, or the workitem is dropped if still queued, and its
+    message is acknowledged without a reply. A cancel only reaches a
+    participant whose consumers are all busy through a spare prefetch
+    slot; CANCEL_WINDOW reserves some.
+
+    Given a reply_cache, a RuoteAMQP.dedup.ReplyCache or
+    SQLiteReplyCache, the reply to each workitem is cached before its
+    message is acknowledged. A workitem delivered again, after a
+    reconnect or a restart, is answered with the cached reply instead of
+    being consumed, and one delivered again while it is still being
+    consumed gets the reply once that finishes.
+
+    Given processes, a Processes or True for the defaults, a CPU bound
+    consume() runs in a WorkerProcess for each consumer thread, so
+    workitems are consumed in parallel despite the GIL. A cancelled
+    workitem's process is killed. Worker processes need fork().
+
+    Given scheduling, a RuoteAMQP.scheduler.Scheduling or True for the
+    defaults, prefetched workitems wait for a consumer thread in order
+    of schedule(), and those whose deadline passes first are answered
+    with an Expired error.
+
+    Given an outbox, a RuoteAMQP.outbox.Outbox, replies are stored there
+    for it to publish, and a workitem is acknowledged once its reply is
+    stored.
+
+    Given validation, a RuoteAMQP.schema.Validation, each workitem is
+    checked as soon as it is received, and one which doesn't match is
+    answered with a SchemaError instead of being consumed.
     """
 
+    # Bounds in seconds of the delay before reconnecting
+    RECONNECT_MIN_DELAY = 1
+    RECONNECT_MAX_DELAY = 60
+
+    # Most seconds a finished workitem waits for its batch
+    REPLY_DELAY = 0.05
+
+    # Prefetch slots left for a cancel to come in while every consumer
+    # thread is busy, none unless a subclass asks for them
+    CANCEL_WINDOW = 0
+
+    # Errors meaning the connection to the broker was lost, besides
+    # amqplib's AMQPConnectionException: naming it here would import
+    # amqplib with the module
+    CONNECTION_ERRORS = (IOError,)
+
     def __init__(self, ruote_queue,
                  amqp_host="localhost", amqp_user="ruote",
-                 amqp_pass="ruote", amqp_vhost="ruote"):
+                 amqp_pass="ruote", amqp_vhost="ruote",
+                 concurrency=1, lazy_workitems=False, reconnect=False,
+                 connection_pool=None, prefetch=None, metrics=None,
+                 reply_batch=0, confirm_replies=False, compression=None,
+                 compress_threshold=codec.COMPRESS_THRESHOLD,
+                 stream_workitems=False, reply_cache=None, connect=None,
+                 processes=None, scheduling=None,
+                 outbox=None, validation=None):
 
+        if concurrency < 1:
+            raise ValueError("concurrency should be at least 1")
         self._conn_params = dict(
                 host=amqp_host, userid=amqp_user, password=amqp_pass,
                 virtual_host=amqp_vhost, insist=False)
+        self._conn_pool = connection_pool
+        self._conn_factory = connect
         self._chan = None
+        # amqplib channels are not thread safe, all writes go through this
+        self._chan_lock = RLock()
         self._queue = ruote_queue
         self._consumer_tag = None
         self._running = False
+        self._concurrency = concurrency
+        if scheduling is True:
+            scheduling = Scheduling()
+        self._scheduling = scheduling
+        if not prefetch:
+            prefetch = concurrency + reply_batch + self.CANCEL_WINDOW
+            if scheduling is not None:
+                prefetch += scheduling.window
+        self._prefetch = prefetch
+        # Set by a ParticipantHost, which must never wait for consume()
+        self._hosted = False
+        self._lazy_workitems = lazy_workitems
+        self._stream_workitems = stream_workitems
+        if processes is True:
+            processes = Processes()
+        self._processes = processes
+        if compression:
+            # Fail now rather than when replying
+            codec.compressor(compression)
+        self._compression = compression
+        self._compress_threshold = compress_threshold
+        self._reconnect = reconnect
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self._metrics = ParticipantMetrics(metrics, ruote_queue)
+        self._pool = None
+        self._replies = None
+        self._results = Queue()
+        # Storage ids of the workitems received and not yet finished,
+        # mapped to the tokens cancelling them
+        self._in_flight = {}
+        self._in_flight_lock = RLock()
+        self._reply_cache = reply_cache
+        self._outbox = outbox
+        self._validation = validation
+        # Reply cache keys of the workitems being consumed, mapped to the
+        # (tag, channel) of the duplicates waiting for their reply
+        self._duplicates = {}
+        self._local = local()
         self.workitem = None
         self.log = logging.getLogger(__name__)
+        if reply_batch or confirm_replies:
+            self._replies = ReplyPipeline(self, max(reply_batch, 1),
+                                          self.REPLY_DELAY, confirm_replies)
+
+    @property
+    def workitem(self):
+        "The workitem being handled by the current thread."
+        return getattr(self._local, "workitem", None)
+
+    @workitem.setter
+    def workitem(self, workitem):
+        self._local.workitem = workitem
+
+    @property
+    def cancelled(self):
+        "The CancelToken of the workitem handled by the current thread."
+        return getattr(self._local, "cancelled", None)
+
+    @property
+    def stats(self):
+        """
+        The reconnects, seconds spent disconnected and redelivered
+        workitems counted in metrics for the participant's queue.
+        """
+        metrics = self._metrics
+        return {"reconnects": metrics.reconnects.value,
+                "downtime": metrics.downtime.value,
+                "redelivered": metrics.redelivered.value}
+
+    def _connect(self):
+        """Opens a connection of the participant's own."""
+        if self._conn_pool is not None:
+            return self._conn_pool.connect()
+        if self._conn_factory is not None:
+            return self._conn_factory()
+        return amqp.Connection(**self._conn_params)
 
     def _open_channel(self, connection):
-        """Open and initialize the amqp channel."""
+        """
+        Open and initialize the amqp channel on a connection or
+        ConnectionPool.
+        """
         if self._chan is None or not self._chan.is_open:
             self._chan = connection.channel()
-            # set qos option on this channel with prefetch count 1 whole
-            # message of any size
-            self._chan.basic_qos(0, 1, False)
+            if isinstance(connection, ConnectionPool):
+                # Other channels share the connection, and its lock
+                self._chan_lock = connection.lock(self._chan)
+            # set qos option on this channel to prefetch one whole message
+            # of any size for each workitem we may receive ahead
+            self._chan.basic_qos(0, self._prefetch, False)
             # Declare a shareable queue for the participant
             self._chan.queue_declare(
                     queue=self._queue, durable=True, exclusive=False,
@@ -146,6 +884,8 @@ class Participant(object):
             # self._chan.queue_bind(
             #        queue=self._queue, exchange="", routing_key=self._queue)
             # and set a callback for workitems
+            if self._replies is not None:
+                self._replies.reset(self._chan)
             self._consumer_tag = self._chan.basic_consume(
                     queue=self._queue, no_ack=False,
                     callback=self.workitem_callback)
@@ -156,39 +896,346 @@ class Participant(object):
         This is where a workitem message is handled
         """
         tag = msg.delivery_info["delivery_tag"]
+        metrics = self._metrics
+        metrics.received.inc()
+        metrics.received_bytes.observe(len(msg.body))
+        encoding = msg.properties.get("content_encoding")
+        message = None
         try:
-            self.workitem = Workitem(msg.body)
+            started = clock()
+            # Worker processes decode the fields, however small
+            workitem = Workitem(msg.body,
+                                lazy=self._lazy_workitems or self._processes,
+                                content_encoding=encoding,
+                                stream=self._stream_workitems,
+                                lazy_threshold=0 if self._processes else None)
+            metrics.decode.observe(clock() - started)
+            if self._processes:
+                # For the worker process to decode
+                message = (msg.body, encoding)
+            # Don't keep the body alive next to the workitem while a
+            # sequential consume() runs
+            msg.body = None
         except ValueError as exobj:
             # Reject and don't requeue the message
-            self._chan.basic_reject(tag, False)
+            with self._chan_lock:
+                self._chan.basic_reject(tag, False)
+            metrics.rejected.inc()
             self.log.warning("Exception decoding incoming json\n"
                              "%s\n"
                              "Note: Now re-raising exception\n" %
                              format_block(msg.body))
             raise exobj
 
-        # Launch consume() in separate thread so it doesn't get interrupted by
-        # signals
-        if not self.workitem.is_cancel:
-            consumer = ConsumerThread(self)
-            consumer.start()
-            consumer.join()
-            if consumer.exception:
-                # Note: the mechanism below is different than the one
-                # ruote-beanstalk uses. That sends the message in an array
-                # where the first element indicates the message type
-                # (workitem or error)
-
-                self.workitem.error = format_exception(consumer.exception)
-                self.workitem.trace = format_ruby_backtrace(consumer.trace)
+        if msg.delivery_info.get("redelivered"):
+            metrics.redelivered.inc()
+
+        metrics.in_flight.inc()
+        if self._replies is not None:
+            self._replies.received(tag)
+        self.workitem = workitem
+        if workitem.is_cancel:
+            self._cancel_workitem(workitem.sid)
+            # The engine expects no reply to a cancel
+            self._finish_workitem(workitem, tag, reply=False)
+            return
+
+        invalid = self._validate(workitem)
+        if invalid is not None:
+            metrics.invalid.inc()
+            self.log.warning("Workitem %s failed validation: %s"
+                             % (workitem.sid, invalid))
+            self._finish_workitem(workitem, tag, invalid, [])
+            return
+
+        key = None
+        if self._reply_cache is not None:
+            key = reply_key(workitem)
+            if key is not None and self._replay(key, tag):
+                return
+
+        sid = workitem.sid
+        token = CancelToken()
+        with self._in_flight_lock:
+            self._in_flight.setdefault(sid, []).append(token)
+        # Hand consume() over to the consumer threads so it doesn't get
+        # interrupted by signals
+        if self._pool is None:
+            self._start_pool()
+        if (self._concurrency > 1 or self._hosted or
+                self._prefetch > self._concurrency):
+            chan = self._chan
+
+            def done(workitem, exception, trace):
+                self._untrack(sid, token)
+                self._finish_pooled_workitem(workitem, tag, exception, trace,
+                                             chan, not token, key)
+            self._pool.submit(workitem, token, done, message,
+                              *self._schedule(workitem))
         else:
-            self.log.warning("Ignoring a cancel message")
+            self._pool.submit(workitem, token,
+                              lambda *result: self._results.put(result),
+                              message, *self._schedule(workitem))
+            workitem, exception, trace = self._results.get()
+            self._untrack(sid, token)
+            self._finish_workitem(workitem, tag, exception, trace,
+                                  reply=not token, key=key)
 
-        # Acknowledge the message as received
-        self._chan.basic_ack(tag)
+    def _validate(self, workitem):
+        """
+        Returns a SchemaError if the workitem's fields or params don't
+        match their schemas, or None.
+        """
+        validation = self._validation
+        if validation is None:
+            return None
+        errors = []
+        if validation.fields is not None:
+            try:
+                fields = workitem._fields_h()
+            except KeyError:
+                fields = {}
+            errors.extend(validation.fields.errors(fields, "fields"))
+        if validation.params is not None:
+            params = workitem._params_h()
+            errors.extend(validation.params.errors(
+                    {} if params is None else params, "fields.params"))
+        if errors:
+            return SchemaError(errors)
+        return None
 
-        if not self.workitem.forget:
-            self.reply_to_engine()
+    def _schedule(self, workitem):
+        """
+        Returns the (priority, deadline) to queue a workitem with, if
+        scheduling.
+        """
+        if not self._scheduling:
+            return 0, None
+        try:
+            return self.schedule(workitem)
+        except Exception:
+            self.log.error("Failed to schedule workitem %s\n%s"
+                           % (workitem.sid,
+                              format_block(traceback.format_exc())))
+            return 0, None
+
+    def schedule(self, workitem):
+        """
+        Returns the priority of a workitem, its params.priority, and its
+        deadline in epoch seconds or None; see RuoteAMQP.scheduler.
+        Override it to schedule differently.
+        """
+        return priority_of(workitem), deadline_of(workitem,
+                                                  self._scheduling.timeout)
+
+    def _cancel_workitem(self, sid):
+        """Cancels the workitems with storage id sid not yet finished."""
+        with self._in_flight_lock:
+            tokens = self._in_flight.pop(sid, [])
+        for token in tokens:
+            token.cancel()
+        if tokens:
+            self._metrics.cancelled.inc(len(tokens))
+            self.log.info("Cancelled workitem %s" % sid)
+        else:
+            self.log.info("Workitem %s to cancel isn't being consumed here"
+                          % sid)
+
+    def _untrack(self, sid, token):
+        """Forgets a finished workitem's token."""
+        with self._in_flight_lock:
+            tokens = self._in_flight.get(sid)
+            if tokens and token in tokens:
+                tokens.remove(token)
+                if not tokens:
+                    del self._in_flight[sid]
+
+    def _replay(self, key, tag):
+        """
+        Finishes the message with tag if it is a duplicate of a workitem
+        consumed already or being consumed, with reply cache key key.
+        Returns False if the workitem should be consumed.
+        """
+        with self._in_flight_lock:
+            if key in self._duplicates:
+                self._duplicates[key].append((tag, self._chan))
+                return True
+            try:
+                cached = self._reply_cache.get(key)
+            except Exception:
+                self.log.error("Failed to look up the reply to workitem %s"
+                               "\n%s" % (key,
+                                         format_block(traceback.format_exc())))
+                cached = None
+            if cached is None:
+                self._duplicates[key] = []
+                return False
+        self.log.info("Replaying the reply to duplicate workitem %s" % key)
+        self._metrics.in_flight.dec()
+        self._metrics.replayed.inc()
+        self._complete(tag, self._message(*cached), self._chan, key)
+        return True
+
+    def _remember(self, key, msg):
+        """
+        Caches the reply msg, or None for no reply, under key and returns
+        the duplicates waiting for it.
+        """
+        body = encoding = None
+        if msg is not None:
+            body = msg.body
+            encoding = msg.properties.get("content_encoding")
+        with self._in_flight_lock:
+            try:
+                self._reply_cache.put(key, body, encoding)
+            except Exception:
+                # The reply still goes out, it just won't be replayed
+                self.log.error("Failed to cache the reply to workitem %s"
+                               "\n%s" % (key,
+                                         format_block(traceback.format_exc())))
+            return self._duplicates.pop(key, [])
+
+    def _finish_workitem(self, workitem, tag, exception=None, trace=None,
+                         chan=None, reply=True, key=None):
+        """
+        Records any exception raised by consume() in the workitem,
+        acknowledges its message and replies to the engine unless reply
+        is false.
+
+        chan is the channel the workitem was received on, if that may
+        have been replaced since. Given the workitem's reply cache key,
+        the reply is cached and sent for the duplicates received
+        meanwhile too.
+        """
+        if exception:
+            # Note: the mechanism below is different than the one
+            # ruote-beanstalk uses. That sends the message in an array
+            # where the first element indicates the message type
+            # (workitem or error)
+
+            workitem.error = format_exception(exception)
+            workitem.trace = format_ruby_backtrace(trace)
+
+        self._metrics.in_flight.dec()
+        msg = None
+        if reply and not workitem.forget:
+            try:
+                msg = self._reply_message(workitem)
+            except Exception as exobj:
+                self.log.error("Failed to encode the reply to workitem %s, "
+                               "replying with the error\n%s"
+                               % (workitem.sid,
+                                  format_block(traceback.format_exc())))
+                msg = self._error_reply_message(workitem, exobj)
+                if msg is None:
+                    self._reject(tag, chan, key)
+                    return
+        duplicates = []
+        if key is not None:
+            duplicates = self._remember(key, msg)
+        self._complete(tag, msg, chan, workitem.sid)
+        for duplicate_tag, duplicate_chan in duplicates:
+            self._metrics.in_flight.dec()
+            self._metrics.replayed.inc()
+            self._complete(duplicate_tag, msg, duplicate_chan, workitem.sid)
+
+    def _error_reply_message(self, workitem, exception):
+        """
+        Returns a reply reporting that the reply to workitem couldn't be
+        encoded, keeping the fields which can be, or None if that fails
+        too.
+        """
+        try:
+            body, encoding = codec.compress(error_reply(workitem, exception),
+                                            self._compression,
+                                            self._compress_threshold)
+            return self._message(body, encoding)
+        except Exception:
+            self.log.error("Failed to encode an error reply to workitem %s, "
+                           "rejecting it\n%s"
+                           % (workitem.sid,
+                              format_block(traceback.format_exc())))
+            return None
+
+    def _reject(self, tag, chan, key=None):
+        """
+        Rejects the message with tag, received on chan, without
+        requeueing it, and the duplicates waiting for its reply cache key.
+        """
+        rejected = [(tag, chan)]
+        if key is not None:
+            with self._in_flight_lock:
+                duplicates = self._duplicates.pop(key, [])
+            rejected.extend(duplicates)
+            self._metrics.in_flight.dec(len(duplicates))
+        for tag, chan in rejected:
+            self._metrics.rejected.inc()
+            if self._replies is not None:
+                self._replies.reject(tag, chan or self._chan)
+                continue
+            with self._chan_lock:
+                if chan is None or chan is self._chan:
+                    self._chan.basic_reject(tag, False)
+
+    def _complete(self, tag, msg, chan, sid):
+        """
+        Acknowledges the message with tag, received on chan, and sends
+        the reply msg unless it is None.
+        """
+        if msg is not None and self._outbox is not None:
+            # Stored before the workitem is acknowledged
+            self._outbox.put(msg.body, msg.properties.get("content_encoding"))
+            msg = None
+        if self._replies is not None:
+            self._replies.complete(tag, msg, chan or self._chan)
+            return
+        with self._chan_lock:
+            if chan is not None and chan is not self._chan:
+                # The delivery tag died with its channel and the broker
+                # will deliver the workitem again
+                self.log.warning("Channel lost while handling workitem %s, "
+                                 "not replying as it will be redelivered" %
+                                 sid)
+                return
+            # Acknowledge the message as received
+            self._chan.basic_ack(tag)
+            self._metrics.acked.inc()
+
+            if msg is not None:
+                self._publish(msg)
+
+    def _finish_pooled_workitem(self, workitem, tag, exception, trace, chan,
+                                reply, key):
+        """Finishes a workitem from a pool thread, logging any failure."""
+        try:
+            self._finish_workitem(workitem, tag, exception, trace, chan,
+                                  reply, key)
+        except Exception:
+            self.log.error("Failed to acknowledge and reply to workitem %s\n%s"
+                           % (workitem.sid,
+                              format_block(traceback.format_exc())))
+
+    def _start_pool(self, threads=True):
+        """
+        Starts the worker processes, if any, then the consumer threads
+        unless threads is false.
+        """
+        if self._pool is None:
+            self._pool = ConsumerPool(self, self._concurrency,
+                                      self._processes,
+                                      self._scheduling is not None)
+        self._pool.start(threads)
+
+    def _stop_pool(self):
+        """
+        Waits for the consumer threads to finish their work and exit, then
+        for their replies to be sent.
+        """
+        if self._pool is not None:
+            self._pool.stop()
+            self._pool = None
+        if self._replies is not None:
+            self._replies.stop()
 
     def consume(self):
         """
@@ -203,24 +1250,82 @@ class Participant(object):
         """
         if self._running:
             raise RuntimeError("Participant already running")
+        configure_logging()
+        try:
+            connection_errors = self.CONNECTION_ERRORS + (
+                    amqp.AMQPConnectionException,)
+        except ImportError:
+            # Only a LocalBroker can be reached without amqplib
+            connection_errors = self.CONNECTION_ERRORS
+        self._start_pool()
+        self._running = True
+        attempt = 0
+        lost_at = None
         try:
-            with amqp.Connection(**self._conn_params) as conn:
-                with self._open_channel(conn):
-                    self._running = True
-                    while self._running:
-                        self._chan.wait()
+            while self._running:
+                try:
+                    conn = self._conn_pool
+                    if conn is None:
+                        conn = self._connect()
+                    try:
+                        with self._open_channel(conn):
+                            if lost_at is not None:
+                                self._metrics.downtime.inc(
+                                        time.time() - lost_at)
+                                self.log.info("Reconnected to the broker")
+                                lost_at = None
+                            attempt = 0
+                            while self._running:
+                                self._chan.wait()
+                            # Finish the workitems already received while
+                            # the channel is still open to acknowledge them
+                            self._stop_pool()
+                    finally:
+                        if conn is not self._conn_pool:
+                            conn.close()
+                except connection_errors as exobj:
+                    if not (self._reconnect and self._running):
+                        raise
+                    if lost_at is None:
+                        lost_at = time.time()
+                    with self._chan_lock:
+                        if self._conn_pool is not None and \
+                                self._chan is not None:
+                            self._conn_pool.discard(self._chan)
+                        self._chan = None
+                    delay = self._reconnect_delay(attempt)
+                    attempt += 1
+                    self._metrics.reconnects.inc()
+                    self.log.warning("Lost connection to the broker (%s), "
+                                     "reconnecting in %.1fs" %
+                                     (format_exception(exobj), delay))
+                    time.sleep(delay)
         except:
             self._running = False
             raise
+        finally:
+            self._stop_pool()
+
+    def _reconnect_delay(self, attempt):
+        """Returns the delay before the given reconnection attempt."""
+        return reconnect_delay(attempt, self.RECONNECT_MIN_DELAY,
+                               self.RECONNECT_MAX_DELAY)
 
     def finish(self):
         """
         Closes channel and connection
         """
+        if self._hosted:
+            # The host cancels the consumer from its own thread
+            self._running = False
+            return
+        # Cleared first, or run() could go back to waiting once the
+        # cancel has woken it
+        self._running = False
         if self._chan and self._chan.is_open:
             # Cancel the consumer so that we don't receive more messages
-            self._chan.basic_cancel(self._consumer_tag)
-        self._running = False
+            with self._chan_lock:
+                self._chan.basic_cancel(self._consumer_tag)
 
     def reply_to_engine(self, workitem=None):
         """
@@ -228,16 +1333,48 @@ class Participant(object):
         ruote engine.  The consume() method should set the
         workitem.result() if required.
         """
-        if not (self._chan and self._chan.is_open):
-            raise RuntimeError("AMQP channel not open")
         if not workitem:
             workitem = self.workitem
-        msg = amqp.Message(json.dumps(workitem.to_h()))
-        # delivery_mode=2 is persistent
-        msg.properties["delivery_mode"] = 2
+        if self._outbox is not None:
+            msg = self._reply_message(workitem)
+            self._outbox.put(msg.body, msg.properties.get("content_encoding"))
+            return
+        if not (self._chan and self._chan.is_open):
+            raise RuntimeError("AMQP channel not open")
+        self._publish(self._reply_message(workitem))
 
-        # Publish the message.
+    def _publish(self, msg):
+        """Publishes a reply message."""
         # Notice that this is sent to the anonymous/'' exchange (which is
         # different to 'amq.direct') with a routing_key for the queue
-        self._chan.basic_publish(msg, exchange='',
-                                 routing_key='ruote_workitems')
+        with self._chan_lock:
+            started = clock()
+            self._chan.basic_publish(msg, exchange='',
+                                     routing_key='ruote_workitems')
+            self._metrics.publish.observe(clock() - started)
+
+    def _reply_message(self, workitem):
+        """Returns the reply message for a workitem."""
+        metrics = self._metrics
+        started = clock()
+        body, encoding = codec.compress(workitem.to_json(),
+                                        self._compression,
+                                        self._compress_threshold)
+        metrics.encode.observe(clock() - started)
+        metrics.reply_bytes.observe(len(body))
+        return self._message(body, encoding)
+
+    @staticmethod
+    def _message(body, encoding):
+        """
+        Returns the reply message with body and content_encoding, or None
+        if body is None.
+        """
+        if body is None:
+            return None
+        msg = new_message(body)
+        if encoding:
+            msg.properties["content_encoding"] = encoding
+        # delivery_mode=2 is persistent
+        msg.properties["delivery_mode"] = 2
+        return msg
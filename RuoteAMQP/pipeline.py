@@ -0,0 +1,242 @@
+# Copyright (C) 2010 Nokia Corporation and/or its subsidiary(-ies).
+# Contact: David Greaves <ext-david.greaves@nokia.com>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Batched acknowledgements and replies """
+
+from __future__ import with_statement
+import time
+import traceback
+from collections import deque
+from threading import Condition, Thread
+from RuoteAMQP.metrics import clock
+
+
+class ReplyPipeline(object):
+    """
+    Acknowledges workitem messages and publishes their replies to the
+    engine in batches, from a thread of its own.
+
+    A batch is flushed once max_batch workitems are finished or the
+    oldest of them has waited max_delay seconds. Its replies are
+    published first, then the messages are acknowledged: workitems
+    finished in delivery order with a single ack of the latest tag, with
+    multiple set, and the others one at a time. If publishing fails the
+    batch's messages are requeued.
+
+    With confirm set the replies are published in a transaction on a
+    connection of the pipeline's own and the messages are only
+    acknowledged once the broker has committed it, so a reply is never
+    lost when the broker fails after the ack.
+    """
+
+    def __init__(self, participant, max_batch=100, max_delay=0.05,
+                 confirm=False):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.confirm = confirm
+        self.__participant = participant
+        self.log = participant.log
+        self._cond = Condition()
+        self._chan = None
+        # Tags in delivery order which aren't acknowledged yet
+        self._delivered = deque()
+        # Tags finished since the last flush, and acknowledged singly
+        self._done = set()
+        self._acked = set()
+        # (tag, reply message or None) for the next flush
+        self._pending = []
+        self._oldest = None
+        self._running = False
+        self._thread = None
+        self._publisher = None
+
+    def reset(self, chan):
+        """
+        Follows the participant onto a new channel. Workitems received on
+        the previous one are dropped, as the broker delivers them again.
+        """
+        with self._cond:
+            self._chan = chan
+            self._delivered.clear()
+            self._done.clear()
+            self._acked.clear()
+            self._pending = []
+            self._oldest = None
+            if not self._running:
+                self._running = True
+                self._thread = Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def received(self, tag):
+        """Records a delivery which will be finished through complete()."""
+        with self._cond:
+            self._delivered.append(tag)
+
+    def complete(self, tag, reply, chan):
+        """
+        Queues the acknowledgement of the message with tag, received on
+        chan, and the reply message unless it is None.
+        """
+        with self._cond:
+            if chan is not self._chan:
+                # The delivery tag died with its channel and the broker
+                # will deliver the workitem again
+                self.log.warning("Channel lost while handling a workitem, "
+                                 "not replying as it will be redelivered")
+                return
+            if not self._pending:
+                # Start the clock of the thread waiting for a batch
+                self._oldest = time.time()
+                self._cond.notify()
+            self._pending.append((tag, reply))
+            self._done.add(tag)
+            if len(self._pending) >= self.max_batch:
+                self._cond.notify()
+
+    def reject(self, tag, chan):
+        """
+        Rejects the message with tag, received on chan, without
+        requeueing it.
+        """
+        with self._cond:
+            if chan is not self._chan:
+                return
+            try:
+                self._delivered.remove(tag)
+            except ValueError:
+                pass
+        with self.__participant._chan_lock:
+            chan.basic_reject(tag, False)
+
+    def _ready(self):
+        """Is a batch due?"""
+        if not self._pending:
+            return False
+        return (len(self._pending) >= self.max_batch or
+                time.time() - self._oldest >= self.max_delay or
+                not self._running)
+
+    def _take(self):
+        """
+        Returns the channel, the pending (tag, reply) pairs, the tag to
+        acknowledge with multiple set or None and the tags to
+        acknowledge singly, and starts the next batch.
+        """
+        multiple = None
+        while self._delivered and (self._delivered[0] in self._done or
+                                   self._delivered[0] in self._acked):
+            tag = self._delivered.popleft()
+            if tag in self._done:
+                self._done.discard(tag)
+                multiple = tag
+            else:
+                self._acked.discard(tag)
+        singles = sorted(self._done)
+        self._acked.update(singles)
+        self._done.clear()
+        pending, self._pending = self._pending, []
+        self._oldest = None
+        return self._chan, pending, multiple, singles
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._ready():
+                    timeout = None
+                    if self._oldest is not None:
+                        timeout = max(0, self._oldest + self.max_delay -
+                                      time.time())
+                    self._cond.wait(timeout)
+                if not (self._running or self._pending):
+                    break
+                batch = self._take()
+            self._flush(*batch)
+        self._close_publisher()
+
+    def _flush(self, chan, pending, multiple, singles):
+        """Publishes the replies of a batch then acknowledges it."""
+        participant = self.__participant
+        metrics = participant._metrics
+        replies = [reply for _, reply in pending if reply is not None]
+        try:
+            started = clock()
+            if self.confirm and replies:
+                self._publish_confirmed(replies)
+                with participant._chan_lock:
+                    self._ack(chan, multiple, singles)
+            else:
+                with participant._chan_lock:
+                    for reply in replies:
+                        chan.basic_publish(reply, exchange='',
+                                           routing_key='ruote_workitems')
+                    self._ack(chan, multiple, singles)
+            metrics.publish.observe(clock() - started)
+            metrics.acked.inc(len(pending))
+        except Exception:
+            self.log.error("Failed to reply to %d workitems, requeueing "
+                           "them\n%s" % (len(pending),
+                                         traceback.format_exc()))
+            try:
+                with participant._chan_lock:
+                    for tag, _ in pending:
+                        chan.basic_reject(tag, True)
+            except Exception:
+                # The channel is gone and the broker requeues them itself
+                pass
+
+    @staticmethod
+    def _ack(chan, multiple, singles):
+        """Acknowledges a batch."""
+        if multiple is not None:
+            chan.basic_ack(multiple, multiple=True)
+        for tag in singles:
+            chan.basic_ack(tag)
+
+    def _publish_confirmed(self, replies):
+        """Publishes replies in a transaction and waits for the commit."""
+        if self._publisher is None:
+            conn = self.__participant._connect()
+            self._publisher = conn.channel()
+            self._publisher.tx_select()
+        try:
+            for reply in replies:
+                self._publisher.basic_publish(reply, exchange='',
+                                              routing_key='ruote_workitems')
+            self._publisher.tx_commit()
+        except Exception:
+            self._close_publisher()
+            raise
+
+    def _close_publisher(self):
+        """Closes the confirm mode connection."""
+        publisher, self._publisher = self._publisher, None
+        if publisher is None:
+            return
+        try:
+            publisher.connection.close()
+        except Exception:
+            # The connection was broken already
+            pass
+
+    def stop(self):
+        """Flushes what is pending and stops the thread."""
+        with self._cond:
+            if not self._running:
+                return
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
+        self._thread = None
@@ -0,0 +1,176 @@
+# Copyright (C) 2010 Nokia Corporation and/or its subsidiary(-ies).
+# Contact: David Greaves <ext-david.greaves@nokia.com>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" AMQP connection pooling """
+
+from __future__ import with_statement
+import random
+from threading import RLock
+from RuoteAMQP.lazy import LazyModule
+
+amqp = LazyModule("amqplib.client_0_8")
+
+
+def reconnect_delay(attempt, min_delay, max_delay):
+    """
+    Returns the seconds to wait before a reconnection attempt, counted
+    from 0: min_delay doubled with each attempt, up to max_delay, and
+    jittered so that clients which lost the same broker don't all come
+    back at once.
+    """
+    delay = min(max_delay, min_delay * 2 ** attempt)
+    return random.uniform(delay / 2.0, delay)
+
+
+class ConnectionPool(object):
+    """
+    A ConnectionPool lets Launchers and Participants share a few AMQP
+    connections, each carrying many channels.
+
+    channel() hands out a channel released earlier if it is still open,
+    or else opens one on the least busy connection. A new connection is
+    only opened once every connection carries channels_per_connection
+    channels, and no more than max_connections are opened.
+
+    Given connect, a callable returning a new connection such as
+    LocalBroker.connect, it is called instead of opening an amqplib
+    Connection to amqp_host.
+
+    amqplib connections are not thread safe. Opening a channel waits for
+    the broker's reply, as does Participant.run(), so all the channels of
+    a pool should be opened and waited on from one thread (see
+    ParticipantHost). Other threads may publish, acknowledge and reject
+    on them while holding the lock() of the channel's connection.
+    """
+
+    def __init__(self,
+                 amqp_host="localhost", amqp_user="ruote",
+                 amqp_pass="ruote", amqp_vhost="ruote",
+                 max_connections=2, channels_per_connection=64,
+                 connect=None):
+        self._conn_params = dict(
+                host=amqp_host, userid=amqp_user, password=amqp_pass,
+                virtual_host=amqp_vhost, insist=False)
+        self._conn_factory = connect
+        self.max_connections = max_connections
+        self.channels_per_connection = channels_per_connection
+        self._lock = RLock()
+        self._conns = []
+        self._idle = []
+        self._locks = {}
+
+    @staticmethod
+    def _channels(conn):
+        "The number of open channels on a connection."
+        # The connection itself is channel 0
+        return len(conn.channels) - 1
+
+    @staticmethod
+    def _healthy(chan):
+        "Is the channel and its connection still usable?"
+        conn = chan.connection
+        return (chan.is_open and conn is not None and
+                conn.transport is not None)
+
+    def _connection(self):
+        """Returns the connection to open the next channel on."""
+        self._conns = [conn for conn in self._conns
+                       if conn.transport is not None]
+        for conn in list(self._locks):
+            if conn not in self._conns:
+                del self._locks[conn]
+        free = [conn for conn in self._conns
+                if self._channels(conn) < self.channels_per_connection]
+        if free:
+            return min(free, key=self._channels)
+        if len(self._conns) >= self.max_connections:
+            raise RuntimeError("Connection pool exhausted: %d connections "
+                               "with %d channels each" %
+                               (len(self._conns),
+                                self.channels_per_connection))
+        conn = self._new_connection()
+        self._conns.append(conn)
+        self._locks[conn] = RLock()
+        return conn
+
+    def _new_connection(self):
+        """Opens a connection to the pool's broker."""
+        if self._conn_factory is not None:
+            return self._conn_factory()
+        return amqp.Connection(**self._conn_params)
+
+    def connect(self):
+        """
+        Opens a connection for the caller's sole use, outside the pool,
+        with the pool's broker and credentials.
+        """
+        return self._new_connection()
+
+    def channel(self):
+        """
+        Returns an open channel for the caller's sole use until it is
+        released or closed.
+        """
+        with self._lock:
+            while self._idle:
+                chan = self._idle.pop()
+                if self._healthy(chan):
+                    return chan
+            return self._connection().channel()
+
+    def lock(self, chan):
+        """
+        Returns the lock serialising writes to the connection of a channel
+        handed out by this pool.
+        """
+        with self._lock:
+            return self._locks[chan.connection]
+
+    def release(self, chan):
+        """
+        Returns a channel for reuse. Channels with consumers or in
+        transaction mode should be closed instead.
+        """
+        with self._lock:
+            if self._healthy(chan):
+                self._idle.append(chan)
+
+    def discard(self, chan):
+        """
+        Drops the connection of a channel which failed, so that the
+        channels handed out next are opened on a new one.
+        """
+        with self._lock:
+            conn = chan.connection
+            if conn in self._conns:
+                self._conns.remove(conn)
+                del self._locks[conn]
+            self._idle = [idle for idle in self._idle
+                          if idle.connection is not conn]
+        if conn is not None and conn.transport is not None:
+            try:
+                conn.close()
+            except Exception:
+                # The connection was broken already
+                pass
+
+    def close(self):
+        """Closes all the connections."""
+        with self._lock:
+            conns, self._conns, self._idle = self._conns, [], []
+            self._locks = {}
+        for conn in conns:
+            if conn.transport is not None:
+                conn.close()
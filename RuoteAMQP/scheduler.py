@@ -0,0 +1,164 @@
+# Copyright (C) 2010 Nokia Corporation and/or its subsidiary(-ies).
+# Contact: David Greaves <ext-david.greaves@nokia.com>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Ordering the workitems waiting for a consumer thread.
+
+A scheduling participant hands the workitems it has prefetched to its
+consumer threads by priority, from params.priority, then by deadline:
+the time the workitem was dispatched plus its params.timeout, as ruote
+understands it, or the timeout of the participant's Scheduling. A
+workitem whose deadline passed before a thread took it is answered with
+an Expired error instead of being consumed.
+"""
+
+import calendar
+import heapq
+import itertools
+import re
+import time
+try:
+    from Queue import PriorityQueue
+except ImportError:
+    from queue import PriorityQueue
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+# Seconds in each unit of a ruote (rufus) duration
+DURATION_UNITS = {"y": 365 * 24 * 3600, "M": 30 * 24 * 3600,
+                  "w": 7 * 24 * 3600, "d": 24 * 3600, "h": 3600, "m": 60,
+                  "s": 1}
+
+_DURATION = re.compile(r"^(?:\d+(?:\.\d+)?[yMwdhms])+$")
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)([yMwdhms])")
+_TIME = re.compile(r"^(\d{4})-(\d\d)-(\d\d)[ T](\d\d):(\d\d):(\d\d)(\.\d+)?"
+                   r"(?: ?(?:UTC|Z|\+0000|\+00:00))?$")
+
+INFINITY = float("inf")
+
+
+class Scheduling(object):
+    """
+    How a Participant schedules workitems: those without a params.timeout
+    expire timeout seconds after being dispatched, or never if it is
+    None, and window workitems are prefetched beyond those being
+    consumed to choose from.
+    """
+
+    def __init__(self, timeout=None, window=16):
+        self.timeout = timeout
+        self.window = window
+
+
+class Expired(Exception):
+    """The reply to a workitem whose deadline passed before consume()."""
+    pass
+
+
+def parse_duration(value):
+    """
+    Returns the seconds in a ruote duration, such as "1h30m" or "2d", or
+    None if value isn't one. Numbers are seconds but, as in ruote, a
+    string of digits counts milliseconds.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if not isinstance(value, string_types):
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value) / 1000.0
+    if not _DURATION.match(value):
+        return None
+    return float(sum(float(number) * DURATION_UNITS[unit]
+                     for number, unit in _DURATION_PART.findall(value)))
+
+
+def parse_time(value):
+    """
+    Returns the epoch seconds of a ruote UTC time, such as
+    "2010-05-07 10:11:12.123456 UTC", or of epoch seconds, or None if
+    value is neither.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if not isinstance(value, string_types):
+        return None
+    match = _TIME.match(value.strip())
+    if match is None:
+        return None
+    seconds = calendar.timegm(tuple(int(part) for part in match.groups()[:6]))
+    if match.group(7):
+        seconds += float(match.group(7))
+    return float(seconds)
+
+
+def priority_of(workitem):
+    """Returns the params.priority of workitem as a number, 0 by default."""
+    priority = workitem.params.priority
+    if isinstance(priority, bool):
+        return 0
+    try:
+        return int(priority or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def deadline_of(workitem, timeout=None, received=None):
+    """
+    Returns when workitem expires, in epoch seconds, or None if it
+    doesn't. Its params.timeout overrides timeout, in seconds, and the
+    time it was received stands in for its dispatched_at.
+    """
+    duration = parse_duration(workitem.params.timeout)
+    if duration is None:
+        duration = timeout
+    if duration is None:
+        return None
+    dispatched = parse_time(workitem.dispatched_at)
+    if dispatched is None:
+        dispatched = received if received is not None else time.time()
+    return dispatched + duration
+
+
+class JobQueue(PriorityQueue):
+    """
+    A Queue taking (job, priority, deadline) items and handing out the
+    jobs by priority, highest first, then by deadline, earliest first,
+    and otherwise in the order they came. A None job comes after all
+    the others.
+    """
+
+    def _init(self, maxsize):
+        PriorityQueue._init(self, maxsize)
+        self._order = itertools.count()
+
+    def _put(self, item):
+        job, priority, deadline = item
+        if job is None:
+            key = (1,)
+        else:
+            key = (0, -priority,
+                   INFINITY if deadline is None else deadline)
+        heapq.heappush(self.queue, (key, next(self._order), job))
+
+    def _get(self):
+        return heapq.heappop(self.queue)[-1]
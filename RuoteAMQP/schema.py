@@ -0,0 +1,407 @@
+# Copyright (C) 2010 Nokia Corporation and/or its subsidiary(-ies).
+# Contact: David Greaves <ext-david.greaves@nokia.com>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Checking workitem fields and params against a JSON schema.
+
+A schema is compiled once into nested validator functions, so checking
+a workitem walks its fields without looking at the schema again:
+
+    order = Schema({"type": "object",
+                    "required": ["customer", "lines"],
+                    "properties": {
+                        "customer": {"type": "string", "minLength": 1},
+                        "lines": {"type": "array", "minItems": 1,
+                                  "items": {"type": "object"}}}})
+    order.validate(workitem.fields.as_dict())
+
+Only this subset of JSON schema is understood: type, enum, const,
+properties, required, additionalProperties, items (a single schema),
+minItems, maxItems, minLength, maxLength, pattern, minimum, maximum,
+exclusiveMinimum and exclusiveMaximum (as numbers), besides the
+annotations title, description, default, examples, $schema, $id and
+$comment. Any other keyword is refused rather than ignored.
+"""
+
+import operator
+import re
+try:
+    string_types = basestring
+    integer_types = (int, long)
+except NameError:
+    string_types = str
+    integer_types = (int,)
+
+# Violations listed in a SchemaError's message, of those found
+MAX_REPORTED = 10
+
+_ANNOTATIONS = frozenset(["title", "description", "default", "examples",
+                          "$schema", "$id", "$comment"])
+
+
+def _is_integer(value):
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, float):
+        return value.is_integer()
+    return isinstance(value, integer_types)
+
+
+def _is_number(value):
+    return (isinstance(value, integer_types + (float,)) and
+            not isinstance(value, bool))
+
+
+# JSON types which isinstance() can tell apart, and those it can't as
+# bool is an int
+_CLASSES = {"object": (dict,), "array": (list,), "string": (string_types,),
+            "boolean": (bool,), "null": (type(None),)}
+_PREDICATES = {"integer": _is_integer, "number": _is_number}
+
+
+def _type_name(value):
+    """Returns the JSON type of a decoded value."""
+    for name in ("integer", "number"):
+        if _PREDICATES[name](value):
+            return name
+    for name, classes in _CLASSES.items():
+        if isinstance(value, classes):
+            return name
+    return type(value).__name__
+
+
+class SchemaError(ValueError):
+    """
+    Fields or params which don't match their schema. errors lists each
+    violation as "path: problem", such as
+    "fields.lines[2].qty: expected integer, got string".
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        message = "; ".join(errors[:MAX_REPORTED])
+        if len(errors) > MAX_REPORTED:
+            message += "; and %d more" % (len(errors) - MAX_REPORTED)
+        ValueError.__init__(self, message)
+
+
+class Schema(object):
+    """
+    A JSON schema compiled into a validator. Raises ValueError if the
+    schema is malformed or uses keywords outside the supported subset.
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        self._check = _compile(schema, "#")
+
+    def errors(self, value, path="fields"):
+        """
+        Returns the ways decoded json value violates the schema, as
+        "path: problem" strings, with value named path.
+        """
+        errors = []
+        if self._check is not None:
+            self._check(value, path, errors)
+        return ["%s: %s" % (_format_path(where), problem)
+                for where, problem in errors]
+
+    def validate(self, value, path="fields"):
+        """Raises a SchemaError if value violates the schema."""
+        errors = self.errors(value, path)
+        if errors:
+            raise SchemaError(errors)
+
+
+def compile_schema(schema):
+    """
+    Returns a Schema for a JSON schema, a Schema as it is, or None for
+    None.
+    """
+    if schema is None or isinstance(schema, Schema):
+        return schema
+    return Schema(schema)
+
+
+class Validation(object):
+    """
+    The schemas a Participant checks the fields and params of each
+    workitem against, JSON schemas or Schemas, compiled once. Only a
+    fields schema makes a lazy workitem decode its fields.
+    """
+
+    def __init__(self, fields=None, params=None):
+        self.fields = compile_schema(fields)
+        self.params = compile_schema(params)
+
+
+def _format_path(path):
+    """
+    Formats a path: the name of the value validated, or a (path, key)
+    pair for a property or an array index in it.
+    """
+    keys = []
+    while isinstance(path, tuple):
+        path, key = path
+        keys.append(key)
+    parts = [path]
+    for key in reversed(keys):
+        if isinstance(key, int):
+            parts.append("[%d]" % key)
+        else:
+            parts.append(".%s" % key)
+    return "".join(parts)
+
+
+def _number(schema, keyword, where):
+    """Returns the number schema has for keyword, refusing others."""
+    value = schema[keyword]
+    if not _is_number(value):
+        raise ValueError("%s/%s should be a number" % (where, keyword))
+    return value
+
+
+def _count(schema, keyword, where):
+    """Returns the count schema has for keyword, refusing others."""
+    value = schema[keyword]
+    if not _is_integer(value) or value < 0:
+        raise ValueError("%s/%s should be a non-negative integer"
+                         % (where, keyword))
+    return int(value)
+
+
+def _compile(schema, where):
+    """
+    Returns a function(value, path, errors) appending to errors a
+    (path, problem) pair for each way value violates schema, found at
+    where in the whole schema, or None if schema accepts anything. Paths
+    are only formatted for the errors, by _format_path().
+    """
+    if schema is True:
+        return None
+    if schema is False:
+        def check_false(value, path, errors):
+            errors.append((path, "not allowed"))
+        return check_false
+    if not isinstance(schema, dict):
+        raise ValueError("%s should be an object or a boolean" % where)
+    unknown = set(schema).difference(
+            ["type"], (keyword for keyword, _ in _KEYWORDS), _ANNOTATIONS)
+    if unknown:
+        raise ValueError("%s uses unsupported keywords: %s"
+                         % (where, ", ".join(sorted(unknown))))
+
+    checks = []
+    for keyword, compiler in _KEYWORDS:
+        if keyword in schema:
+            check = compiler(schema, where)
+            if check is not None:
+                checks.append(check)
+
+    if "type" not in schema:
+        if not checks:
+            return None
+        if len(checks) == 1:
+            return checks[0]
+
+        def check_schema(value, path, errors):
+            for check in checks:
+                check(value, path, errors)
+        return check_schema
+
+    types = schema["type"]
+    if isinstance(types, string_types):
+        types = [types]
+    if not isinstance(types, list):
+        raise ValueError("%s/type should be a string or an array" % where)
+    for name in types:
+        if name not in _CLASSES and name not in _PREDICATES:
+            raise ValueError("%s/type has unknown type %r" % (where, name))
+    classes = tuple(cls for name in types for cls in _CLASSES.get(name, ()))
+    predicates = [_PREDICATES[name] for name in types if name in _PREDICATES]
+    matches = None
+    if len(predicates) == 1:
+        matches = predicates[0]
+    elif predicates:
+        def matches(value):
+            return any(predicate(value) for predicate in predicates)
+    expected = " or ".join(types)
+
+    def check_typed(value, path, errors):
+        if not (isinstance(value, classes) or
+                (matches is not None and matches(value))):
+            errors.append((path, "expected %s, got %s"
+                           % (expected, _type_name(value))))
+            # The other keywords mean little for a value of the wrong type
+            return
+        for check in checks:
+            check(value, path, errors)
+    return check_typed
+
+
+def _compile_enum(schema, where):
+    values = schema["enum"]
+    if not isinstance(values, list):
+        raise ValueError("%s/enum should be an array" % where)
+
+    def check_enum(value, path, errors):
+        if value not in values:
+            errors.append((path, "%r is not one of %r" % (value, values)))
+    return check_enum
+
+
+def _compile_const(schema, where):
+    const = schema["const"]
+
+    def check_const(value, path, errors):
+        if value != const:
+            errors.append((path, "should be %r" % (const,)))
+    return check_const
+
+
+def _compile_properties(schema, where):
+    properties = schema["properties"]
+    if not isinstance(properties, dict):
+        raise ValueError("%s/properties should be an object" % where)
+    compiled = []
+    for name, subschema in sorted(properties.items()):
+        check = _compile(subschema, "%s/properties/%s" % (where, name))
+        if check is not None:
+            compiled.append((name, check))
+    if not compiled:
+        return None
+
+    def check_properties(value, path, errors):
+        if isinstance(value, dict):
+            for name, check in compiled:
+                if name in value:
+                    check(value[name], (path, name), errors)
+    return check_properties
+
+
+def _compile_required(schema, where):
+    required = schema["required"]
+    if not (isinstance(required, list) and
+            all(isinstance(name, string_types) for name in required)):
+        raise ValueError("%s/required should be an array of strings" % where)
+    if not required:
+        return None
+
+    def check_required(value, path, errors):
+        if isinstance(value, dict):
+            for name in required:
+                if name not in value:
+                    errors.append(((path, name), "is required"))
+    return check_required
+
+
+def _compile_additional(schema, where):
+    additional = schema["additionalProperties"]
+    known = frozenset(schema.get("properties") or ())
+    if additional is True:
+        return None
+    check = _compile(additional, "%s/additionalProperties" % where)
+    if check is None:
+        return None
+
+    def check_additional(value, path, errors):
+        if isinstance(value, dict):
+            for name in sorted(set(value) - known):
+                check(value[name], (path, name), errors)
+    return check_additional
+
+
+def _compile_items(schema, where):
+    items = schema["items"]
+    if isinstance(items, list):
+        raise ValueError("%s/items as an array of schemas is not supported"
+                         % where)
+    check = _compile(items, "%s/items" % where)
+    if check is None:
+        return None
+
+    def check_items(value, path, errors):
+        if isinstance(value, list):
+            for index, item in enumerate(value):
+                check(item, (path, index), errors)
+    return check_items
+
+
+def _compile_size(keyword, classes, noun, compare, relation):
+    """
+    Returns a compiler for a keyword bounding the len() of the values of
+    classes.
+    """
+    def compiler(schema, where):
+        bound = _count(schema, keyword, where)
+
+        def check_size(value, path, errors):
+            if isinstance(value, classes) and not compare(len(value), bound):
+                errors.append((path, "should have %s %d %s"
+                               % (relation, bound, noun)))
+        return check_size
+    return compiler
+
+
+def _compile_pattern(schema, where):
+    try:
+        pattern = re.compile(schema["pattern"])
+    except (TypeError, re.error):
+        raise ValueError("%s/pattern should be a regular expression" % where)
+
+    def check_pattern(value, path, errors):
+        # Unanchored, as in JSON schema
+        if (isinstance(value, string_types) and
+                pattern.search(value) is None):
+            errors.append((path, "should match %r" % pattern.pattern))
+    return check_pattern
+
+
+def _compile_bound(keyword, compare, relation):
+    """Returns a compiler for a keyword bounding numbers."""
+    def compiler(schema, where):
+        bound = _number(schema, keyword, where)
+
+        def check_bound(value, path, errors):
+            if _is_number(value) and not compare(value, bound):
+                errors.append((path, "should be %s %r" % (relation, bound)))
+        return check_bound
+    return compiler
+
+
+# Keyword: compiler, in the order their checks run
+_KEYWORDS = [
+    ("enum", _compile_enum),
+    ("const", _compile_const),
+    ("required", _compile_required),
+    ("properties", _compile_properties),
+    ("additionalProperties", _compile_additional),
+    ("items", _compile_items),
+    ("minItems", _compile_size("minItems", list, "items", operator.ge,
+                               "at least")),
+    ("maxItems", _compile_size("maxItems", list, "items", operator.le,
+                               "at most")),
+    ("minLength", _compile_size("minLength", string_types, "characters",
+                                operator.ge, "at least")),
+    ("maxLength", _compile_size("maxLength", string_types, "characters",
+                                operator.le, "at most")),
+    ("pattern", _compile_pattern),
+    ("minimum", _compile_bound("minimum", operator.ge, "at least")),
+    ("maximum", _compile_bound("maximum", operator.le, "at most")),
+    ("exclusiveMinimum", _compile_bound("exclusiveMinimum", operator.gt,
+                                        "more than")),
+    ("exclusiveMaximum", _compile_bound("exclusiveMaximum", operator.lt,
+                                        "less than")),
+]
@@ -1,10 +1,269 @@
 #!/usr/bin/python
 
+import re
+# The interpreter's own lock, sparing workitems the threading module
+try:
+    from thread import allocate_lock
+except ImportError:
+    from _thread import allocate_lock
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
 try:
     import json
+    from json.decoder import scanstring
 except ImportError:
     import simplejson as json
-from copy import deepcopy
+    from simplejson.decoder import scanstring
+from RuoteAMQP import codec
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_SCALAR = re.compile(r'[^,}\]\s]+')
+# What lies between the strings and brackets of an array or object
+_BETWEEN = re.compile(r'[^"{}\[\]]*')
+_BRACKET = re.compile(r'[{}\[\]]')
+_raw_decode = json.JSONDecoder().raw_decode
+
+# Returned by _scan_value() for a value it didn't decode
+_SKIPPED = object()
+
+# Message bodies shorter than this many bytes are decoded whole even for
+# a lazy workitem, as scanning them costs more
+LAZY_THRESHOLD = 256 * 1024
+
+# The strings and brackets of an array or object are followed one at a
+# time while they average SKIP_BYTES characters or more, beyond the first
+# two. Decoding shorter ones costs less than walking them in python.
+SKIP_BYTES = 256
+
+# Characters _count_brackets() first counts the brackets of at a time,
+# doubled up to COUNT_CHUNK
+COUNT_START = 256
+COUNT_CHUNK = 64 * 1024
+
+# Translation tables from json to its brackets, opening ones as "(" and
+# closing ones as ")", with or without its quotes
+_TO_BRACKETS = bytearray(range(256))
+_TO_BRACKETS[ord("{")] = _TO_BRACKETS[ord("[")] = ord("(")
+_TO_BRACKETS[ord("}")] = _TO_BRACKETS[ord("]")] = ord(")")
+_TO_BRACKETS = bytes(_TO_BRACKETS)
+_NOT_BRACKETS = bytes(bytearray(c for c in range(256)
+                                if chr(c) not in '{}[]'))
+_NOT_QUOTES = bytes(bytearray(c for c in range(256)
+                              if chr(c) not in '"{}[]'))
+
+
+def _skip_string(s, pos):
+    """Returns the end of the json string starting at pos."""
+    end = pos
+    while True:
+        end = s.find('"', end + 1)
+        if end < 0:
+            raise ValueError("Unterminated string starting at %d" % pos)
+        # A quote is escaped by an odd number of backslashes
+        before = end - 1
+        while s[before] == '\\':
+            before -= 1
+        if (end - before) % 2:
+            return end + 1
+
+
+def _skip_container(s, pos):
+    """
+    Returns the end of the array or object starting at pos by following
+    its strings and brackets, or None once they are too short to be
+    worth it; see SKIP_BYTES.
+    """
+    start = pos
+    depth = 0
+    tokens = 0
+    while True:
+        if s[pos] == '"':
+            pos = _skip_string(s, pos)
+        else:
+            depth += 1 if s[pos] in "{[" else -1
+            pos += 1
+            if depth == 0:
+                return pos
+        tokens += 1
+        if tokens > 2 and pos - start < tokens * SKIP_BYTES:
+            return None
+        pos = _BETWEEN.match(s, pos).end()
+
+
+def _encoded(s, start, end):
+    """Returns s[start:end] as bytes."""
+    chunk = s[start:end]
+    if not isinstance(chunk, bytes):
+        chunk = chunk.encode("utf-8")
+    return chunk
+
+
+def _balance(brackets):
+    """
+    Returns (closing, change) for a run of brackets: how many of them
+    close ones opened before it, and the change in depth over it.
+    """
+    # What is left once the pairs opened and closed in it are dropped
+    while b"()" in brackets:
+        brackets = brackets.replace(b"()", b"")
+    closing = brackets.count(b")")
+    return closing, len(brackets) - 2 * closing
+
+
+def _plain(s, start, end, brackets, carry):
+    """
+    Returns the brackets of s[start:end], given them with its quotes,
+    and whether it then ends in a string, or None if one of its strings
+    holds a bracket or escaped quote. carry is whether it starts in one.
+    """
+    if s.find("\\", start - 1, end) >= 0 and \
+            s.find('\\"', start - 1, end) >= 0:
+        return None
+    first = 0
+    if carry:
+        if not brackets:
+            return brackets, True
+        if not brackets.startswith(b'"'):
+            return None
+        first = 1
+    # The quotes of strings holding no brackets come in pairs. The
+    # opening quote of the first string holding one would end an odd run
+    # of quotes, unless it is the last one, of a string going on past end
+    last = len(brackets)
+    quotes = brackets.count(b'"', first)
+    if quotes % 2:
+        if not brackets.endswith(b'"'):
+            return None
+        last -= 1
+    if brackets.count(b'""', first, last) * 2 != quotes - quotes % 2:
+        return None
+    return brackets.translate(None, b'"'), bool(quotes % 2)
+
+
+def _count_brackets(s, pos):
+    """
+    Returns (end, exact) for the array or object starting at pos: where
+    its brackets balance, or None if they never do, and whether that is
+    where it ends, as it is when none of its strings hold a bracket or
+    escaped quote. They are counted a chunk at a time, and the chunk
+    where they balance is halved down to COUNT_START characters to walk.
+    """
+    depth = 1
+    pos += 1
+    size = COUNT_START
+    exact = True
+    carry = False
+    while pos < len(s):
+        chunk = _encoded(s, pos, pos + size)
+        plain = None
+        if exact:
+            plain = _plain(s, pos, pos + size,
+                           chunk.translate(_TO_BRACKETS, _NOT_QUOTES), carry)
+            exact = plain is not None
+        if plain is None:
+            brackets = chunk.translate(_TO_BRACKETS, _NOT_BRACKETS)
+        else:
+            brackets, carry = plain
+        closing, change = _balance(brackets)
+        if closing < depth:
+            depth += change
+            pos += size
+            size = min(size * 2, COUNT_CHUNK)
+            continue
+        while size > COUNT_START:
+            size //= 2
+            closing, change = _balance(_encoded(s, pos, pos + size).translate(
+                    _TO_BRACKETS, _NOT_BRACKETS))
+            if closing < depth:
+                depth += change
+                pos += size
+        for match in _BRACKET.finditer(s, pos, pos + size):
+            depth += 1 if match.group() in "{[" else -1
+            if depth == 0:
+                return match.end(), exact
+        break
+    return None, False
+
+
+def _decode_container(s, pos, end):
+    """
+    Returns (end, value) for the array or object starting at pos, given
+    where its brackets balance.
+    """
+    if end is not None:
+        try:
+            # Only decodes if end is right, as nothing may follow a value
+            return end, codec.loads(s[pos:end])
+        except ValueError:
+            pass
+    value, end = _raw_decode(s, pos)
+    return end, value
+
+
+def _scan_value(s, pos, key=None):
+    """
+    Returns (end, value) for the json value starting at pos, where value
+    is _SKIPPED unless it had to be decoded to find its end.
+    """
+    char = s[pos]
+    if char == '"':
+        return _skip_string(s, pos), _SKIPPED
+    if char in "{[":
+        end = _skip_container(s, pos)
+        if end is None:
+            end, exact = _count_brackets(s, pos)
+            if not exact:
+                return _decode_container(s, pos, end)
+        return end, _SKIPPED
+    match = _SCALAR.match(s, pos)
+    if match is None:
+        raise ValueError("Expecting json value at %d" % pos)
+    return match.end(), _SKIPPED
+
+
+def _scan_field(s, pos, key):
+    """Scans a field, decoding params and dispatched_at."""
+    if key in ("params", "dispatched_at"):
+        value, end = _raw_decode(s, pos)
+        return end, value
+    return _scan_value(s, pos)
+
+
+def _scan_object(s, pos=0, scan=_scan_value):
+    """
+    Returns (members, end) for the json object at pos, with (key, start,
+    end, value) for each member: s[start:end] is the still encoded value
+    and value what scan(s, start, key) returned for it.
+    """
+    members = []
+    try:
+        pos = _WHITESPACE.match(s, pos).end()
+        if s[pos] != '{':
+            raise ValueError("Expecting json object at %d" % pos)
+        pos = _WHITESPACE.match(s, pos + 1).end()
+        if s[pos] == '}':
+            return members, pos + 1
+        while True:
+            if s[pos] != '"':
+                raise ValueError("Expecting property name at %d" % pos)
+            key, pos = scanstring(s, pos + 1)
+            pos = _WHITESPACE.match(s, pos).end()
+            if s[pos] != ':':
+                raise ValueError("Expecting : delimiter at %d" % pos)
+            start = _WHITESPACE.match(s, pos + 1).end()
+            pos, value = scan(s, start, key)
+            members.append((key, start, pos, value))
+            pos = _WHITESPACE.match(s, pos).end()
+            if s[pos] == '}':
+                return members, pos + 1
+            if s[pos] != ',':
+                raise ValueError("Expecting , delimiter at %d" % pos)
+            pos = _WHITESPACE.match(s, pos + 1).end()
+    except IndexError:
+        raise ValueError("Unexpected end of json object")
 
 
 class DictAttrProxy(object):
@@ -18,26 +277,57 @@ class DictAttrProxy(object):
       wip.ev.items[1]=5
       wi => {'ev': {'items': [1, 5, 3], 'val': 5}}
 
-    It is iterable and nested dicts will be proxied too
+    It is iterable and nested dicts will be proxied too. The proxy for a
+    nested dict is kept and reused for as long as that same dict object is
+    found under the attribute.
+
+    Given a dirty set, the proxy records in it which of the top level
+    keys may have been changed: the one it is under (key), or for the
+    top level proxy those written to or whose lists were handed out,
+    and None once the whole dict was handed out by as_dict().
+
+    Reading a field named like one of the proxy's own slots (_d,
+    _children, _dirty or _key) or methods returns the proxy's attribute;
+    such fields are read through as_dict(). Writing one sets the field.
     """
-    def __init__(self, d):
+
+    __slots__ = ('_d', '_children', '_dirty', '_key')
+
+    def __init__(self, d, dirty=None, key=None):
         # This:
         #   self._d = d
         # won't work as we can't set a local attribute as we override
-        # __setattr__ so instead we poke straight into the __dict__ :
-        self.__dict__['_d'] = d
+        # __setattr__ so instead we go straight to object.__setattr__ :
+        object.__setattr__(self, '_d', d)
+        object.__setattr__(self, '_children', None)
+        object.__setattr__(self, '_dirty', dirty)
+        object.__setattr__(self, '_key', key)
 
     # Any attempt to get an attr looks it up in the proxied dict
     # any nested dict items are also proxied
     def __getattr__(self, attr):
         r = self._d.get(attr, None)
         if type(r) is dict:
-            return DictAttrProxy(r)
+            children = self._children
+            if children is None:
+                children = {}
+                object.__setattr__(self, '_children', children)
+            proxy = children.get(attr)
+            if proxy is None or proxy._d is not r:
+                proxy = children[attr] = DictAttrProxy(
+                        r, self._dirty, attr if self._key is None
+                        else self._key)
+            return proxy
+        if self._dirty is not None and type(r) is list:
+            # Lists can be changed behind our back
+            self._dirty.add(attr if self._key is None else self._key)
         return r
 
     # Note that writing into an entry creates it.
     def __setattr__(self, attr, value):
         self._d[attr] = value
+        if self._dirty is not None:
+            self._dirty.add(attr if self._key is None else self._key)
 
     # Passthru to the dict __iter__() and /__next__()
     def __iter__(self):
@@ -51,9 +341,91 @@ class DictAttrProxy(object):
 
     # and if we want to use this syntax to get at a nested dict:
     def as_dict(self):
+        if self._dirty is not None:
+            self._dirty.add(self._key)
         return self._d
 
 
+class FieldPath(object):
+    """
+    A dotted field path such as 'customer.address.city', split once so it
+    can be used on any number of workitems. See Workitem.compile_path().
+    """
+
+    __slots__ = ('path', 'keys', '_parents', '_last')
+
+    def __init__(self, path):
+        self.path = path
+        self.keys = tuple(path.split("."))
+        self._parents = self.keys[:-1]
+        self._last = self.keys[-1]
+
+    def __repr__(self):
+        return "FieldPath(%r)" % self.path
+
+    def get(self, workitem):
+        """Returns the field's value, or None if it isn't there."""
+        if workitem._lazy_fields is not None:
+            workitem._materialize()
+        ref = workitem._h['fields']
+        for k in self.keys:
+            if k not in ref:
+                return None
+            ref = ref[k]
+        if type(ref) in (dict, list):
+            workitem._changed(self.keys[0])
+        return ref
+
+    def set(self, workitem, value):
+        """Sets the field, creating any missing parent fields."""
+        workitem._changed(self.keys[0])
+        if workitem._lazy_fields is not None:
+            workitem._materialize()
+        ref = workitem._h['fields']
+        for k in self._parents:
+            if k not in ref:
+                ref[k] = {}
+            ref = ref[k]
+        ref[self._last] = value
+
+    def delete(self, workitem):
+        """Removes the field if it is there."""
+        workitem._changed(self.keys[0])
+        ref = workitem._fields_h()
+        for k in self._parents:
+            if k not in ref:
+                return
+            ref = ref[k]
+        if isinstance(ref, dict):
+            ref.pop(self._last, None)
+
+
+# Compiled FieldPaths and lookup_many() plans, least recently used first
+_PATHS = OrderedDict()
+_PATHS_LOCK = allocate_lock()
+PATH_CACHE_SIZE = 256
+
+
+def _cached(key):
+    """
+    Returns the FieldPath or plan cached for key, or None, moving it to
+    the end of _PATHS as the most recently used.
+    """
+    with _PATHS_LOCK:
+        value = _PATHS.pop(key, None)
+        if value is not None:
+            _PATHS[key] = value
+    return value
+
+
+def _cache(key, value):
+    """Caches value for key, evicting the least recently used if full."""
+    with _PATHS_LOCK:
+        while len(_PATHS) >= PATH_CACHE_SIZE:
+            _PATHS.popitem(last=False)
+        _PATHS[key] = value
+
+
 class FlowExpressionId(object):
     """
     The FlowExpressionId (fei for short) is an process expression identifier.
@@ -74,12 +446,36 @@ class FlowExpressionId(object):
 
     CHILD_SEP = '_'
 
+    # Feis are immutable, which lets the storage id and hash be cached
+    __slots__ = ('_h', '_sid', '_hash')
+
     def __init__(self, h):
-        self._h = deepcopy(h)
+        # fei values are all strings, so a shallow copy is enough
+        object.__setattr__(self, '_h', dict(h))
+        object.__setattr__(self, '_sid', None)
+        object.__setattr__(self, '_hash', None)
+
+    def __setattr__(self, attr, value):
+        raise AttributeError("FlowExpressionId is immutable")
 
     def __getitem__(self, key):
         return self._h[key]
 
+    def __eq__(self, other):
+        if not isinstance(other, FlowExpressionId):
+            return NotImplemented
+        return self is other or self._h == other._h
+
+    def __ne__(self, other):
+        if not isinstance(other, FlowExpressionId):
+            return NotImplemented
+        return not self == other
+
+    def __hash__(self):
+        if self._hash is None:
+            object.__setattr__(self, '_hash', hash(self.to_storage_id()))
+        return self._hash
+
     @property
     def expid(self): return self._h['expid']
 
@@ -93,10 +489,12 @@ class FlowExpressionId(object):
     def engine_id(self): return self._h['engine_id']
 
     def to_storage_id(self):
-        return "%s!%s!%s" % (
-            self._h['expid'],
-            self._h['subid'] if self._h['subid'] else self._h['sub_wfid'],
-            self._h['wfid'])
+        if self._sid is None:
+            object.__setattr__(self, '_sid', "%s!%s!%s" % (
+                self._h['expid'],
+                self._h.get('subid') or self._h.get('sub_wfid'),
+                self._h['wfid']))
+        return self._sid
 
     @property
     def child_id(self):
@@ -105,21 +503,25 @@ class FlowExpressionId(object):
         '0_5_7', the child_id will be '7'.
         """
         try:
-            return int(self._h.expid.split(self.CHILD_SEP)[-1])
+            return int(self._h['expid'].split(self.CHILD_SEP)[-1])
         except ValueError:
             return None
 
     def direct_child(self, other_fei):
+        """
+        Is other_fei the fei of a direct child of this expression? Ie is
+        its expid this one's with one more child id, as '0_5_7' is for
+        '0_5'.
+        """
 
         for k in ["sub_wfid", "wfid", "engine_id"]:
             if self._h[k] != other_fei[k]:
                 return False
 
-        pei = self.CHILD_SEP.join(list(reversed(
-            other_fei['expid'].split(self.CHILD_SEP))))
-        if pei == self._h['expid']:
-            return True
-        return False
+        expid = self._h['expid']
+        other_expid = other_fei['expid']
+        return (other_expid.rfind(self.CHILD_SEP) == len(expid) and
+                other_expid.startswith(expid))
 
 
 class Workitem(object):
@@ -128,14 +530,182 @@ class Workitem(object):
     (fields).
 
     The payload/fields MUST be JSONifiable.
+
+    A lazy workitem whose message body is lazy_threshold bytes or more,
+    by default LAZY_THRESHOLD, only decodes the fields when they are
+    first used (params and dispatched_at excepted), and if they are
+    never used the original json is sent back as it was received.
+    Otherwise the json of each top level field which wasn't changed is
+    copied into the reply, so a reply setting __result__ doesn't encode
+    the whole workitem again. A field counts as changed once it is
+    written to, or once a dict or list in it is handed out other than
+    through a DictAttrProxy.
+
+    A message body compressed as its content_encoding says is
+    decompressed first; see codec.compress().
+
+    With stream set a workitem which isn't lazy is decompressed and
+    decoded a chunk at a time, so the decompressed json is never held
+    whole, if ijson is installed; see codec.load().
     """
 
-    def __init__(self, msg):
-        self._h = json.loads(msg)
+    def __init__(self, msg, lazy=False, content_encoding=None,
+                 stream=False, lazy_threshold=None):
+        self._raw = None
+        # The json to_json() relays as it is, see _relay()
+        self._json = None
+        self._lazy_fields = None
+        self._field_spans = None
+        # Fields of a lazy workitem decoded while scanning it
+        self._values = None
+        # The top level fields which may have changed, None for all of
+        # them, or None if not tracked
+        self._dirty = None
+        self._proxies = {}
+        if stream and not lazy:
+            self._h = codec.load(codec.reader(msg, content_encoding))
+        else:
+            if content_encoding:
+                msg = codec.decompress(msg, content_encoding)
+            if lazy_threshold is None:
+                lazy_threshold = LAZY_THRESHOLD
+            if lazy and len(msg) >= lazy_threshold:
+                self._load_lazy(msg)
+            else:
+                self._h = codec.loads(msg)
         self._fei = FlowExpressionId(self._h['fei'])
 
+    def _load_lazy(self, msg):
+        """Decodes everything but the fields, remembering where they are."""
+        if bytes is not str and isinstance(msg, bytes):
+            # Python 3 message bodies need decoding before scanning
+            msg = msg.decode("utf-8")
+        self._raw = msg
+        self._dirty = set()
+        self._h = {}
+        self._params = None
+        for key, start, end, value in _scan_object(msg, 0, self._scan)[0]:
+            if key == "fields" and msg[start] == "{":
+                self._lazy_fields = (start, end)
+            else:
+                self._h[key] = value
+        if self._lazy_fields is not None:
+            self._params = self._values.get("params")
+
+    def _scan(self, s, start, key):
+        """
+        Decodes a top level value for _scan_object() but for the fields,
+        which are scanned one at a time, keeping those decoded on the
+        way, and params and dispatched_at, in _values.
+        """
+        if key != "fields" or s[start] != "{":
+            value, end = _raw_decode(s, start)
+            return end, value
+        members, end = _scan_object(s, start, _scan_field)
+        self._field_spans = {}
+        self._values = {}
+        for field, field_start, field_end, value in members:
+            self._field_spans[field] = (field_start, field_end)
+            if value is _SKIPPED:
+                # Of a duplicate field, the last one counts
+                self._values.pop(field, None)
+            else:
+                self._values[field] = value
+        return end, _SKIPPED
+
+    def _materialize(self):
+        """Decodes the fields of a lazy workitem."""
+        if self._lazy_fields is not None:
+            raw = self._raw
+            values = self._values
+            fields = {}
+            for key, (start, end) in self._field_spans.items():
+                if key in values:
+                    # params may already have been handed out and changed
+                    fields[key] = values[key]
+                else:
+                    fields[key] = codec.loads(raw[start:end])
+            self._h["fields"] = fields
+            self._lazy_fields = None
+            self._values = None
+
+    def _changed(self, key):
+        """
+        Records that the top level field key, or all fields if it is
+        None, may have been changed.
+        """
+        if self._dirty is not None:
+            self._dirty.add(key)
+
+    def _forget_raw(self):
+        """Stops copying fields from the original message."""
+        self._lazy_fields = None
+        self._values = None
+        self._raw = None
+        self._field_spans = None
+        self._dirty = None
+
+    def _relay(self, body):
+        """
+        Has to_json() return body, the json of the workitem as a worker
+        process sent it back, which the rest of the workitem knows nothing
+        of.
+        """
+        self._json = body
+
+    def to_json(self):
+        """
+        Returns the workitem encoded as json. The fields of a lazy workitem
+        which weren't changed are copied from the original message.
+        """
+        if self._json is not None:
+            return self._json
+        dirty = self._dirty
+        if dirty is None or None in dirty:
+            self._materialize()
+            self._forget_raw()
+            return codec.dumps(self._h)
+        if self._lazy_fields is not None:
+            if "params" in dirty:
+                self._materialize()
+            else:
+                start, end = self._lazy_fields
+                return "".join(self._header() + [self._raw[start:end], "}"])
+        fields = self._h.get("fields")
+        if fields is None:
+            return codec.dumps(self._h)
+        raw = self._raw
+        spans = self._field_spans
+        # Joined once, as the fields may be megabytes
+        parts = self._header()
+        separator = "{"
+        for key, value in fields.items():
+            span = spans.get(key)
+            if span is None or key in dirty:
+                value = codec.dumps(value)
+            else:
+                value = raw[span[0]:span[1]]
+            parts.extend((separator, codec.dumps(key), ": ", value))
+            separator = ", "
+        parts.append("}}" if fields else "{}}")
+        return "".join(parts)
+
+    def _header(self):
+        """
+        Returns the start of the workitem's json up to the value of its
+        fields.
+        """
+        header = codec.dumps(dict((key, value)
+                                  for key, value in self._h.items()
+                                  if key != "fields"))
+        if header == "{}":
+            return ['{"fields": ']
+        return [header[:-1], ', "fields": ']
+
     def to_h(self):
         "Returns the underlying Hash instance."
+        self._materialize()
+        self._forget_raw()
         return self._h
 
     @property
@@ -175,11 +745,11 @@ class Workitem(object):
     @property
     def fei(self):
         "Returns a Ruote::FlowExpressionId instance."
-        return FlowExpressionId(self._h['fei'])
+        return self._fei
 
     def dup(self):
         """Returns a complete copy of this workitem."""
-        return Workitem(json.dumps(self._h))
+        return Workitem(self.to_json())
 
     @property
     def participant_name(self):
@@ -196,9 +766,10 @@ class Workitem(object):
     @property
     def fields(self):
         "Returns the payload, ie the fields hash."
+        self._materialize()
         try:
-            return DictAttrProxy(self._h['fields'])
-        except:
+            return self._proxy('fields', self._h['fields'])
+        except KeyError:
             return DictAttrProxy({})
 
     @fields.setter
@@ -207,6 +778,7 @@ class Workitem(object):
         Sets all the fields in one sweep.
         Remember : the fields must be a JSONifiable hash.
         """
+        self._forget_raw()
         self._h['fields'] = fields
 
     @property
@@ -227,6 +799,8 @@ class Workitem(object):
     @property
     def dispatched_at(self):
         "When was this workitem dispatched ?"
+        if self._lazy_fields is not None:
+            return self._values.get("dispatched_at")
         return self.fields.dispatched_at
 
     @property
@@ -257,7 +831,7 @@ class Workitem(object):
 
     def hash(self):
         "Warning : hash is fei's hash."
-        return hash(self._h['fei'])
+        return hash(self._fei)
 
     def lookup(self, key, container_lookup=False):
         """
@@ -273,15 +847,113 @@ class Workitem(object):
         is equivalent to
            workitem.fields['toto']['address']
         """
-        ref = self._h['fields']
-        for k in key.split("."):
-            if k not in ref:
-                return None
-            ref = ref[k]
-        return ref
+        if type(key) is str:
+            # Splitting a short path costs less than finding its FieldPath
+            if self._lazy_fields is not None:
+                self._materialize()
+            ref = self._h['fields']
+            if "." not in key:
+                ref = ref.get(key)
+            else:
+                for k in key.split("."):
+                    if k not in ref:
+                        return None
+                    ref = ref[k]
+            if type(ref) in (dict, list):
+                self._changed(key.split(".", 1)[0])
+            return ref
+        if not isinstance(key, FieldPath):
+            key = self.compile_path(key)
+        return key.get(self)
 
     lf = lookup
 
+    @staticmethod
+    def compile_path(path):
+        """
+        Returns a FieldPath for a dotted path, for looking up, setting or
+        deleting the same field in many workitems:
+
+           city = Workitem.compile_path('customer.address.city')
+           city.get(workitem)
+
+        The PATH_CACHE_SIZE paths used most recently are cached.
+        """
+        compiled = _cached(path)
+        if compiled is None:
+            compiled = FieldPath(path)
+            _cache(path, compiled)
+        return compiled
+
+    def lookup_many(self, paths):
+        """
+        Returns a list with the value of each dotted path, like #lookup,
+        walking the parent fields several paths share only once.
+        """
+        refs = [self._fields_h()]
+        results = [None] * len(paths)
+        for index, shared, keys in self._lookup_plan(paths):
+            if len(refs) <= shared:
+                # The previous path went missing among the shared parents
+                continue
+            del refs[shared + 1:]
+            ref = refs[-1]
+            for k in keys:
+                if k not in ref:
+                    break
+                ref = ref[k]
+                refs.append(ref)
+            else:
+                results[index] = ref
+                if type(ref) in (dict, list):
+                    self._changed(self.compile_path(paths[index]).keys[0]
+                                  if not isinstance(paths[index], FieldPath)
+                                  else paths[index].keys[0])
+        return results
+
+    @classmethod
+    def _lookup_plan(cls, paths):
+        """
+        Returns (index, shared, keys) for each path in an order where paths
+        sharing parents are next to each other: shared is how many leading
+        keys it has in common with the previous path and keys the rest.
+        """
+        paths = tuple(path.path if isinstance(path, FieldPath) else path
+                      for path in paths)
+        plan = _cached(paths)
+        if plan is None:
+            compiled = [cls.compile_path(path).keys for path in paths]
+            plan = []
+            previous = ()
+            for index in sorted(range(len(compiled)),
+                                key=compiled.__getitem__):
+                keys = compiled[index]
+                shared = 0
+                limit = min(len(keys), len(previous))
+                while shared < limit and keys[shared] == previous[shared]:
+                    shared += 1
+                plan.append((index, shared, keys[shared:]))
+                previous = keys
+            _cache(paths, plan)
+        return plan
+
+    def _fields_h(self):
+        """Returns the fields hash itself."""
+        self._materialize()
+        return self._h['fields']
+
+    def _params_h(self):
+        """
+        Returns the params hash itself, or None, without decoding the
+        fields of a lazy workitem.
+        """
+        if self._lazy_fields is not None:
+            return self._params
+        fields = self._h.get('fields')
+        if not isinstance(fields, dict):
+            return None
+        return fields.get('params')
+
     def set_field(self, key, value):
         """Like #lookup allows for nested lookups, #set_field can be used
         to set sub fields directly.
@@ -295,18 +967,39 @@ class Workitem(object):
 
         """
 
-        ref = self._h['fields']
-        ks = key.split(".")
-        last = ks.pop()
-        for k in ks:
-            if k not in ref:
-                ref[k] = {}
-            ref = ref[k]
-        ref[last] = value
+        if type(key) is str:
+            if self._lazy_fields is not None:
+                self._materialize()
+            ref = self._h['fields']
+            if "." not in key:
+                if self._dirty is not None:
+                    self._dirty.add(key)
+                ref[key] = value
+                return
+            ks = key.split(".")
+            if self._dirty is not None:
+                self._dirty.add(ks[0])
+            last = ks.pop()
+            for k in ks:
+                if k not in ref:
+                    ref[k] = {}
+                ref = ref[k]
+            ref[last] = value
+            return
+        if not isinstance(key, FieldPath):
+            key = self.compile_path(key)
+        key.set(self, value)
+
+    def del_field(self, key):
+        """Removes a field given its dotted path, like #set_field."""
+        if not isinstance(key, FieldPath):
+            key = self.compile_path(key)
+        key.delete(self)
 
     @property
     def timed_out(self):
         "Shortcut for wi.fields['__timed_out__']"
+        self._materialize()
         return self._h['fields']['__timed_out__']
 
     # Note this is different to the ruote internal workitem which
@@ -360,11 +1053,28 @@ class Workitem(object):
         contains
            { 'ref' => 'toto', 'task' => 'x' }
         """
+        if self._lazy_fields is not None:
+            if self._params is None:
+                return DictAttrProxy({})
+            return self._proxy('params', self._params, 'params')
         try:
-            return DictAttrProxy(self._h['fields']['params'])
-        except:
+            return self._proxy('params', self._h['fields']['params'],
+                               'params')
+        except (KeyError, TypeError):
             return DictAttrProxy({})
 
+    def _proxy(self, name, d, key=None):
+        """
+        Returns the DictAttrProxy kept as name, if it still wraps d. It
+        records changes to the top level field key, or to any field if
+        key is None.
+        """
+        proxy = self._proxies.get(name)
+        if proxy is None or proxy._d is not d:
+            proxy = self._proxies[name] = DictAttrProxy(d, self._dirty, key)
+        return proxy
+
     def dump(self):
         "A useful and consistent dump format"
+        self._materialize()
         return json.dumps(self._h, sort_keys=True, indent=4)
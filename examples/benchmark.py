@@ -0,0 +1,564 @@
+#!/usr/bin/python
+"""
+Micro-benchmarks for the RuoteAMQP hot paths.
+
+  python examples/benchmark.py [section ...]
+
+Runs every section when none is named.
+"""
+from __future__ import print_function
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from copy import deepcopy
+from threading import Event
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from RuoteAMQP import codec
+from RuoteAMQP.dedup import ReplyCache, SQLiteReplyCache, reply_key
+from RuoteAMQP.localbroker import LocalBroker
+from RuoteAMQP.metrics import Metrics, ParticipantMetrics, clock
+from RuoteAMQP.outbox import Outbox
+from RuoteAMQP.participant import CancelToken, ConsumerPool, Participant, \
+        Processes
+from RuoteAMQP.scheduler import JobQueue, deadline_of, priority_of
+from RuoteAMQP.schema import Schema
+from RuoteAMQP.workitem import FlowExpressionId, Workitem
+
+# Approximate sizes in bytes of the generated workitems' fields
+SIZES = [1024, 64 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+
+
+def workitem_h(size):
+    """Returns a workitem hash with roughly size bytes of fields."""
+    packages = []
+    while len(packages) * 40 < size / 2:
+        packages.append({"name": "package-%d" % len(packages),
+                         "version": "1.%d" % len(packages)})
+    return {
+        "fei": {"engine_id": "engine", "wfid": "20100507-wagamama",
+                "subid": "6f7b2b0c4f3e4b3a8a2bd5f1e5b1e2d4",
+                "expid": "0_0_1"},
+        "participant_name": "builder",
+        "wf_name": "test",
+        "fields": {"params": {"ref": "toto", "task": "build"},
+                   "packages": packages,
+                   "log": "make: Entering directory\n" * (size // 50)},
+        }
+
+
+def best(func, number=None):
+    """Returns the best time per call of func in seconds."""
+    timer = timeit.Timer(func)
+    if number is None:
+        number = 1
+        while min(timer.repeat(1, number)) < 0.2 and number < 100000:
+            number *= 10
+    return min(timer.repeat(3, number)) / number
+
+
+def human(seconds):
+    """Formats a duration."""
+    for unit, scale in (("s", 1), ("ms", 1e3), ("us", 1e6)):
+        if seconds * scale >= 1:
+            return "%.2f%s" % (seconds * scale, unit)
+    return "%.0fns" % (seconds * 1e9)
+
+
+def bench_codec():
+    """Decode, mutate and encode cost for each json backend."""
+    print("%-10s %10s %10s %10s %10s" %
+          ("backend", "size", "decode", "mutate", "encode"))
+    for size in SIZES:
+        text = codec.get_codec().dumps(workitem_h(size))
+        for backend in codec.available():
+            decoded = backend.loads(text)
+
+            def mutate():
+                h = backend.loads(text)
+                h["fields"]["__result__"] = True
+                return backend.dumps(h)
+            print("%-10s %10d %10s %10s %10s" % (
+                backend.name, len(text),
+                human(best(lambda: backend.loads(text))),
+                human(best(mutate)),
+                human(best(lambda: backend.dumps(decoded)))))
+
+
+def bench_fei():
+    """Per-access cost of Workitem.fei and sid."""
+    h = workitem_h(1024)
+    # direct_child() compares the older sub_wfid too
+    h["fei"]["sub_wfid"] = h["fei"]["subid"]
+    wi = Workitem(codec.dumps(h))
+    fei = h["fei"]
+    child = dict(fei, expid="0_0_1_3")
+
+    # What every access cost when each one built a deep copied fei
+    def old_sid():
+        f = deepcopy(fei)
+        return "%s!%s!%s" % (f["expid"], f["subid"], f["wfid"])
+
+    for name, func in (("fei (deepcopy)", lambda: FlowExpressionId(
+                            deepcopy(fei))),
+                       ("fei", lambda: wi.fei),
+                       ("sid (deepcopy)", old_sid),
+                       ("sid", lambda: wi.sid),
+                       ("hash", lambda: hash(wi.fei)),
+                       ("direct_child", lambda: wi.fei.direct_child(child))):
+        print("%-16s %10s" % (name, human(best(func))))
+
+
+def bench_fields():
+    """Nested field access through Workitem.fields and params."""
+    h = workitem_h(1024)
+    h["fields"]["build"] = {"target": {"arch": "i586", "repo": "standard"}}
+    wi = Workitem(codec.dumps(h))
+
+    def write():
+        wi.fields.build.target.arch = "armv7el"
+    for name, func in (("fields.a.b.c", lambda: wi.fields.build.target.arch),
+                       ("fields.a.b.c =", write),
+                       ("params.x", lambda: wi.params.task)):
+        print("%-16s %10s" % (name, human(best(func))))
+
+
+def bench_paths():
+    """Field lookups and updates: as they used to be, now, compiled."""
+    h = workitem_h(1024)
+    h["fields"]["build"] = {"target": {"arch": "i586", "repo": "standard"},
+                            "project": "Trunk"}
+    wi = Workitem(codec.dumps(h))
+    plain = ["build", "status", "missing"]
+    # Not "build", which the dotted paths go through
+    plain_set = ["status", "result", "extra"]
+    dotted = ["build.target.arch", "build.target.repo", "build.project",
+              "params.task", "params.ref", "missing.field"]
+    compiled = [Workitem.compile_path(path) for path in dotted]
+
+    # Workitem.lookup() and set_field() before paths were compiled, which
+    # didn't yet record the fields handed out or set for lazy workitems
+    def old_lookup(key):
+        wi._materialize()
+        ref = wi._h['fields']
+        for k in key.split("."):
+            if k not in ref:
+                return None
+            ref = ref[k]
+        return ref
+
+    def old_set_field(key, value):
+        wi._materialize()
+        ref = wi._h['fields']
+        ks = key.split(".")
+        last = ks.pop()
+        for k in ks:
+            if k not in ref:
+                ref[k] = {}
+            ref = ref[k]
+        ref[last] = value
+
+    for name, func in (
+            ("old lookup", lambda: [old_lookup(key) for key in plain]),
+            ("lookup", lambda: [wi.lookup(key) for key in plain]),
+            ("old set_field", lambda: [old_set_field(key, 1)
+                                       for key in plain_set]),
+            ("set_field", lambda: [wi.set_field(key, 1)
+                                   for key in plain_set]),
+            ("old lookup.", lambda: [old_lookup(path) for path in dotted]),
+            ("lookup.", lambda: [wi.lookup(path) for path in dotted]),
+            ("compiled.", lambda: [path.get(wi) for path in compiled]),
+            ("lookup_many.", lambda: wi.lookup_many(compiled)),
+            ("old set_field.", lambda: [old_set_field(path, 1)
+                                        for path in dotted[:3]]),
+            ("set_field.", lambda: [wi.set_field(path, 1)
+                                    for path in dotted[:3]])):
+        print("%-16s %10s" % (name, human(best(func))))
+
+
+def bench_metrics():
+    """Instrumentation overhead per workitem."""
+    metrics = ParticipantMetrics(Metrics(), "bench")
+
+    # Everything a Participant records for one workitem
+    def workitem():
+        metrics.received.inc()
+        metrics.received_bytes.observe(1024)
+        metrics.decode.observe(clock() - clock())
+        metrics.in_flight.inc()
+        metrics.wait.observe(clock() - clock())
+        metrics.consume.observe(clock() - clock())
+        metrics.in_flight.dec()
+        metrics.acked.inc()
+        metrics.encode.observe(clock() - clock())
+        metrics.reply_bytes.observe(1024)
+        metrics.publish.observe(clock() - clock())
+    for name, func in (("counter", metrics.received.inc),
+                       ("histogram", lambda: metrics.consume.observe(0.01)),
+                       ("clock", clock),
+                       ("workitem", workitem)):
+        print("%-16s %10s" % (name, human(best(func))))
+
+
+def bench_compression():
+    """Wire size and cost of each compression algorithm."""
+    print("%-10s %10s %10s %8s %10s %10s" %
+          ("algorithm", "size", "wire", "ratio", "compress", "decompress"))
+    algorithms = []
+    for name, _ in codec.COMPRESSORS:
+        try:
+            algorithms.append(codec.compressor(name))
+        except ValueError:
+            continue
+    rand = random.Random(0)
+    for size in SIZES:
+        h = workitem_h(size)
+        # A build log repeats itself less than workitem_h()'s
+        h["fields"]["log"] = "".join(
+                "[%6d] CC src/%08x.o -O2 -g %s\n" % (
+                    i, rand.getrandbits(32),
+                    rand.choice(["", "warning: unused variable",
+                                 "note: in expansion of macro"]))
+                for i in range(size // 90))
+        body = codec.dumps(h).encode("utf-8")
+        for algorithm in algorithms:
+            compressed = algorithm.compress(body)
+            print("%-10s %10d %10d %7.1f%% %10s %10s" % (
+                algorithm.name, len(body), len(compressed),
+                100.0 * len(compressed) / len(body),
+                human(best(lambda: algorithm.compress(body))),
+                human(best(lambda: algorithm.decompress(compressed)))))
+
+
+def bench_memory():
+    """Peak memory decoding a workitem, as a multiple of its json size."""
+    try:
+        import tracemalloc
+    except ImportError:
+        print("needs tracemalloc (Python 3.4 or later)")
+        return
+    print("%-16s %10s %10s %10s" % ("mode", "size", "peak", "kept"))
+    for size in SIZES + [16 * 1024 * 1024]:
+        text = codec.dumps(workitem_h(size)).encode("utf-8")
+        deflated = codec.compress(text, "deflate", 0)[0]
+        for name, body, kwargs in (
+                ("loads", text, {}),
+                ("lazy", text, {"lazy": True}),
+                ("stream", text, {"stream": True}),
+                ("deflate", deflated, {"content_encoding": "deflate"}),
+                ("deflate stream", deflated,
+                 {"content_encoding": "deflate", "stream": True})):
+            tracemalloc.start()
+            wi = Workitem(body, **kwargs)
+            kept, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del wi
+            print("%-16s %10d %9.2fx %9.2fx" % (
+                name, len(text), float(peak) / len(text),
+                float(kept) / len(text)))
+    if codec.get_ijson() is None:
+        print("ijson isn't installed, stream decodes the whole text")
+
+
+def bench_delta():
+    """Encoding a reply which only set __result__, by workitem size."""
+    print("%10s %10s %10s %10s" % ("size", "full", "delta", "decode"))
+    for size in SIZES:
+        text = codec.dumps(workitem_h(size))
+        full = Workitem(text)
+        full.result = True
+        delta = Workitem(text, lazy=True)
+        # Decode the fields as consume() reading any field would
+        delta.fields.log
+        delta.result = True
+
+        def decode():
+            Workitem(text, lazy=True).fields.params
+        print("%10d %10s %10s %10s" % (
+            len(text), human(best(full.to_json)),
+            human(best(delta.to_json)), human(best(decode))))
+
+
+def bench_lazy():
+    """Decoding the whole body, a lazy workitem and its fields, by size."""
+    print("%10s %10s %10s %10s" % ("size", "loads", "lazy", "touched"))
+    for size in SIZES:
+        h = workitem_h(size)
+        # The engine emits the fields first, with the params last of them
+        fields = h.pop("fields")
+        fields["params"] = fields.pop("params")
+        body = (codec.dumps({"fields": fields})[:-1] + "," +
+                codec.dumps(h)[1:]).encode("utf-8")
+        print("%10d %10s %10s %10s" % (
+            len(body), human(best(lambda: Workitem(body))),
+            human(best(lambda: Workitem(body, lazy=True))),
+            human(best(lambda: Workitem(body, lazy=True).fields))))
+
+
+def bench_cancel():
+    """Per-workitem cost of a CancelToken, and delay freeing a consumer."""
+    class Waiter(Participant):
+        def consume(self):
+            self.cancelled.wait(10)
+    pool = ConsumerPool(Waiter("bench"), 1)
+    pool.start()
+    wi = Workitem(codec.dumps(workitem_h(1024)))
+    delays = []
+    for _ in range(200):
+        token = CancelToken()
+        finished = Event()
+        pool.submit(wi, token, lambda *result: finished.set())
+        # Let consume() start waiting
+        time.sleep(0.001)
+        started = clock()
+        token.cancel()
+        finished.wait()
+        delays.append(clock() - started)
+    pool.stop()
+    delays.sort()
+    for name, seconds in (("token", best(CancelToken)),
+                          ("cancel (median)", delays[len(delays) // 2]),
+                          ("cancel (max)", delays[-1])):
+        print("%-16s %10s" % (name, human(seconds)))
+
+
+def bench_dedup():
+    """Reply cache cost per workitem, in memory and in SQLite."""
+    h = workitem_h(64 * 1024)
+    # The engine adds it last
+    h["fields"]["dispatched_at"] = "2010-05-07 10:11:12.123456 UTC"
+    body = codec.dumps(h)
+    for name, wi in (("key", Workitem(body)),
+                     ("key (lazy)", Workitem(body, lazy=True))):
+        print("%-16s %10s" % (name, human(best(lambda: reply_key(wi)))))
+    tmp = tempfile.mkdtemp()
+    try:
+        caches = [("memory", ReplyCache()),
+                  ("sqlite", SQLiteReplyCache(os.path.join(tmp, "replies")))]
+        for name, cache in caches:
+            keys = ["%d" % i for i in range(100000)]
+            cache.put("hit", body)
+
+            def put():
+                cache.put(keys.pop(), body)
+            print("%-16s %10s" % (name + " put", human(best(put, 1000))))
+            print("%-16s %10s" % (name + " get",
+                                  human(best(lambda: cache.get("hit")))))
+        caches[1][1].close()
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_processes():
+    """CPU bound consume() in threads and in worker processes."""
+    class Spinner(Participant):
+        def consume(self):
+            if self.workitem.fields.spin:
+                sum(i * i for i in range(self.workitem.fields.spin))
+            self.workitem.result = True
+    size = max(2, multiprocessing.cpu_count())
+    print("%d consumers" % size)
+    for spin, count in ((0, 200), (200000, 8 * size)):
+        h = workitem_h(64 * 1024)
+        h["fields"]["spin"] = spin
+        body = codec.dumps(h)
+        for processes in (None, Processes()):
+            pool = ConsumerPool(Spinner("bench"), size, processes)
+            pool.start()
+            finished = Queue()
+            started = clock()
+            for _ in range(count):
+                pool.submit(Workitem(body, lazy=True), CancelToken(),
+                            lambda *result: finished.put(result),
+                            (body, None))
+            for _ in range(count):
+                finished.get()
+            elapsed = clock() - started
+            pool.stop()
+            print("%-22s %10s" % (
+                "%s spin=%d" % ("processes" if processes else "threads",
+                                spin), human(elapsed / count)))
+
+
+def bench_scheduling():
+    """Queueing cost, and the wait of an urgent workitem behind a backlog."""
+    h = workitem_h(1024)
+    h["fields"]["params"].update(priority=5, timeout="1h")
+    h["fields"]["dispatched_at"] = "2010-05-07 10:11:12.123456 UTC"
+    wi = Workitem(codec.dumps(h), lazy=True)
+    fifo, jobs = Queue(), JobQueue()
+
+    def scheduled():
+        jobs.put((wi, priority_of(wi), deadline_of(wi)))
+        jobs.get()
+    for name, func in (("fifo", lambda: (fifo.put(wi), fifo.get())),
+                       ("scheduled", scheduled)):
+        print("%-24s %10s" % (name, human(best(func))))
+
+    class Sleeper(Participant):
+        def consume(self):
+            time.sleep(0.001)
+    for scheduled in (False, True):
+        pool = ConsumerPool(Sleeper("bench"), 1, scheduled=scheduled)
+        finished = Queue()
+        for _ in range(100):
+            pool.submit(wi, CancelToken(), lambda *result: None)
+        started = clock()
+        pool.submit(wi, CancelToken(),
+                    lambda *result: finished.put(clock()), priority=1)
+        pool.start()
+        waited = finished.get() - started
+        pool.stop()
+        print("%-24s %10s" % ("urgent wait (%s)" % (
+            "scheduled" if scheduled else "fifo"), human(waited)))
+
+
+def bench_outbox():
+    """Storing replies in an Outbox, and publishing them from it."""
+    try:
+        import amqplib
+    except ImportError:
+        print("amqplib isn't installed")
+        return
+    body = codec.dumps(workitem_h(1024))
+    broker = LocalBroker()
+    chan = broker.connect().channel()
+    chan.queue_declare(queue="ruote_workitems")
+    # Keep the broker away while timing the puts
+    reachable = Event()
+
+    def connect():
+        reachable.wait()
+        return broker.connect()
+    tmp = tempfile.mkdtemp()
+    try:
+        outbox = Outbox(os.path.join(tmp, "outbox"), connect)
+        for name, func, count in (
+                ("put", lambda: outbox.put(body), 1),
+                ("put_many (100)",
+                 lambda: outbox.put_many([(body, None)] * 100), 100)):
+            print("%-16s %10s" % (name, human(best(func, 20) / count)))
+        stored = len(outbox)
+        started = clock()
+        reachable.set()
+        outbox.flush()
+        print("%-16s %10s" % ("publish", human(
+                (clock() - started) / stored)))
+        outbox.close()
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_schema():
+    """Checking fields and params against compiled schemas, and decoding."""
+    fields = Schema({
+        "type": "object", "required": ["packages", "log"],
+        "properties": {
+            "packages": {"type": "array", "items": {
+                "type": "object", "required": ["name", "version"],
+                "properties": {"name": {"type": "string", "minLength": 1},
+                               "version": {"type": "string",
+                                           "pattern": "^[0-9.]+$"}}}},
+            "log": {"type": "string"}}})
+    params = Schema({"type": "object", "required": ["task"],
+                     "properties": {"task": {"enum": ["build", "test"]}}})
+    for size in SIZES[:3]:
+        body = codec.dumps(workitem_h(size))
+        wi = Workitem(body)
+        lazy = Workitem(body, lazy=True)
+        for name, func in (
+                ("decode", lambda: Workitem(body)),
+                ("fields", lambda: fields.errors(wi._fields_h())),
+                ("params (lazy)", lambda: params.errors(lazy._params_h()))):
+            print("%-8s %-16s %10s" % (size, name, human(best(func))))
+
+
+# Modules which importing RuoteAMQP should leave to the code using them
+HEAVY_MODULES = ["amqplib", "urllib2", "urllib.request", "multiprocessing",
+                 "BaseHTTPServer", "http.server", "sqlite3", "ijson",
+                 "orjson", "ujson", "simplejson", "zstandard", "lz4"]
+
+# Seconds a bare "import RuoteAMQP" may take, at best of five
+IMPORT_BUDGET = 0.05
+
+IMPORT_SCRIPT = """
+import sys, time
+started = time.time()
+%s
+elapsed = time.time() - started
+print(elapsed)
+print(" ".join(name for name in %r if sys.modules.get(name) is not None))
+"""
+
+
+def bench_imports():
+    """Import time in a fresh interpreter, and heavy modules pulled in."""
+    # Fails if any heavy module is, or "import RuoteAMQP" is over budget
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+            [root] + [path for path in [env.get("PYTHONPATH")] if path])
+    ok = True
+    for statement in ("import RuoteAMQP",
+                      "from RuoteAMQP import Workitem",
+                      "from RuoteAMQP import Launcher",
+                      "from RuoteAMQP import Participant"):
+        times = []
+        for _ in range(5):
+            process = subprocess.Popen(
+                    [sys.executable, "-c",
+                     IMPORT_SCRIPT % (statement, HEAVY_MODULES)],
+                    stdout=subprocess.PIPE, env=env)
+            output = process.communicate()[0]
+            if process.returncode:
+                print("%-36s failed" % statement)
+                return False
+            lines = output.decode("utf-8").splitlines()
+            times.append(float(lines[0]))
+        heavy = lines[1] if len(lines) > 1 else ""
+        print("%-36s %10s %s" % (statement, human(min(times)),
+                                 heavy and "imports " + heavy))
+        if heavy:
+            ok = False
+        if statement == "import RuoteAMQP" and min(times) > IMPORT_BUDGET:
+            print("%-36s over the %s budget" % ("", human(IMPORT_BUDGET)))
+            ok = False
+    return ok
+
+
+SECTIONS = [("codec", bench_codec), ("fei", bench_fei),
+            ("fields", bench_fields), ("paths", bench_paths),
+            ("metrics", bench_metrics), ("compression", bench_compression),
+            ("memory", bench_memory), ("lazy", bench_lazy),
+            ("delta", bench_delta),
+            ("cancel", bench_cancel), ("dedup", bench_dedup),
+            ("processes", bench_processes),
+            ("scheduling", bench_scheduling), ("outbox", bench_outbox),
+            ("schema", bench_schema), ("imports", bench_imports)]
+
+
+def main(names):
+    failed = []
+    for name, section in SECTIONS:
+        if names and name not in names:
+            continue
+        print("== %s: %s" % (name, section.__doc__))
+        # Sections which check something return False when it fails
+        if section() is False:
+            failed.append(name)
+        print()
+    if failed:
+        sys.exit("Failed: %s" % ", ".join(failed))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,252 @@
+#!/usr/bin/python
+"""
+Load test of Launchers and Participants on an in-process LocalBroker.
+
+  python examples/loadtest.py [options]
+
+A stand-in engine turns each launch into a workitem for the
+participants' queue and times its reply. Reports the throughput, the
+latency from launch to reply and the peak memory of the process.
+"""
+from __future__ import print_function
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from RuoteAMQP import codec
+from RuoteAMQP.launcher import Launcher
+from RuoteAMQP.localbroker import LocalBroker, new_message
+from RuoteAMQP.outbox import Outbox
+from RuoteAMQP.participant import Participant
+
+QUEUE = "loadtest"
+
+
+class Engine(object):
+    """
+    Stands in for the ruote engine: dispatches a workitem for each
+    launch and records how long its reply took to come back.
+    """
+
+    def __init__(self, broker, expected):
+        self.expected = expected
+        self.latencies = []
+        self.errors = 0
+        self.done = threading.Event()
+        self._launches = 0
+        self._running = True
+        self._chan = broker.connect().channel()
+        self._chan.queue_declare(queue="ruote_workitems")
+        self._consumer_tag = self._chan.basic_consume(
+                queue="ruote_workitems", no_ack=True, callback=self._received)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._chan.basic_cancel(self._consumer_tag)
+        self._thread.join()
+        self._chan.close()
+
+    def _run(self):
+        while self._running:
+            self._chan.wait()
+
+    def _received(self, msg):
+        h = codec.loads(codec.decompress(
+                msg.body, msg.properties.get("content_encoding")))
+        if "definition" in h:
+            self._dispatch(h)
+            return
+        self.latencies.append(time.time() - h["fields"]["launched_at"])
+        if "__error__" in h["fields"]:
+            self.errors += 1
+        if len(self.latencies) >= self.expected:
+            self.done.set()
+
+    def _dispatch(self, launch):
+        self._launches += 1
+        fields = launch["fields"]
+        fields["params"] = {}
+        fields["dispatched_at"] = time.time()
+        workitem = {"fei": {"engine_id": "engine", "wfid": str(self._launches),
+                            "subid": "0", "expid": "0_0"},
+                    "participant_name": QUEUE, "wf_name": "loadtest",
+                    "fields": fields}
+        self._chan.basic_publish(new_message(codec.dumps(workitem)),
+                                 exchange="", routing_key=QUEUE)
+
+
+class Worker(Participant):
+    """Takes delay seconds over each workitem."""
+
+    delay = 0.0
+
+    def consume(self):
+        if self.delay:
+            time.sleep(self.delay)
+        self.workitem.result = True
+
+
+def launch(launcher, count, size, rate):
+    """
+    Launches count processes with size bytes of fields, rate a second
+    or as fast as it can if rate is 0.
+    """
+    payload = "x" * size
+    started = time.time()
+    for index in range(count):
+        if rate:
+            delay = started + index / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        launcher.launch("Ruote.process_definition { loadtest }",
+                        {"payload": payload, "launched_at": time.time()})
+
+
+def percentile(ordered, percent):
+    """Returns the percent percentile of a sorted list."""
+    return ordered[int(round(percent / 100.0 * (len(ordered) - 1)))]
+
+
+def human(seconds):
+    """Formats a duration."""
+    if seconds >= 1:
+        return "%.2fs" % seconds
+    return "%.2fms" % (seconds * 1e3)
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-l", "--launchers", type="int", default=1,
+                      help="launcher threads [%default]")
+    parser.add_option("-p", "--participants", type="int", default=1,
+                      help="participants consuming the queue [%default]")
+    parser.add_option("-c", "--concurrency", type="int", default=1,
+                      help="consumer threads of each participant [%default]")
+    parser.add_option("-n", "--workitems", type="int", default=1000,
+                      help="processes to launch [%default]")
+    parser.add_option("-s", "--size", type="int", default=1024,
+                      help="bytes of payload in each workitem [%default]")
+    parser.add_option("-r", "--rate", type="float", default=0,
+                      help="launches a second, 0 for a burst [%default]")
+    parser.add_option("-d", "--delay", type="float", default=0.0,
+                      help="seconds each consume() takes [%default]")
+    parser.add_option("--lazy", action="store_true",
+                      help="use lazy workitems")
+    parser.add_option("--reply-batch", type="int", default=0,
+                      help="acknowledge and reply in batches [%default]")
+    parser.add_option("--outbox", action="store_true",
+                      help="send replies and launches through an Outbox")
+    parser.add_option("--trace-memory", action="store_true",
+                      help="trace python allocations (slower)")
+    parser.add_option("--timeout", type="float", default=300,
+                      help="seconds to wait for the replies [%default]")
+    options = parser.parse_args(argv)[0]
+    logging.basicConfig(level=logging.WARNING)
+    if options.trace_memory:
+        if tracemalloc is None:
+            parser.error("--trace-memory needs Python 3.4 or later")
+        tracemalloc.start()
+
+    broker = LocalBroker()
+    engine = Engine(broker, options.workitems)
+    engine.start()
+    outbox = tmp = None
+    if options.outbox:
+        tmp = tempfile.mkdtemp()
+        outbox = Outbox(os.path.join(tmp, "outbox"), broker.connect)
+    participants = []
+    for _ in range(options.participants):
+        participant = Worker(QUEUE, concurrency=options.concurrency,
+                             lazy_workitems=options.lazy,
+                             reply_batch=options.reply_batch,
+                             connect=broker.connect, outbox=outbox)
+        participant.delay = options.delay
+        thread = threading.Thread(target=participant.run)
+        thread.daemon = True
+        thread.start()
+        participants.append((participant, thread))
+    # Launches for a queue nobody declared yet would be dropped
+    while any(participant._consumer_tag is None
+              for participant, _ in participants):
+        time.sleep(0.01)
+
+    started = time.time()
+    launchers = []
+    for index in range(options.launchers):
+        count = options.workitems // options.launchers
+        if index < options.workitems % options.launchers:
+            count += 1
+        if outbox is not None:
+            launcher = Launcher(outbox=outbox)
+        else:
+            launcher = Launcher(conn=broker.connect())
+        thread = threading.Thread(target=launch, args=(
+                launcher, count, options.size,
+                float(options.rate) / options.launchers))
+        thread.daemon = True
+        thread.start()
+        launchers.append((launcher, thread))
+    for _, thread in launchers:
+        thread.join()
+    launched = time.time() - started
+    engine.done.wait(options.timeout)
+    elapsed = time.time() - started
+
+    for participant, _ in participants:
+        participant.finish()
+    for participant, thread in participants:
+        thread.join()
+    for launcher, _ in launchers:
+        launcher.close()
+    if outbox is not None:
+        outbox.close()
+        shutil.rmtree(tmp)
+    engine.stop()
+
+    replies = len(engine.latencies)
+    print("launched %10d in %s (%.0f/s)" % (
+        options.workitems, human(launched), options.workitems / launched))
+    print("replies  %10d in %s (%.0f/s), %d errors" % (
+        replies, human(elapsed), replies / elapsed, engine.errors))
+    if replies:
+        ordered = sorted(engine.latencies)
+        print("latency  p50 %s  p90 %s  p99 %s  max %s" % tuple(
+            human(value) for value in (percentile(ordered, 50),
+                                       percentile(ordered, 90),
+                                       percentile(ordered, 99),
+                                       ordered[-1])))
+    if resource is not None:
+        # Kilobytes on Linux
+        print("memory   peak RSS %.1fMB" % (
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+    if options.trace_memory:
+        print("memory   peak traced %.1fMB" % (
+            tracemalloc.get_traced_memory()[1] / 1048576.0))
+    if replies < options.workitems:
+        print("%d replies missing after %.0fs" % (
+            options.workitems - replies, options.timeout))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,249 @@
+"""
+Tests of AsyncParticipant against an AsyncLocalConnection. Imported by
+test_aio, as Python 2 can't compile them.
+"""
+
+import asyncio
+import threading
+import unittest
+
+from RuoteAMQP import codec
+from RuoteAMQP.aio import AsyncParticipant
+from RuoteAMQP.aiolocalbroker import AsyncLocalConnection
+from RuoteAMQP.dedup import ReplyCache
+from RuoteAMQP.localbroker import LocalBroker
+from tests.support import TIMEOUT, cancel, workitem
+
+
+class AsyncEngine(object):
+    """
+    Stands in for the engine: publishes workitems to a queue and
+    collects the replies sent to ruote_workitems.
+    """
+
+    def __init__(self, broker, queue="test"):
+        self.broker = broker
+        self.queue = queue
+        self._replies = asyncio.Queue()
+        self._chan = None
+
+    async def start(self):
+        self._chan = await AsyncLocalConnection(self.broker).channel()
+        await self._chan.queue_declare(queue_name="ruote_workitems")
+        await self._chan.queue_declare(queue_name=self.queue, durable=True)
+        await self._chan.basic_consume(self._received,
+                                       queue_name="ruote_workitems",
+                                       no_ack=True)
+
+    async def _received(self, channel, body, envelope, properties):
+        await self._replies.put(codec.loads(codec.decompress(
+                body, properties.content_encoding)))
+
+    async def send(self, body):
+        """Publishes a workitem or a cancel to the participant's queue."""
+        await self._chan.basic_publish(body, exchange_name="",
+                                       routing_key=self.queue)
+
+    async def reply(self, timeout=TIMEOUT):
+        """Returns the next reply, failing if none comes in time."""
+        try:
+            return await asyncio.wait_for(self._replies.get(), timeout)
+        except asyncio.TimeoutError:
+            raise AssertionError("No reply within %ss" % timeout)
+
+    async def stop(self):
+        await self._chan.close()
+
+
+class Waiting(AsyncParticipant):
+    """
+    Waits in consume() for release to be set, unless told not to, and
+    records the workitems it consumed and saw cancelled.
+    """
+
+    def __init__(self, *args, **kwargs):
+        AsyncParticipant.__init__(self, *args, **kwargs)
+        self.started = asyncio.Event()
+        self.release = asyncio.Event()
+        self.consumed = []
+        self.cancelled_workitems = []
+
+    async def consume(self):
+        self.consumed.append(self.workitem.wfid)
+        if self.workitem.params.quick:
+            return
+        self.started.set()
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled_workitems.append(self.workitem.wfid)
+            raise
+        self.workitem.result = True
+
+
+class PlainWaiting(AsyncParticipant):
+    """A plain consume() waiting for its workitems to be cancelled."""
+
+    def __init__(self, *args, **kwargs):
+        AsyncParticipant.__init__(self, *args, **kwargs)
+        self.started = threading.Event()
+        self.cancelled_workitems = []
+
+    def consume(self):
+        if self.workitem.params.quick:
+            self.workitem.result = True
+            return
+        self.started.set()
+        if self.cancelled.wait(TIMEOUT):
+            self.cancelled_workitems.append(self.workitem.wfid)
+
+
+class Unencodable(AsyncParticipant):
+    """Leaves a field json can't encode in the workitems asking for it."""
+
+    async def consume(self):
+        if self.workitem.params.unencodable:
+            self.workitem.fields.bad = set([1])
+        self.workitem.result = True
+
+
+async def wait_until(predicate):
+    """Waits for predicate() to be true, failing if it takes too long."""
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + TIMEOUT
+    while not predicate():
+        if loop.time() > deadline:
+            raise AssertionError("Timed out")
+        await asyncio.sleep(0.01)
+
+
+class AsyncParticipantTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = LocalBroker()
+
+    def run_participant(self, cls, scenario, **kwargs):
+        """
+        Runs scenario(engine, participant) against a cls participant,
+        made in the event loop, then checks every message was
+        acknowledged.
+        """
+        participants = []
+
+        async def run():
+            participant = cls("test", conn=AsyncLocalConnection(self.broker),
+                              **kwargs)
+            participants.append(participant)
+            engine = AsyncEngine(self.broker)
+            await engine.start()
+            running = asyncio.ensure_future(participant.run())
+            try:
+                await wait_until(lambda: participant._consumer_tag)
+                await scenario(engine, participant)
+            finally:
+                await participant.finish()
+                await asyncio.wait_for(running, TIMEOUT)
+                await engine.stop()
+        asyncio.run(run())
+        self.assertEqual(self.broker.queue_size("test"), 0)
+        self.assertEqual(participants[0]._metrics.in_flight.value, 0)
+
+    def test_consume(self):
+        async def scenario(engine, participant):
+            participant.release.set()
+            for wfid in range(3):
+                await engine.send(workitem(wfid))
+            replies = [await engine.reply() for _ in range(3)]
+            self.assertEqual(
+                    sorted(reply["fei"]["wfid"] for reply in replies),
+                    ["0", "1", "2"])
+            for reply in replies:
+                self.assertTrue(reply["fields"]["__result__"])
+        self.run_participant(Waiting, scenario)
+
+    def test_plain_consume(self):
+        async def scenario(engine, participant):
+            for wfid in range(3):
+                await engine.send(workitem(wfid, {"quick": True}))
+            for _ in range(3):
+                self.assertTrue((await engine.reply())["fields"]["__result__"])
+        self.run_participant(PlainWaiting, scenario)
+
+    def test_cancel(self):
+        async def scenario(engine, participant):
+            await engine.send(workitem(1))
+            await asyncio.wait_for(participant.started.wait(), TIMEOUT)
+            await engine.send(cancel(1))
+            await engine.send(workitem(2, {"quick": True}))
+            # The cancelled workitem gets no reply
+            self.assertEqual((await engine.reply())["fei"]["wfid"], "2")
+            self.assertEqual(participant.cancelled_workitems, ["1"])
+        self.run_participant(Waiting, scenario)
+
+    def test_cancel_plain_consume(self):
+        async def scenario(engine, participant):
+            await engine.send(workitem(1))
+            loop = asyncio.get_event_loop()
+            started = await loop.run_in_executor(
+                    None, participant.started.wait, TIMEOUT)
+            self.assertTrue(started)
+            await engine.send(cancel(1))
+            await engine.send(workitem(2, {"quick": True}))
+            self.assertEqual((await engine.reply())["fei"]["wfid"], "2")
+            await wait_until(lambda: participant.cancelled_workitems)
+            self.assertEqual(participant.cancelled_workitems, ["1"])
+        self.run_participant(PlainWaiting, scenario)
+
+    def test_duplicate_while_consuming(self):
+        body = workitem(1, dispatched_at="2010-05-07 10:11:12.123456 UTC")
+
+        async def scenario(engine, participant):
+            await engine.send(body)
+            await asyncio.wait_for(participant.started.wait(), TIMEOUT)
+            await engine.send(body)
+            await wait_until(lambda: any(participant._duplicates.values()))
+            participant.release.set()
+            replies = [await engine.reply() for _ in range(2)]
+            self.assertEqual([reply["fei"]["wfid"] for reply in replies],
+                             ["1", "1"])
+            self.assertEqual(replies[0], replies[1])
+            self.assertEqual(participant.consumed, ["1"])
+            # Later duplicates are answered from the cache
+            await engine.send(body)
+            self.assertEqual(await engine.reply(), replies[0])
+            self.assertEqual(participant.consumed, ["1"])
+            self.assertEqual(participant._duplicates, {})
+        self.run_participant(Waiting, scenario, reply_cache=ReplyCache())
+
+    def test_unencodable_reply(self):
+        async def scenario(engine, participant):
+            for wfid in range(3):
+                await engine.send(workitem(wfid, {"unencodable": True},
+                                           keep=wfid))
+            await engine.send(workitem("good"))
+            replies = {}
+            for _ in range(4):
+                reply = await engine.reply()
+                replies[reply["fei"]["wfid"]] = reply
+            self.assertFalse(replies["good"].get("error"))
+            for wfid in range(3):
+                reply = replies[str(wfid)]
+                self.assertTrue("fields dropped from the reply: bad"
+                                in reply["error"])
+                self.assertEqual(reply["fields"]["keep"], wfid)
+                self.assertTrue(reply["fields"]["__result__"])
+                self.assertFalse("bad" in reply["fields"])
+        self.run_participant(Unencodable, scenario, concurrency=2)
+
+    def test_unencodable_reply_cached(self):
+        body = workitem(1, {"unencodable": True},
+                        dispatched_at="2010-05-07 10:11:12.123456 UTC")
+
+        async def scenario(engine, participant):
+            await engine.send(body)
+            first = await engine.reply()
+            self.assertTrue("fields dropped" in first["error"])
+            # A duplicate gets the same error reply
+            await engine.send(body)
+            self.assertEqual(await engine.reply(), first)
+        self.run_participant(Unencodable, scenario, reply_cache=ReplyCache())
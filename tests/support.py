@@ -0,0 +1,112 @@
+"""
+Helpers running participants against a LocalBroker.
+"""
+
+import threading
+import time
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+from RuoteAMQP import codec
+from RuoteAMQP.localbroker import LocalMessage
+
+# Seconds to wait for anything which should happen
+TIMEOUT = 10
+
+
+def workitem(wfid, params=None, **fields):
+    """Returns the json of a workitem for the participant "test"."""
+    fields["params"] = params or {}
+    return codec.dumps({
+        "fei": {"engine_id": "engine", "wfid": str(wfid), "subid": "0",
+                "expid": "0_0"},
+        "participant_name": "test", "wf_name": "test", "fields": fields})
+
+
+def cancel(wfid):
+    """Returns the json of the engine cancelling a workitem."""
+    h = codec.loads(workitem(wfid))
+    h["cancel"] = True
+    return codec.dumps(h)
+
+
+class Engine(object):
+    """
+    Stands in for the engine: publishes workitems to a queue and
+    collects the replies sent to ruote_workitems.
+    """
+
+    def __init__(self, broker, queue="test"):
+        self.queue = queue
+        self._replies = Queue()
+        # The content_encoding of each reply received
+        self.encodings = []
+        self._chan = broker.connect().channel()
+        self._chan.queue_declare(queue="ruote_workitems")
+        self._chan.queue_declare(queue=queue, durable=True,
+                                 auto_delete=False)
+        self._consumer_tag = self._chan.basic_consume(
+                queue="ruote_workitems", no_ack=True, callback=self._received)
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while self._running:
+            self._chan.wait()
+
+    def _received(self, msg):
+        encoding = msg.properties.get("content_encoding")
+        self.encodings.append(encoding)
+        self._replies.put(codec.loads(codec.decompress(msg.body, encoding)))
+
+    def send(self, body, content_encoding=None):
+        """Publishes a workitem or a cancel to the participant's queue."""
+        properties = {}
+        if content_encoding:
+            properties["content_encoding"] = content_encoding
+        self._chan.basic_publish(LocalMessage(body, properties), exchange="",
+                                 routing_key=self.queue)
+
+    def reply(self, timeout=TIMEOUT):
+        """Returns the next reply, failing if none comes in time."""
+        try:
+            return self._replies.get(timeout=timeout)
+        except Empty:
+            raise AssertionError("No reply within %ss" % timeout)
+
+    def replies(self, count, timeout=TIMEOUT):
+        """Returns the next count replies by wfid."""
+        replies = {}
+        for _ in range(count):
+            reply = self.reply(timeout)
+            replies[reply["fei"]["wfid"]] = reply
+        return replies
+
+    def stop(self):
+        self._running = False
+        self._chan.basic_cancel(self._consumer_tag)
+        self._thread.join(TIMEOUT)
+        self._chan.close()
+
+
+def start(participant):
+    """Runs participant in a thread once it is consuming, returning it."""
+    thread = threading.Thread(target=participant.run)
+    thread.daemon = True
+    thread.start()
+    deadline = time.time() + TIMEOUT
+    while participant._consumer_tag is None and time.time() < deadline:
+        time.sleep(0.01)
+    return thread
+
+
+def stop(participant, thread):
+    """Stops a participant started by start()."""
+    participant.finish()
+    thread.join(TIMEOUT)
+    if thread.is_alive():
+        raise AssertionError("Participant didn't stop")
@@ -0,0 +1,6 @@
+import sys
+
+# The tests are in a module of their own as only Python 3.7 and later can
+# compile them
+if sys.version_info >= (3, 7):
+    from tests.aio_cases import *  # noqa
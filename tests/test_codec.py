@@ -0,0 +1,110 @@
+import json
+import unittest
+
+from RuoteAMQP import codec
+
+
+def refusing(obj):
+    """Encodes like json, but refuses integers beyond 64 bits."""
+    text = json.dumps(obj)
+    if str(2 ** 70) in text:
+        raise OverflowError("int too big to convert")
+    return text
+
+
+class BackendTest(unittest.TestCase):
+    """The backends used encode what the json module does."""
+
+    VALUES = [{1: "int key", 2.5: "float key", None: "null key"},
+              {"huge": 2 ** 70, "negative": -2 ** 64, "big": 2 ** 63},
+              [{"nested": {7: [2 ** 100]}}]]
+
+    def test_awkward_values(self):
+        for backend in codec.available():
+            for value in self.VALUES:
+                self.assertEqual(json.loads(backend.dumps(value)),
+                                 json.loads(json.dumps(value)),
+                                 "%s: %r" % (backend.name, value))
+
+    def test_unencodable(self):
+        for backend in codec.available():
+            self.assertRaises(TypeError, backend.dumps, {"set": set([1])})
+
+    def test_refusing_backend(self):
+        self.assertFalse(
+                codec.Codec("refusing", json.loads, refusing).compatible())
+        self.assertTrue(codec.Codec("falling back", json.loads,
+                                    codec._falling_back(refusing))
+                        .compatible())
+
+    def test_huge_int_round_trip(self):
+        value = {"huge": 2 ** 70, "low": [-2 ** 63 - 1, 2 ** 64]}
+        for backend in codec.available():
+            text = backend.dumps(value)
+            for encoded in (text, text.encode("utf-8")):
+                self.assertEqual(json.dumps(backend.loads(encoded)),
+                                 json.dumps(value), backend.name)
+
+    def test_floating_backend(self):
+        def floating(text):
+            """Decodes like json, but integers beyond 64 bits as floats."""
+            return json.loads(text, parse_int=lambda digits: (
+                    int(digits) if abs(int(digits)) < 2 ** 63
+                    else float(digits)))
+        self.assertFalse(
+                codec.Codec("floating", floating, json.dumps).compatible())
+        self.assertTrue(codec.Codec("exact", codec._exact_loads(floating),
+                                    json.dumps).compatible())
+
+    def test_orjson_kept(self):
+        try:
+            import orjson
+        except ImportError:
+            raise unittest.SkipTest("orjson isn't installed")
+        self.assertEqual(codec.available()[0].name, "orjson")
+
+
+class LoadTest(unittest.TestCase):
+    """load() decodes a file object as loads() does its text."""
+
+    BODIES = [codec.SAMPLE,
+              json.dumps({"packages": [{"name": "package-%d" % index,
+                                        "size": index * 1.5,
+                                        "tags": [None, True, False, {}, []]}
+                                       for index in range(5000)],
+                          "log": u"caf\u00e9 \u20ac \"quoted\"\n" * 5000}),
+              "[]", '"text"', "-12.5e3"]
+
+    def setUp(self):
+        self.ijson = codec._ijson
+
+    def tearDown(self):
+        codec._ijson = self.ijson
+
+    def check(self):
+        for body in self.BODIES:
+            for algorithm in (None, "deflate"):
+                data, encoding = codec.compress(body.encode("utf-8"),
+                                                algorithm, 0)
+                loaded = codec.load(codec.reader(data, encoding))
+                self.assertTrue(codec._same(loaded, codec.loads(body)),
+                                body[:60])
+        for bad in ("", "{", '{"a": }', "[1] [2]"):
+            self.assertRaises(ValueError, codec.load,
+                              codec.reader(bad.encode("utf-8")))
+
+    def test_ijson(self):
+        if codec.get_ijson() is None:
+            raise unittest.SkipTest("ijson isn't installed")
+        self.check()
+        # Repeated keys are shared, as the json module does
+        packages = codec.load(codec.reader(self.BODIES[1]))["packages"]
+        self.assertTrue(list(packages[0])[0] is list(packages[1])[0])
+
+    def test_without_ijson(self):
+        codec._ijson = None
+        self.check()
+
+
+if __name__ == "__main__":
+    unittest.main()
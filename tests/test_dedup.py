@@ -0,0 +1,122 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from RuoteAMQP import dedup
+from RuoteAMQP.dedup import ReplyCache, SQLiteReplyCache, reply_key
+from RuoteAMQP.workitem import Workitem
+from tests.support import workitem
+
+
+class Clock(object):
+    """Stands in for the time module, with a time set by the test."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class ClockedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.time, dedup.time = dedup.time, self.clock
+
+    def tearDown(self):
+        dedup.time = self.time
+
+
+class ReplyKeyTest(unittest.TestCase):
+
+    def test_key(self):
+        self.assertEqual(
+                reply_key(Workitem(workitem("w", dispatched_at="then"))),
+                "0_0!0!w|then")
+        self.assertTrue(reply_key(Workitem(workitem("w"))) is None)
+
+
+class ReplyCacheTest(ClockedTestCase):
+
+    def test_ttl(self):
+        cache = ReplyCache(ttl=10)
+        cache.put("a", b"reply", "deflate")
+        cache.put("b", None)
+        self.clock.now += 10
+        self.assertEqual(cache.get("a"), (b"reply", "deflate"))
+        self.assertEqual(cache.get("b"), (None, None))
+        self.clock.now += 1
+        self.assertTrue(cache.get("a") is None)
+
+    def test_lru(self):
+        cache = ReplyCache(max_entries=3)
+        for key in "abc":
+            cache.put(key, key)
+        # Used, so the least recently used is b
+        cache.get("a")
+        cache.put("d", "d")
+        self.assertEqual(len(cache), 3)
+        self.assertTrue(cache.get("b") is None)
+        self.assertEqual([cache.get(key) for key in "acd"],
+                         [("a", None), ("c", None), ("d", None)])
+        # Put again, c is now the most recent
+        cache.put("c", "c2")
+        cache.put("e", "e")
+        self.assertTrue(cache.get("a") is None)
+        self.assertEqual(cache.get("c"), ("c2", None))
+
+
+class SQLiteReplyCacheTest(ClockedTestCase):
+
+    def setUp(self):
+        ClockedTestCase.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "replies.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        ClockedTestCase.tearDown(self)
+
+    def test_ttl(self):
+        cache = SQLiteReplyCache(self.path, ttl=10)
+        cache.put("a", u"reply \u20ac", "deflate")
+        cache.put("b", None)
+        self.clock.now += 10
+        self.assertEqual(cache.get("a"),
+                         (u"reply \u20ac".encode("utf-8"), "deflate"))
+        self.assertEqual(cache.get("b"), (None, None))
+        self.clock.now += 1
+        self.assertTrue(cache.get("a") is None)
+        # Expired replies are only deleted when pruning
+        self.assertEqual(len(cache), 2)
+        cache.PRUNE_INTERVAL = 1
+        cache.put("c", b"c")
+        self.assertEqual(len(cache), 1)
+        cache.close()
+
+    def test_oldest_dropped(self):
+        cache = SQLiteReplyCache(self.path, max_entries=3)
+        cache.PRUNE_INTERVAL = 5
+        for index in range(5):
+            self.clock.now += 1
+            cache.put(str(index), b"reply")
+        # Pruned on the fifth put, however recently the first were read
+        self.assertEqual(len(cache), 3)
+        self.assertEqual([cache.get(str(index)) is None
+                          for index in range(5)],
+                         [True, True, False, False, False])
+        cache.close()
+
+    def test_survives_restart(self):
+        cache = SQLiteReplyCache(self.path)
+        cache.put("a", b"reply", "zstd")
+        cache.close()
+        cache = SQLiteReplyCache(self.path)
+        self.assertEqual(cache.get("a"), (b"reply", "zstd"))
+        cache.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+import threading
+import time
+import unittest
+
+from RuoteAMQP.host import ParticipantHost
+from RuoteAMQP.localbroker import LocalBroker, LocalMessage
+from RuoteAMQP.participant import Participant
+from RuoteAMQP.pool import ConnectionPool
+from tests.support import TIMEOUT, Engine, workitem
+
+
+class Named(Participant):
+    """Puts the name of its queue in the workitem, once let through."""
+
+    def __init__(self, *args, **kwargs):
+        Participant.__init__(self, *args, **kwargs)
+        self.consuming = threading.Event()
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def consume(self):
+        self.consuming.set()
+        self.gate.wait(TIMEOUT)
+        self.workitem.fields.queue = self._queue
+        self.workitem.result = True
+
+
+class ParticipantHostTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = LocalBroker()
+        self.engine = Engine(self.broker, "first")
+        self.pool = ConnectionPool(connect=self.broker.connect,
+                                   channels_per_connection=2)
+        self.host = ParticipantHost(connection_pool=self.pool)
+        self.host.POLL_INTERVAL = 0.05
+        self.first = self.host.register(Named, "first", concurrency=2)
+        self.second = self.host.register(Named, "second")
+        self.thread = threading.Thread(target=self.host.run)
+        self.thread.daemon = True
+        self.thread.start()
+        deadline = time.time() + TIMEOUT
+        while (time.time() < deadline and
+               not (self.first._running and self.second._running)):
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.host.finish()
+        self.thread.join(TIMEOUT)
+        self.engine.stop()
+        self.pool.close()
+
+    def send(self, queue, wfid):
+        self.engine._chan.basic_publish(LocalMessage(workitem(wfid)),
+                                        exchange="", routing_key=queue)
+
+    def stopped(self):
+        self.host.finish()
+        self.thread.join(TIMEOUT)
+        return not self.thread.is_alive()
+
+    def test_shared_connection(self):
+        self.assertTrue(self.first._chan.connection is
+                        self.second._chan.connection)
+        for wfid in range(10):
+            self.send("first" if wfid % 2 else "second", wfid)
+        replies = self.engine.replies(10)
+        for wfid in range(10):
+            self.assertEqual(replies[str(wfid)]["fields"]["queue"],
+                             "first" if wfid % 2 else "second")
+        self.assertEqual(self.broker.queue_size("first"), 0)
+        self.assertEqual(self.broker.queue_size("second"), 0)
+
+    def test_slow_participant(self):
+        self.first.gate.clear()
+        for wfid in range(3):
+            self.send("first", "first%d" % wfid)
+        self.send("second", "second")
+        # Dispatched while the first participant's consumers are busy
+        self.assertEqual(self.engine.reply()["fei"]["wfid"], "second")
+        self.first.gate.set()
+        self.assertEqual(sorted(self.engine.replies(3)),
+                         ["first0", "first1", "first2"])
+
+    def test_participant_finish(self):
+        self.first.finish()
+        deadline = time.time() + TIMEOUT
+        while self.first._consumer_tag is not None and \
+                time.time() < deadline:
+            time.sleep(0.01)
+        self.send("first", "first")
+        self.send("second", "second")
+        self.assertEqual(self.engine.reply()["fei"]["wfid"], "second")
+        self.assertEqual(self.broker.queue_size("first"), 1)
+        self.assertTrue(self.thread.is_alive())
+
+    def test_shutdown(self):
+        self.first.gate.clear()
+        self.send("first", "busy")
+        self.assertTrue(self.first.consuming.wait(TIMEOUT))
+        chans = [self.first._chan, self.second._chan]
+        self.host.finish()
+        # The workitem being consumed is finished before run() returns
+        time.sleep(0.2)
+        self.assertTrue(self.thread.is_alive())
+        self.first.gate.set()
+        self.assertTrue(self.stopped())
+        self.assertEqual(self.engine.reply()["fei"]["wfid"], "busy")
+        self.assertEqual(self.broker.queue_size("first"), 0)
+        self.assertEqual([chan.is_open for chan in chans], [False, False])
+        self.assertTrue(self.first._chan is None)
+        # The pool was passed in, so stays open
+        self.assertTrue(self.pool.channel().is_open)
+
+
+if __name__ == "__main__":
+    unittest.main()
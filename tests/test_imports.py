@@ -0,0 +1,57 @@
+import os
+import subprocess
+import sys
+import unittest
+
+# Modules the package defers until they are needed
+HEAVY_MODULES = ["amqplib", "multiprocessing", "sqlite3", "ijson", "orjson",
+                 "ujson", "simplejson", "zstandard", "lz4", "urllib2",
+                 "urllib.request", "BaseHTTPServer", "http.server",
+                 "threading"]
+
+SCRIPT = """
+import sys
+%s
+print(" ".join(name for name in %r if sys.modules.get(name) is not None))
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def heavy_modules(statement):
+    """
+    Returns the heavy modules a fresh interpreter has imported once it
+    has run statement.
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+            [ROOT] + [path for path in [env.get("PYTHONPATH")] if path])
+    process = subprocess.Popen(
+            [sys.executable, "-c", SCRIPT % (statement, HEAVY_MODULES)],
+            stdout=subprocess.PIPE, env=env)
+    output = process.communicate()[0]
+    if process.returncode:
+        raise AssertionError("%r failed" % statement)
+    return output.decode("utf-8").split()
+
+
+class ImportTest(unittest.TestCase):
+
+    def test_package(self):
+        self.assertEqual(heavy_modules("import RuoteAMQP"), [])
+
+    def test_workitem(self):
+        self.assertEqual(heavy_modules("from RuoteAMQP import Workitem"), [])
+
+    def test_participant(self):
+        # amqplib is only imported once the participant connects, but
+        # its consumer threads are defined with the module
+        self.assertEqual(heavy_modules("from RuoteAMQP import Participant, "
+                                       "Launcher"), ["threading"])
+
+    def test_codec_on_first_use(self):
+        self.assertEqual(heavy_modules("from RuoteAMQP import codec"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
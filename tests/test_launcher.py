@@ -0,0 +1,130 @@
+import unittest
+
+from RuoteAMQP.launcher import Launcher
+from RuoteAMQP.localbroker import LocalBroker
+from RuoteAMQP.pool import ConnectionPool
+from RuoteAMQP.schema import SchemaError
+
+SCHEMA = {"type": "object", "required": ["image"]}
+
+
+def definitions(count, read=None):
+    """
+    Yields count definitions, with bad fields for every tenth, counting
+    those read in read.
+    """
+    for index in range(count):
+        if read is not None:
+            read.append(index)
+        if index % 10 == 9:
+            yield ("Ruote.process_definition {}", ["not", "a", "dict"], None)
+        else:
+            yield ("Ruote.process_definition {}", {"image": index}, None)
+
+
+class LaunchManyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = LocalBroker()
+        self.broker.connect().channel().queue_declare(queue="ruote_workitems")
+
+    def launched(self):
+        return self.broker.queue_size("ruote_workitems")
+
+    def test_failed_definitions(self):
+        launcher = Launcher(conn=self.broker.connect(), fields_schema=SCHEMA)
+        report = launcher.launch_many(
+                [("a", {"image": 1}, None), ("b", {"image": 1}, "variables"),
+                 ("c", {"other": 1}, None), ("d", {"image": 2}, None)],
+                batch_size=2)
+        self.assertEqual(report.sent, 2)
+        self.assertEqual([index for index, _ in report.failed], [1, 2])
+        self.assertTrue(isinstance(report.failed[0][1], TypeError))
+        self.assertTrue(isinstance(report.failed[1][1], SchemaError))
+        self.assertTrue(report.unreached is None)
+        self.assertEqual(self.launched(), 2)
+
+    def test_generator(self):
+        read = []
+        launcher = Launcher(conn=self.broker.connect())
+        report = launcher.launch_many(definitions(250, read), batch_size=40)
+        self.assertEqual(report.sent, 225)
+        self.assertEqual([index for index, _ in report.failed],
+                         list(range(9, 250, 10)))
+        self.assertEqual(len(read), 250)
+        self.assertEqual(self.launched(), 225)
+
+    def test_confirm(self):
+        launcher = Launcher(conn=self.broker.connect())
+        for _ in range(2):
+            report = launcher.launch_many(definitions(50), batch_size=20,
+                                          confirm=True)
+            self.assertEqual(report.sent, 45)
+        self.assertEqual(self.launched(), 90)
+        tx_chan = launcher._tx_chan
+        launcher.close()
+        self.assertFalse(tx_chan.is_open)
+
+    def test_publishing_error_stops_run(self):
+        read = []
+        launcher = Launcher(conn=self.broker.connect())
+
+        def failing():
+            for index in range(100):
+                read.append(index)
+                if index == 30:
+                    launcher._tx_chan.close()
+                yield ("Ruote.process_definition {}", {"image": index}, None)
+        report = launcher.launch_many(failing(), batch_size=20, confirm=True)
+        self.assertEqual(report.sent, 20)
+        self.assertEqual(report.unreached, 40)
+        self.assertEqual(len(read), 40)
+        self.assertEqual([index for index, _ in report.failed],
+                         list(range(20, 40)))
+        self.assertEqual(self.launched(), 20)
+        # A new channel is opened for the next run
+        self.assertEqual(launcher.launch_many(definitions(10),
+                                              confirm=True).sent, 9)
+
+
+class PooledLaunchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = LocalBroker()
+        self.broker.connect().channel().queue_declare(queue="ruote_workitems")
+        self.pool = ConnectionPool(connect=self.broker.connect,
+                                   channels_per_connection=1)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_confirm(self):
+        launcher = Launcher(connection_pool=self.pool)
+        report = launcher.launch_many(definitions(50), batch_size=20,
+                                      confirm=True)
+        self.assertEqual(report.sent, 45)
+        self.assertEqual(self.broker.queue_size("ruote_workitems"), 45)
+        # Locked as the connection of its own channel
+        tx_chan = launcher._tx_chan
+        self.assertFalse(tx_chan.connection is launcher.chan.connection)
+        self.assertTrue(launcher._tx_lock is self.pool.lock(tx_chan))
+        chan = launcher.chan
+        launcher.close()
+        self.assertFalse(tx_chan.is_open)
+        # The plain channel goes back to the pool
+        self.assertTrue(self.pool.channel() is chan)
+
+    def test_failed_channel_discarded(self):
+        launcher = Launcher(connection_pool=self.pool)
+        launcher.launch_many(definitions(10), confirm=True)
+        tx_chan = launcher._tx_chan
+        tx_chan.close()
+        report = launcher.launch_many(definitions(10), confirm=True)
+        self.assertEqual(report.sent, 0)
+        self.assertTrue(tx_chan.connection.transport is None)
+        self.assertEqual(launcher.launch_many(definitions(10),
+                                              confirm=True).sent, 9)
+
+
+if __name__ == "__main__":
+    unittest.main()
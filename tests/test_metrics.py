@@ -0,0 +1,116 @@
+import socket
+import unittest
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
+from RuoteAMQP.metrics import MemoryExporter, Metrics, PrometheusExporter, \
+        StatsdExporter
+
+
+def registry():
+    """Returns a Metrics registry with one instrument of each kind."""
+    metrics = Metrics()
+    metrics.counter("received", "Messages received", queue="build").inc(3)
+    metrics.gauge("in_flight", queue="build").set(2)
+    histogram = metrics.histogram("consume_seconds", "Time in consume()",
+                                  buckets=(0.5, 1), queue="build")
+    histogram.observe(0.25)
+    histogram.observe(2)
+    return metrics
+
+
+class PrometheusExporterTest(unittest.TestCase):
+
+    def test_render(self):
+        self.assertEqual(PrometheusExporter(registry()).render(), "\n".join([
+            '# HELP ruote_amqp_consume_seconds Time in consume()',
+            '# TYPE ruote_amqp_consume_seconds histogram',
+            'ruote_amqp_consume_seconds_bucket{le="0.5",queue="build"} 1',
+            'ruote_amqp_consume_seconds_bucket{le="1",queue="build"} 1',
+            'ruote_amqp_consume_seconds_bucket{le="+Inf",queue="build"} 2',
+            'ruote_amqp_consume_seconds_sum{queue="build"} 2.25',
+            'ruote_amqp_consume_seconds_count{queue="build"} 2',
+            '# TYPE ruote_amqp_in_flight gauge',
+            'ruote_amqp_in_flight{queue="build"} 2',
+            '# HELP ruote_amqp_received Messages received',
+            '# TYPE ruote_amqp_received counter',
+            'ruote_amqp_received{queue="build"} 3', '']))
+
+    def test_label_escaping(self):
+        metrics = Metrics(prefix="")
+        metrics.counter("errors", queue='a "b"\\c\nd').inc()
+        self.assertEqual(PrometheusExporter(metrics).render().splitlines(),
+                         ['# TYPE errors counter',
+                          'errors{queue="a \\"b\\"\\\\c\\nd"} 1'])
+
+    def test_serve(self):
+        exporter = PrometheusExporter(registry())
+        server = exporter.serve(0, "127.0.0.1")
+        try:
+            response = urlopen("http://127.0.0.1:%d/metrics" %
+                               server.server_address[1])
+            self.assertEqual(response.info()["Content-Type"],
+                             exporter.content_type)
+            self.assertEqual(response.read().decode("utf-8"),
+                             exporter.render())
+        finally:
+            exporter.close()
+
+
+class StatsdExporterTest(unittest.TestCase):
+
+    def test_lines(self):
+        metrics = registry()
+        exporter = StatsdExporter(metrics)
+        self.assertEqual(exporter.lines(), [
+            "ruote_amqp_consume_seconds.build.count:2|c",
+            "ruote_amqp_consume_seconds.build.sum:2.25|c",
+            "ruote_amqp_in_flight.build:2|g",
+            "ruote_amqp_received.build:3|c"])
+        # Counters are sent as their increase, and only if they changed
+        metrics.counter("received", queue="build").inc(2)
+        self.assertEqual(exporter.lines(), [
+            "ruote_amqp_in_flight.build:2|g",
+            "ruote_amqp_received.build:2|c"])
+
+    def test_dotted_label(self):
+        metrics = Metrics(prefix="")
+        metrics.gauge("up", host="a.b").set(1)
+        self.assertEqual(StatsdExporter(metrics).lines(), ["up.a_b:1|g"])
+
+    def test_flush(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("127.0.0.1", 0))
+        sock.settimeout(5)
+        metrics = Metrics(prefix="")
+        for index in range(100):
+            metrics.counter("counter_%03d" % index).inc()
+        exporter = StatsdExporter(metrics, "127.0.0.1",
+                                  sock.getsockname()[1])
+        try:
+            exporter.flush()
+            lines = []
+            while len(lines) < 100:
+                datagram = sock.recv(65536)
+                self.assertTrue(len(datagram) <= exporter.MAX_DATAGRAM)
+                lines.extend(datagram.decode("utf-8").split("\n"))
+        finally:
+            sock.close()
+        self.assertEqual(lines, ["counter_%03d:1|c" % index
+                                 for index in range(100)])
+
+
+class MemoryExporterTest(unittest.TestCase):
+
+    def test_value(self):
+        exporter = MemoryExporter(registry())
+        self.assertEqual(exporter.value("received", queue="build"), 3)
+        self.assertEqual(exporter.value("consume_seconds", queue="build"),
+                         (2, 2.25))
+        self.assertTrue(exporter.value("received", queue="other") is None)
+
+
+if __name__ == "__main__":
+    unittest.main()
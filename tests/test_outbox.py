@@ -0,0 +1,142 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from RuoteAMQP.localbroker import LocalBroker
+from RuoteAMQP.outbox import Outbox
+from RuoteAMQP.participant import Participant
+from tests.support import TIMEOUT, Engine, start, stop, workitem
+
+
+class QuickOutbox(Outbox):
+    """Retries without the usual delay."""
+
+    RETRY_MIN_DELAY = 0.01
+    RETRY_MAX_DELAY = 0.01
+
+
+class FlakyBroker(object):
+    """
+    A LocalBroker which refuses connections while down, and fails the
+    next commits of its channels while failing_commits is above zero.
+    """
+
+    def __init__(self):
+        self.broker = LocalBroker()
+        self.down = False
+        self.failing_commits = 0
+        self.connects = 0
+
+    def connect(self):
+        if self.down:
+            raise IOError("Connection refused")
+        self.connects += 1
+        conn = self.broker.connect()
+        channel = conn.channel
+
+        def flaky_channel():
+            chan = channel()
+            commit = chan.tx_commit
+
+            def tx_commit():
+                if self.failing_commits:
+                    self.failing_commits -= 1
+                    chan.close()
+                    raise IOError("Connection reset")
+                commit()
+            chan.tx_commit = tx_commit
+            return chan
+        conn.channel = flaky_channel
+        return conn
+
+
+class OutboxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "outbox.db")
+        self.flaky = FlakyBroker()
+        self.engine = Engine(self.flaky.broker)
+
+    def tearDown(self):
+        self.engine.stop()
+        shutil.rmtree(self.dir)
+
+    def put(self, outbox, wfids):
+        for wfid in wfids:
+            outbox.put(workitem(wfid))
+
+    def wfids(self, count):
+        """The wfids of the next count replies, in order."""
+        return [self.engine.reply()["fei"]["wfid"] for _ in range(count)]
+
+    def test_broker_down(self):
+        self.flaky.down = True
+        outbox = QuickOutbox(self.path, self.flaky.connect, batch_size=3)
+        try:
+            self.put(outbox, range(7))
+            self.assertFalse(outbox.flush(0.1))
+            self.assertEqual(len(outbox), 7)
+            self.flaky.down = False
+            self.assertTrue(outbox.flush(TIMEOUT))
+        finally:
+            outbox.close()
+        self.assertEqual(self.wfids(7), [str(wfid) for wfid in range(7)])
+
+    def test_failed_commit_replayed(self):
+        self.flaky.failing_commits = 2
+        outbox = QuickOutbox(self.path, self.flaky.connect, batch_size=4)
+        try:
+            self.put(outbox, range(10))
+            self.assertTrue(outbox.flush(TIMEOUT))
+        finally:
+            outbox.close()
+        # Each failed batch was published again, on a new connection
+        self.assertEqual(self.wfids(10), [str(wfid) for wfid in range(10)])
+        self.assertEqual(self.flaky.connects, 3)
+        self.assertEqual(self.flaky.broker.queue_size("ruote_workitems"), 0)
+
+    def test_replayed_after_restart(self):
+        self.flaky.down = True
+        outbox = QuickOutbox(self.path, self.flaky.connect)
+        self.put(outbox, range(3))
+        outbox.close()
+        self.assertEqual(self.flaky.connects, 0)
+        self.flaky.down = False
+        outbox = QuickOutbox(self.path, self.flaky.connect)
+        try:
+            self.assertTrue(outbox.flush(TIMEOUT))
+        finally:
+            outbox.close()
+        self.assertEqual(self.wfids(3), ["0", "1", "2"])
+
+    def test_participant_replies(self):
+        self.flaky.down = True
+        outbox = QuickOutbox(self.path, self.flaky.connect)
+        broker = self.flaky.broker
+        participant = Participant("test", connect=broker.connect,
+                                  outbox=outbox)
+        thread = start(participant)
+        try:
+            for wfid in range(3):
+                self.engine.send(workitem(wfid))
+            deadline = time.time() + TIMEOUT
+            while (participant._metrics.acked.value < 3 and
+                   time.time() < deadline):
+                time.sleep(0.01)
+            self.assertEqual(len(outbox), 3)
+            # Acknowledged once their replies are in the outbox
+            self.assertEqual(participant._metrics.acked.value, 3)
+            self.assertEqual(broker.queue_size("test"), 0)
+            self.flaky.down = False
+            self.assertTrue(outbox.flush(TIMEOUT))
+        finally:
+            stop(participant, thread)
+            outbox.close()
+        self.assertEqual(sorted(self.wfids(3)), ["0", "1", "2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
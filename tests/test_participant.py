@@ -0,0 +1,338 @@
+import os
+import threading
+import time
+import unittest
+
+from RuoteAMQP import codec
+from RuoteAMQP.localbroker import LocalBroker
+from RuoteAMQP.metrics import MemoryExporter, Metrics
+from RuoteAMQP.participant import ForkServer, Participant, Processes
+from RuoteAMQP.workitem import Workitem
+from tests.support import TIMEOUT, Engine, cancel, start, stop, workitem
+
+
+class Unencodable(Participant):
+    """Leaves a field json can't encode in the workitems asking for it."""
+
+    def consume(self):
+        if self.workitem.params.unencodable:
+            self.workitem.fields.bad = set([1])
+        self.workitem.result = True
+
+
+class UnencodableReplyTest(unittest.TestCase):
+
+    def run_participant(self, **kwargs):
+        broker = LocalBroker()
+        engine = Engine(broker)
+        participant = Unencodable("test", connect=broker.connect, **kwargs)
+        thread = start(participant)
+        try:
+            # More than the prefetch window, which a lost ack would fill
+            for wfid in range(4):
+                engine.send(workitem(wfid, {"unencodable": True}, keep=wfid))
+            engine.send(workitem("good"))
+            replies = engine.replies(5)
+        finally:
+            stop(participant, thread)
+            engine.stop()
+        self.assertEqual(broker.queue_size("test"), 0)
+        return replies
+
+    def check(self, replies):
+        self.assertTrue(replies["good"]["fields"]["__result__"])
+        self.assertFalse(replies["good"].get("error"))
+        for wfid in range(4):
+            reply = replies[str(wfid)]
+            self.assertTrue("fields dropped from the reply: bad"
+                            in reply["error"])
+            self.assertEqual(reply["fields"]["keep"], wfid)
+            self.assertTrue(reply["fields"]["__result__"])
+            self.assertFalse("bad" in reply["fields"])
+
+    def test_sequential(self):
+        self.check(self.run_participant())
+
+    def test_concurrent(self):
+        self.check(self.run_participant(concurrency=2))
+
+    def test_batched(self):
+        self.check(self.run_participant(concurrency=2, reply_batch=3))
+
+    def test_rejected_without_error_reply(self):
+        class Hopeless(Unencodable):
+            def _error_reply_message(self, workitem, exception):
+                return None
+        broker = LocalBroker()
+        engine = Engine(broker)
+        participant = Hopeless("test", connect=broker.connect, concurrency=2)
+        thread = start(participant)
+        try:
+            for wfid in range(4):
+                engine.send(workitem(wfid, {"unencodable": True}))
+            engine.send(workitem("good"))
+            self.assertEqual(engine.reply()["fei"]["wfid"], "good")
+        finally:
+            stop(participant, thread)
+            engine.stop()
+        self.assertEqual(broker.queue_size("test"), 0)
+
+
+class Echo(Participant):
+    """Copies the workitem's log field to result."""
+
+    def consume(self):
+        self.workitem.result = self.workitem.fields.log
+
+
+class CompressionTest(unittest.TestCase):
+
+    LOG = "make: Entering directory\n" * 10000
+
+    def algorithms(self):
+        """The compression algorithms available here."""
+        algorithms = []
+        for name, _ in codec.COMPRESSORS:
+            try:
+                codec.compressor(name)
+            except ValueError:
+                continue
+            algorithms.append(name)
+        return algorithms
+
+    def run_participant(self, bodies, **kwargs):
+        """
+        Sends (body, content_encoding) pairs to an Echo participant and
+        returns its replies by wfid, and their content_encodings.
+        """
+        broker = LocalBroker()
+        engine = Engine(broker)
+        participant = Echo("test", connect=broker.connect, **kwargs)
+        thread = start(participant)
+        try:
+            for body, encoding in bodies:
+                engine.send(body, encoding)
+            replies = engine.replies(len(bodies))
+        finally:
+            stop(participant, thread)
+            engine.stop()
+        self.assertEqual(broker.queue_size("test"), 0)
+        return replies, engine.encodings
+
+    def test_round_trip(self):
+        for stream in (False, True):
+            for algorithm in self.algorithms():
+                body, encoding = codec.compress(
+                        workitem("1", log=self.LOG), algorithm)
+                self.assertEqual(encoding, algorithm)
+                replies, encodings = self.run_participant(
+                        [(body, encoding)], compression=algorithm,
+                        stream_workitems=stream)
+                self.assertEqual(encodings, [algorithm])
+                self.assertEqual(replies["1"]["fields"]["log"], self.LOG)
+                self.assertEqual(replies["1"]["fields"]["__result__"],
+                                 self.LOG)
+
+    def test_threshold(self):
+        large, encoding = codec.compress(workitem("large", log=self.LOG))
+        replies, encodings = self.run_participant(
+                [(workitem("small", log="short"), None)], compression=True)
+        self.assertEqual(encodings, [None])
+        self.assertEqual(replies["small"]["fields"]["__result__"], "short")
+        # Compressed whatever the size once past a lower threshold
+        replies, encodings = self.run_participant(
+                [(workitem("small", log="short"), None), (large, encoding)],
+                compression="deflate", compress_threshold=0)
+        self.assertEqual(encodings, ["deflate", "deflate"])
+        self.assertEqual(replies["large"]["fields"]["__result__"], self.LOG)
+
+
+class Quick(Participant):
+    """Reconnects without the usual delay."""
+
+    RECONNECT_MIN_DELAY = 0.01
+    RECONNECT_MAX_DELAY = 0.01
+
+
+class ChannelClosedTest(unittest.TestCase):
+
+    def test_reconnects(self):
+        broker = LocalBroker()
+        engine = Engine(broker)
+        metrics = Metrics()
+        participant = Quick("test", connect=broker.connect, reconnect=True,
+                            metrics=metrics)
+        thread = start(participant)
+        try:
+            engine.send(workitem(1))
+            engine.reply()
+            participant._chan.close()
+            engine.send(workitem(2))
+            self.assertEqual(engine.reply()["fei"]["wfid"], "2")
+        finally:
+            stop(participant, thread)
+            engine.stop()
+        exporter = MemoryExporter(metrics)
+        self.assertEqual(exporter.value("reconnects_total", queue="test"), 1)
+        downtime = exporter.value("disconnected_seconds_total", queue="test")
+        self.assertTrue(0 < downtime < TIMEOUT, downtime)
+        self.assertEqual(participant.stats, {"reconnects": 1,
+                                             "downtime": downtime,
+                                             "redelivered": 0})
+
+    def test_run_ends_without_reconnect(self):
+        broker = LocalBroker()
+        participant = Participant("test", connect=broker.connect)
+        errors = []
+
+        def run():
+            try:
+                participant.run()
+            except IOError as exobj:
+                errors.append(exobj)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        deadline = time.time() + TIMEOUT
+        while participant._consumer_tag is None and time.time() < deadline:
+            time.sleep(0.01)
+        participant._chan.close()
+        thread.join(TIMEOUT)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(errors), 1)
+
+
+class Patient(Participant):
+    """Waits for its workitems to be cancelled, unless told not to."""
+
+    CANCEL_WINDOW = 1
+
+    def __init__(self, *args, **kwargs):
+        Participant.__init__(self, *args, **kwargs)
+        self.started = threading.Event()
+        self.cancelled_workitems = []
+
+    def consume(self):
+        if self.workitem.params.quick:
+            return
+        self.started.set()
+        if self.cancelled.wait(TIMEOUT):
+            self.cancelled_workitems.append(self.workitem.wfid)
+
+
+class CancelTest(unittest.TestCase):
+
+    def test_prefetch(self):
+        for participant_class, kwargs, prefetch in (
+                (Participant, {}, 1),
+                (Participant, {"concurrency": 3, "reply_batch": 4}, 7),
+                (Patient, {}, 2),
+                (Patient, {"prefetch": 5}, 5)):
+            participant = participant_class("test", **kwargs)
+            self.assertEqual(participant._prefetch, prefetch)
+
+    def test_cancel_during_consume(self):
+        broker = LocalBroker()
+        engine = Engine(broker)
+        participant = Patient("test", connect=broker.connect)
+        thread = start(participant)
+        try:
+            engine.send(workitem(1))
+            self.assertTrue(participant.started.wait(TIMEOUT))
+            engine.send(cancel(1))
+            engine.send(workitem(2, {"quick": True}))
+            # The cancelled workitem gets no reply
+            self.assertEqual(engine.reply()["fei"]["wfid"], "2")
+            self.assertEqual(participant.cancelled_workitems, ["1"])
+        finally:
+            stop(participant, thread)
+            engine.stop()
+        self.assertEqual(broker.queue_size("test"), 0)
+
+
+# Taken by the consume() of Forked, in its worker process
+consume_lock = threading.Lock()
+
+
+class Forked(Participant):
+    """
+    Takes consume_lock, or exits when asked to, or after TIMEOUT failing
+    to take it.
+    """
+
+    def consume(self):
+        if self.workitem.params.exit:
+            os._exit(3)
+        deadline = time.time() + TIMEOUT
+        while not consume_lock.acquire(False):
+            if time.time() > deadline:
+                os._exit(4)
+            time.sleep(0.01)
+        consume_lock.release()
+        self.workitem.result = os.getpid()
+
+
+class WorkerProcessTest(unittest.TestCase):
+
+    def test_restart_while_lock_held(self):
+        broker = LocalBroker()
+        engine = Engine(broker)
+        participant = Forked("test", connect=broker.connect,
+                             processes=Processes(connect_timeout=10))
+        thread = start(participant)
+        try:
+            engine.send(workitem(1))
+            first = engine.reply()["fields"]["__result__"]
+            # A worker forked from the participant now would inherit
+            # consume_lock locked, and never finish a workitem
+            with consume_lock:
+                engine.send(workitem(2, {"exit": True}))
+                self.assertTrue("exit code 3" in engine.reply()["error"])
+                engine.send(workitem(3))
+                second = engine.reply()["fields"]["__result__"]
+            self.assertNotEqual(first, second)
+        finally:
+            stop(participant, thread)
+            engine.stop()
+        self.assertEqual(broker.queue_size("test"), 0)
+
+    def test_reply_relayed(self):
+        broker = LocalBroker()
+        engine = Engine(broker)
+        participant = Forked("test", connect=broker.connect, processes=True)
+        thread = start(participant)
+        # Patched once the workers are forked, so only the participant
+        # sees it
+        scanned = []
+        init = Workitem.__init__
+
+        def recording(self, *args, **kwargs):
+            init(self, *args, **kwargs)
+            scanned.append(self._lazy_fields is not None)
+        Workitem.__init__ = recording
+        try:
+            engine.send(workitem(1, build={"target": "i586"}))
+            reply = engine.reply()
+            self.assertNotEqual(reply["fields"]["__result__"], os.getpid())
+            self.assertEqual(reply["fields"]["build"], {"target": "i586"})
+        finally:
+            Workitem.__init__ = init
+            stop(participant, thread)
+            engine.stop()
+        # Scanned for its ids, and the reply not decoded at all
+        self.assertEqual(scanned, [True])
+
+    def test_connect_timeout(self):
+        server = ForkServer(Forked("test"), connect_timeout=0.1)
+        server.start()
+        try:
+            self.assertFalse(server._connecting())
+            # As if the worker never connected
+            server._connecting = lambda: False
+            self.assertRaises(RuntimeError, server.fork)
+        finally:
+            server.stop()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import unittest
+
+from RuoteAMQP.localbroker import LocalBroker
+from RuoteAMQP.pool import ConnectionPool, reconnect_delay
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = LocalBroker()
+        self.conns = []
+        self.pool = ConnectionPool(connect=self.connect,
+                                   channels_per_connection=2)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def connect(self):
+        conn = self.broker.connect()
+        self.conns.append(conn)
+        return conn
+
+    def test_channel_reused(self):
+        chan = self.pool.channel()
+        self.pool.release(chan)
+        self.assertTrue(self.pool.channel() is chan)
+        self.assertEqual(len(self.conns), 1)
+
+    def test_unhealthy_channel_not_reused(self):
+        chan = self.pool.channel()
+        chan.close()
+        self.pool.release(chan)
+        other = self.pool.channel()
+        self.assertFalse(other is chan)
+        self.assertTrue(other.is_open)
+
+    def test_busy_connection(self):
+        chans = [self.pool.channel() for _ in range(3)]
+        self.assertEqual(len(self.conns), 2)
+        self.assertTrue(chans[0].connection is chans[1].connection)
+        self.assertTrue(chans[2].connection is self.conns[1])
+        # Released channels go to whoever asks next, on any connection
+        self.pool.release(chans[0])
+        self.assertTrue(self.pool.channel() is chans[0])
+
+    def test_exhausted(self):
+        self.pool.max_connections = 1
+        self.pool.channel()
+        self.pool.channel()
+        self.assertRaises(RuntimeError, self.pool.channel)
+
+    def test_discard_and_reconnect(self):
+        chan = self.pool.channel()
+        idle = self.pool.channel()
+        self.pool.release(idle)
+        lock = self.pool.lock(chan)
+        self.pool.discard(chan)
+        self.assertTrue(self.conns[0].transport is None)
+        self.assertFalse(idle.is_open)
+        # The idle channel died with its connection, a new one is opened
+        replacement = self.pool.channel()
+        self.assertEqual(len(self.conns), 2)
+        self.assertTrue(replacement.connection is self.conns[1])
+        self.assertTrue(replacement.is_open)
+        self.assertFalse(self.pool.lock(replacement) is lock)
+        self.assertRaises(KeyError, self.pool.lock, chan)
+
+    def test_lock_per_connection(self):
+        chans = [self.pool.channel() for _ in range(4)]
+        locks = [self.pool.lock(chan) for chan in chans]
+        self.assertTrue(locks[0] is locks[1])
+        self.assertTrue(locks[2] is locks[3])
+        self.assertFalse(locks[0] is locks[2])
+        # Reentrant, as replies and acknowledgements nest
+        with locks[0]:
+            with locks[1]:
+                pass
+
+    def test_close(self):
+        chan = self.pool.channel()
+        self.pool.close()
+        self.assertTrue(self.conns[0].transport is None)
+        self.assertFalse(chan.is_open)
+
+
+class ReconnectDelayTest(unittest.TestCase):
+
+    def test_bounds(self):
+        for attempt, low, high in ((0, 0.5, 1), (1, 1, 2), (3, 4, 8),
+                                   (6, 30, 60), (50, 30, 60)):
+            for _ in range(20):
+                delay = reconnect_delay(attempt, 1, 60)
+                self.assertTrue(low <= delay <= high, (attempt, delay))
+
+
+if __name__ == "__main__":
+    unittest.main()
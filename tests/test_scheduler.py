@@ -0,0 +1,134 @@
+import threading
+import time
+import unittest
+
+from RuoteAMQP.localbroker import LocalBroker
+from RuoteAMQP.participant import Participant
+from RuoteAMQP.scheduler import JobQueue, Scheduling, deadline_of, \
+        parse_duration, parse_time, priority_of
+from RuoteAMQP.workitem import Workitem
+from tests.support import TIMEOUT, Engine, start, stop, workitem
+
+DISPATCHED = "2010-05-07 10:11:12.5 UTC"
+DISPATCHED_SECONDS = 1273227072.5
+
+
+class ParseTest(unittest.TestCase):
+
+    def test_duration(self):
+        for value, seconds in (("1h30m", 5400.0), ("2d", 172800.0),
+                               ("1.5s", 1.5), ("1500", 1.5), (90, 90.0),
+                               (2.5, 2.5)):
+            self.assertEqual(parse_duration(value), seconds)
+        for value in ("soon", "1x", "", True, None, [1]):
+            self.assertTrue(parse_duration(value) is None, value)
+
+    def test_time(self):
+        for value in (DISPATCHED, "2010-05-07T10:11:12.5Z",
+                      "2010-05-07 10:11:12.5 +0000", DISPATCHED_SECONDS):
+            self.assertEqual(parse_time(value), DISPATCHED_SECONDS)
+        for value in ("2010-05-07", "2010-05-07 10:11:12 CEST", False):
+            self.assertTrue(parse_time(value) is None, value)
+
+    def test_priority(self):
+        for params, priority in (({"priority": 5}, 5),
+                                 ({"priority": "-2"}, -2), ({}, 0),
+                                 ({"priority": "high"}, 0),
+                                 ({"priority": True}, 0)):
+            self.assertEqual(priority_of(Workitem(workitem(1, params))),
+                             priority)
+
+    def test_deadline(self):
+        def deadline(params, **kwargs):
+            return deadline_of(Workitem(workitem(
+                    1, params, dispatched_at=DISPATCHED)), **kwargs)
+        self.assertEqual(deadline({"timeout": "1m"}),
+                         DISPATCHED_SECONDS + 60)
+        # params.timeout overrides the participant's
+        self.assertEqual(deadline({"timeout": "1m"}, timeout=10),
+                         DISPATCHED_SECONDS + 60)
+        self.assertEqual(deadline({}, timeout=10), DISPATCHED_SECONDS + 10)
+        self.assertTrue(deadline({}) is None)
+        # Without dispatched_at, from when it was received
+        self.assertEqual(deadline_of(Workitem(workitem(1)), 10, 100.0),
+                         110.0)
+
+
+class JobQueueTest(unittest.TestCase):
+
+    def test_order(self):
+        jobs = JobQueue()
+        for item in (("late", 0, 200), (None, 0, None), ("first", 0, None),
+                     ("second", 0, None), ("urgent", 5, None),
+                     ("early", 0, 100), ("low", -1, 1)):
+            jobs.put(item)
+        self.assertEqual([jobs.get() for _ in range(7)],
+                         ["urgent", "early", "late", "first", "second",
+                          "low", None])
+
+    def test_unorderable_jobs(self):
+        # Equal keys never compare the jobs themselves
+        jobs = JobQueue()
+        for job in ({"a": 1}, {"b": 2}):
+            jobs.put((job, 0, None))
+        self.assertEqual([jobs.get(), jobs.get()], [{"a": 1}, {"b": 2}])
+
+
+class Gated(Participant):
+    """Holds the workitem "gate" until opened, recording the others."""
+
+    def __init__(self, *args, **kwargs):
+        Participant.__init__(self, *args, **kwargs)
+        self.held = threading.Event()
+        self.gate = threading.Event()
+        self.consumed = []
+
+    def consume(self):
+        if self.workitem.wfid == "gate":
+            self.held.set()
+            self.gate.wait(TIMEOUT)
+        else:
+            self.consumed.append(self.workitem.wfid)
+
+
+class SchedulingTest(unittest.TestCase):
+
+    def test_priority_and_expiry(self):
+        broker = LocalBroker()
+        engine = Engine(broker)
+        participant = Gated("test", connect=broker.connect,
+                            scheduling=Scheduling(timeout=3600, window=4))
+        # Room for the four workitems queued behind the gate
+        self.assertEqual(participant._prefetch, 5)
+        thread = start(participant)
+        try:
+            engine.send(workitem("gate"))
+            self.assertTrue(participant.held.wait(TIMEOUT))
+            engine.send(workitem("low", {"priority": -1}))
+            engine.send(workitem("plain"))
+            engine.send(workitem("expired", dispatched_at=DISPATCHED))
+            engine.send(workitem("high", {"priority": 3}))
+            deadline = time.time() + TIMEOUT
+            while (participant._pool._jobs.qsize() < 4 and
+                   time.time() < deadline):
+                time.sleep(0.01)
+            participant.gate.set()
+            replies = engine.replies(5)
+        finally:
+            stop(participant, thread)
+            engine.stop()
+        self.assertEqual(participant.consumed, ["high", "plain", "low"])
+        self.assertTrue(replies["expired"]["error"].startswith(
+                "Expired: Deadline passed"))
+        for wfid in ("gate", "high", "plain", "low"):
+            self.assertFalse(replies[wfid].get("error"), wfid)
+
+    def test_defaults(self):
+        participant = Participant("test", concurrency=2, scheduling=True)
+        self.assertEqual(participant._scheduling.timeout, None)
+        self.assertEqual(participant._prefetch, 2 + Scheduling().window)
+        self.assertEqual(Participant("test")._scheduling, None)
+
+
+if __name__ == "__main__":
+    unittest.main()
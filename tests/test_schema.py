@@ -0,0 +1,138 @@
+import unittest
+
+from RuoteAMQP.localbroker import LocalBroker
+from RuoteAMQP.participant import Participant
+from RuoteAMQP.schema import MAX_REPORTED, Schema, SchemaError, Validation
+from tests.support import Engine, start, stop, workitem
+
+ORDER = {
+    "type": "object",
+    "required": ["customer", "lines"],
+    "additionalProperties": False,
+    "properties": {
+        "customer": {"type": "string", "minLength": 1, "pattern": "^[a-z]"},
+        "status": {"enum": ["new", "done"]},
+        "version": {"const": 2},
+        "lines": {"type": "array", "minItems": 1, "maxItems": 2,
+                  "items": {"type": "object", "required": ["qty"],
+                            "properties": {
+                                "qty": {"type": "integer", "minimum": 1,
+                                        "exclusiveMaximum": 100},
+                                "price": {"type": ["number", "null"],
+                                          "exclusiveMinimum": 0,
+                                          "maximum": 10}}}}}}
+
+
+class SchemaErrorsTest(unittest.TestCase):
+
+    def errors(self, value):
+        return Schema(ORDER).errors(value)
+
+    def test_valid(self):
+        self.assertEqual(self.errors({"customer": "acme", "lines": [
+                {"qty": 1, "price": None}, {"qty": 99.0, "price": 10}]}), [])
+
+    def test_messages(self):
+        self.assertEqual(self.errors({
+            "customer": "", "status": "old", "version": 1, "extra": 1,
+            "lines": [{"qty": 0, "price": 0}, {"qty": 100, "price": 10.5},
+                      {"qty": "1", "price": True}, []]}), [
+            "fields.customer: should have at least 1 characters",
+            "fields.customer: should match '^[a-z]'",
+            "fields.lines[0].price: should be more than 0",
+            "fields.lines[0].qty: should be at least 1",
+            "fields.lines[1].price: should be at most 10",
+            "fields.lines[1].qty: should be less than 100",
+            "fields.lines[2].price: expected number or null, got boolean",
+            "fields.lines[2].qty: expected integer, got string",
+            "fields.lines[3]: expected object, got array",
+            "fields.lines: should have at most 2 items",
+            "fields.status: 'old' is not one of ['new', 'done']",
+            "fields.version: should be 2",
+            "fields.extra: not allowed"])
+
+    def test_required(self):
+        self.assertEqual(self.errors({"lines": [{}]}),
+                         ["fields.customer: is required",
+                          "fields.lines[0].qty: is required"])
+
+    def test_path(self):
+        self.assertEqual(Schema({"type": "object"}).errors([], "params"),
+                         ["params: expected object, got array"])
+
+    def test_truncated(self):
+        schema = Schema({"items": {"type": "string"}})
+        try:
+            schema.validate(list(range(MAX_REPORTED + 3)))
+        except SchemaError as exobj:
+            error = exobj
+        else:
+            self.fail("No SchemaError")
+        self.assertEqual(len(error.errors), MAX_REPORTED + 3)
+        message = str(error)
+        self.assertTrue(message.startswith(
+                "fields[0]: expected string, got integer; "
+                "fields[1]: expected string, got integer; "), message)
+        self.assertTrue(message.endswith(
+                "fields[9]: expected string, got integer; and 3 more"),
+                message)
+
+
+class MalformedSchemaTest(unittest.TestCase):
+
+    def check(self, schema, message):
+        try:
+            Schema(schema)
+        except ValueError as exobj:
+            self.assertEqual(str(exobj), message)
+        else:
+            self.fail("%r was accepted" % (schema,))
+
+    def test_messages(self):
+        self.check([], "# should be an object or a boolean")
+        self.check({"properties": {"a": {"oneOf": []}}},
+                   "#/properties/a uses unsupported keywords: oneOf")
+        self.check({"type": "float"}, "#/type has unknown type 'float'")
+        self.check({"type": 1}, "#/type should be a string or an array")
+        self.check({"items": [{}]},
+                   "#/items as an array of schemas is not supported")
+        self.check({"minItems": -1},
+                   "#/minItems should be a non-negative integer")
+        self.check({"maximum": "9"}, "#/maximum should be a number")
+        self.check({"required": "a"},
+                   "#/required should be an array of strings")
+        self.check({"pattern": "("},
+                   "#/pattern should be a regular expression")
+
+
+class ParticipantSchemaTest(unittest.TestCase):
+
+    def test_validation_compiled(self):
+        schema = Schema({"required": ["image"]})
+        validation = Validation(fields=schema, params={"type": "object"})
+        self.assertTrue(validation.fields is schema)
+        self.assertEqual(validation.params.errors([], "fields.params"),
+                         ["fields.params: expected object, got array"])
+        self.assertRaises(ValueError, Validation, params={"maximum": "9"})
+
+    def test_error_reply(self):
+        broker = LocalBroker()
+        engine = Engine(broker)
+        participant = Participant(
+                "test", connect=broker.connect, validation=Validation(
+                        fields={"required": ["image"]},
+                        params={"properties": {"task": {"type": "string"}}}))
+        thread = start(participant)
+        try:
+            engine.send(workitem("bad", {"task": 1}))
+            reply = engine.reply()
+        finally:
+            stop(participant, thread)
+            engine.stop()
+        self.assertEqual(reply["error"],
+                         "SchemaError: fields.image: is required; "
+                         "fields.params.task: expected string, got integer")
+
+
+if __name__ == "__main__":
+    unittest.main()
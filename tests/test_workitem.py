@@ -0,0 +1,341 @@
+import timeit
+import unittest
+
+import RuoteAMQP.workitem as workitem_module
+from RuoteAMQP import codec
+from RuoteAMQP.workitem import DictAttrProxy, FlowExpressionId, Workitem
+from tests.support import workitem
+
+
+def make(lazy):
+    return Workitem(workitem("1", {"task": "build"}, status="new",
+                             build={"target": {"arch": "i586"},
+                                    "project": "Trunk"}),
+                    lazy=lazy)
+
+
+class StorageIdTest(unittest.TestCase):
+
+    def test_subid(self):
+        for fei in ({"expid": "0_1", "subid": "abc", "wfid": "w"},
+                    {"expid": "0_1", "subid": "abc", "sub_wfid": "old",
+                     "wfid": "w"},
+                    {"expid": "0_1", "sub_wfid": "abc", "wfid": "w"},
+                    {"expid": "0_1", "subid": None, "sub_wfid": "abc",
+                     "wfid": "w"}):
+            self.assertEqual(FlowExpressionId(fei).to_storage_id(),
+                             "0_1!abc!w")
+
+    def test_sub_wfid_workitem(self):
+        wi = Workitem(codec.dumps({
+            "fei": {"engine_id": "engine", "wfid": "w", "sub_wfid": "abc",
+                    "expid": "0_1"},
+            "participant_name": "test", "fields": {}}))
+        self.assertEqual(wi.sid, "0_1!abc!w")
+
+
+class FlowExpressionIdTest(unittest.TestCase):
+
+    FEI = {"engine_id": "engine", "wfid": "w", "subid": "abc",
+           "expid": "0_1"}
+
+    def test_equality(self):
+        fei = FlowExpressionId(self.FEI)
+        same = FlowExpressionId(dict(self.FEI))
+        other = FlowExpressionId(dict(self.FEI, expid="0_2"))
+        self.assertTrue(fei == same)
+        self.assertFalse(fei != same)
+        self.assertTrue(fei != other)
+        self.assertFalse(fei == other)
+        self.assertFalse(fei == self.FEI)
+        self.assertTrue(fei != self.FEI)
+
+    def test_hash(self):
+        fei = FlowExpressionId(self.FEI)
+        self.assertEqual(hash(fei), hash(FlowExpressionId(dict(self.FEI))))
+        feis = set(FlowExpressionId(dict(self.FEI, expid=expid))
+                   for expid in ["0_1", "0_2", "0_1"])
+        self.assertEqual(len(feis), 2)
+        self.assertTrue(fei in feis)
+        # Workitems decoded from the same body share their fei
+        body = workitem("w")
+        self.assertEqual({Workitem(body).fei: 1}[Workitem(body).fei], 1)
+
+    def test_immutable(self):
+        h = dict(self.FEI)
+        fei = FlowExpressionId(h)
+        sid = fei.to_storage_id()
+        h["expid"] = "0_9"
+        self.assertEqual(fei.expid, "0_1")
+        self.assertRaises(AttributeError, setattr, fei, "expid", "0_9")
+        self.assertRaises(AttributeError, setattr, fei, "other", 1)
+        self.assertEqual(fei.to_storage_id(), sid)
+
+
+class DictAttrProxyTest(unittest.TestCase):
+
+    def test_no_instance_dict(self):
+        proxy = DictAttrProxy({"a": 1})
+        self.assertRaises(AttributeError, object.__getattribute__, proxy,
+                          "__dict__")
+        proxy.b = 2
+        self.assertEqual(proxy.as_dict(), {"a": 1, "b": 2})
+
+    def test_nested_proxy_kept(self):
+        d = {"nest": {"in": 1}}
+        proxy = DictAttrProxy(d)
+        nested = proxy.nest
+        self.assertTrue(proxy.nest is nested)
+        d["nest"] = {"in": 2}
+        self.assertFalse(proxy.nest is nested)
+        self.assertEqual(proxy.nest.__getattr__("in"), 2)
+
+    def test_dirty(self):
+        dirty = set()
+        proxy = DictAttrProxy({"nest": {"deep": {}}, "items": [],
+                               "plain": 1}, dirty)
+        self.assertEqual(proxy.plain, 1)
+        proxy.nest.deep.value = 1
+        self.assertEqual(dirty, set(["nest"]))
+        proxy.items.append(1)
+        proxy.added = 1
+        self.assertEqual(dirty, set(["nest", "items", "added"]))
+        proxy.as_dict()
+        self.assertTrue(None in dirty)
+
+    def test_slot_named_fields(self):
+        d = {"_d": 1, "_children": 2, "_dirty": 3, "_key": 4}
+        proxy = DictAttrProxy(d, key="top")
+        # Read as the proxy's own attributes, but written to the dict
+        self.assertTrue(proxy._d is d)
+        self.assertEqual(proxy._key, "top")
+        proxy._key = 5
+        self.assertEqual(proxy._key, "top")
+        self.assertEqual(proxy.as_dict()["_key"], 5)
+
+
+def engine_body(items, **h):
+    """
+    Returns the json of a workitem laid out as the engine emits it, the
+    fields first, given as (key, value) pairs which may repeat a key.
+    """
+    fields = ", ".join("%s: %s" % (codec.dumps(key), codec.dumps(value))
+                       for key, value in items)
+    h.setdefault("fei", {"engine_id": "engine", "wfid": "1", "subid": "0",
+                         "expid": "0_0"})
+    h.setdefault("participant_name", "test")
+    return ('{"fields": {%s}, %s' % (fields, codec.dumps(h)[1:])).encode(
+            "utf-8")
+
+
+def best(*funcs):
+    """
+    Returns the best time of a few calls of each of funcs, timed in
+    turn so that a busy moment doesn't skew one of them alone.
+    """
+    times = [[] for _ in funcs]
+    for _ in range(7):
+        for func, timed in zip(funcs, times):
+            timed.append(timeit.timeit(func, number=3))
+    return [min(timed) for timed in times]
+
+
+class ScannedTestCase(unittest.TestCase):
+    """Scans the fields of lazy workitems however small their body."""
+
+    def setUp(self):
+        self.threshold = workitem_module.LAZY_THRESHOLD
+        workitem_module.LAZY_THRESHOLD = 0
+
+    def tearDown(self):
+        workitem_module.LAZY_THRESHOLD = self.threshold
+
+
+class FieldPathTest(ScannedTestCase):
+    """Plain and dotted keys, as strings and compiled, on both kinds of
+    workitem."""
+
+    PATHS = ["status", "build", "missing", "build.target.arch",
+             "build.project", "params.task", "build.missing", "status.x"]
+
+    def test_lookup(self):
+        for lazy in (False, True):
+            wi = make(lazy)
+            expected = [wi.lookup(Workitem.compile_path(path))
+                        for path in self.PATHS]
+            self.assertEqual([wi.lookup(path) for path in self.PATHS],
+                             expected)
+            self.assertEqual(wi.lookup_many(self.PATHS), expected)
+            self.assertEqual(expected[:4],
+                             ["new", {"target": {"arch": "i586"},
+                                      "project": "Trunk"}, None, "i586"])
+
+    def test_set_field(self):
+        for lazy in (False, True):
+            for compile_path in (False, True):
+                wi = make(lazy)
+                for path, value in (("status", "done"), ("added", 1),
+                                    ("build.target.arch", "armv7l"),
+                                    ("new.nested.field", True)):
+                    if compile_path:
+                        path = Workitem.compile_path(path)
+                    wi.set_field(path, value)
+                fields = codec.loads(wi.to_json())["fields"]
+                self.assertEqual(fields["status"], "done")
+                self.assertEqual(fields["added"], 1)
+                self.assertEqual(fields["build"],
+                                 {"target": {"arch": "armv7l"},
+                                  "project": "Trunk"})
+                self.assertEqual(fields["new"], {"nested": {"field": True}})
+
+    def test_changed_through_lookup(self):
+        for lazy in (False, True):
+            wi = make(lazy)
+            wi.lookup("build")["project"] = "Release"
+            wi.lookup("build.target")["arch"] = "x86_64"
+            fields = codec.loads(wi.to_json())["fields"]
+            self.assertEqual(fields["build"],
+                             {"target": {"arch": "x86_64"},
+                              "project": "Release"})
+
+    def test_del_field(self):
+        wi = make(True)
+        wi.del_field("build.target")
+        wi.del_field("status")
+        fields = codec.loads(wi.to_json())["fields"]
+        self.assertEqual(fields["build"], {"project": "Trunk"})
+        self.assertFalse("status" in fields)
+
+    def test_path_cache_lru(self):
+        size = workitem_module.PATH_CACHE_SIZE
+        try:
+            workitem_module.PATH_CACHE_SIZE = 3
+            workitem_module._PATHS.clear()
+            hot = Workitem.compile_path("hot")
+            for index in range(5):
+                # Used between each new path, so never evicted
+                self.assertTrue(Workitem.compile_path("hot") is hot)
+                Workitem.compile_path("cold%d" % index)
+            self.assertEqual(list(workitem_module._PATHS),
+                             ["cold3", "hot", "cold4"])
+        finally:
+            workitem_module.PATH_CACHE_SIZE = size
+            workitem_module._PATHS.clear()
+
+
+class LazyTest(ScannedTestCase):
+    """Lazy workitems decode as the whole body does, and faster."""
+
+    ITEMS = [
+        ("params", {"task": "build [x]", "ref": "{\"}"}),
+        ("status", "old"),
+        ("log", u'brackets ]} in "strings", \\ and \\"escapes\\" [{ \u20ac'),
+        ("nested", {"a": [1, {"b": "]]]"}, [], {}], "c": u"caf\u00e9 [",
+                    "d": [1.5, -2, 10 ** 20, None, True, False]}),
+        ("packages", [{"name": "package-%d" % i, "note": "{[%d \\" % i}
+                      for i in range(500)]),
+        ("plain", [{"name": "package-%d" % i} for i in range(500)]),
+        ("strings", ["%d" % i * 300 for i in range(50)]),
+        ("status", "new"),
+        ("dispatched_at", "2010-05-07 10:11:12.123456 UTC"),
+        ]
+
+    def test_decodes_as_loads(self):
+        body = engine_body(self.ITEMS, wf_name="test [1]", re_dispatch_count=0)
+        expected = codec.loads(body)
+        # Following the strings and brackets or counting the brackets,
+        # with chunk edges falling everywhere
+        for skip_bytes in (0, 256, 10 ** 9):
+            for count_start in (4, 7, 256):
+                workitem_module.SKIP_BYTES = skip_bytes
+                workitem_module.COUNT_START = count_start
+                try:
+                    wi = Workitem(body, lazy=True)
+                    self.assertEqual(wi.params.task, "build [x]")
+                    self.assertEqual(wi.dispatched_at,
+                                     "2010-05-07 10:11:12.123456 UTC")
+                    self.assertEqual(wi.fei.wfid, "1")
+                    self.assertEqual(wi.wf_name, "test [1]")
+                    self.assertEqual(wi.to_h(), expected)
+                finally:
+                    workitem_module.SKIP_BYTES = 256
+                    workitem_module.COUNT_START = 256
+
+    def test_faster_than_loads(self):
+        body = engine_body([("packages", [{"name": "package-%d" % i,
+                                           "version": "1.%d" % i}
+                                          for i in range(25000)]),
+                            ("log", "make: Entering directory\n" * 20000),
+                            ("params", {"task": "build"})])
+        loads, lazy, touched = best(
+                lambda: Workitem(body), lambda: Workitem(body, lazy=True),
+                lambda: Workitem(body, lazy=True).fields)
+        self.assertTrue(lazy < loads * 0.75, (lazy, loads))
+        # Fully touched, the fields cost as much as loads and the
+        # scan as much again as lazy
+        self.assertTrue(touched < loads + 3 * lazy, (touched, loads, lazy))
+
+    def test_small_body(self):
+        workitem_module.LAZY_THRESHOLD = self.threshold
+        body = engine_body(self.ITEMS[:4])
+        self.assertTrue(len(body) < self.threshold)
+        self.assertEqual(Workitem(body, lazy=True).to_h(), codec.loads(body))
+        lazy, loads = best(lambda: Workitem(body, lazy=True),
+                           lambda: Workitem(body))
+        self.assertTrue(lazy < loads * 1.5, (lazy, loads))
+
+
+class DeltaTest(ScannedTestCase):
+    """Replies copy the json of the fields which didn't change."""
+
+    # Spaced unlike any encoder would, to tell copied json from encoded
+    SPACED = {"build": '{ "target" : { "arch" : "i586" } ,"project":"Trunk" }',
+              "packages": '[ "a" ,"b",  "c" ]',
+              "params": '{ "task" :"build" }'}
+
+    FIELDS = "{%s}" % ", ".join('"%s": %s' % item
+                                for item in sorted(SPACED.items()))
+
+    def make(self):
+        return Workitem(('{"fields": %s, %s' % (self.FIELDS, codec.dumps({
+            "fei": {"engine_id": "engine", "wfid": "1", "subid": "0",
+                    "expid": "0_0"},
+            "participant_name": "test"})[1:])).encode("utf-8"), lazy=True)
+
+    def test_unchanged_fields_copied(self):
+        wi = self.make()
+        wi.result = True
+        wi.set_field("status", "done")
+        self.assertEqual(wi.params.task, "build")
+        reply = wi.to_json()
+        for json in self.SPACED.values():
+            self.assertTrue(json in reply, json)
+        fields = codec.loads(reply)["fields"]
+        self.assertEqual(fields["__result__"], True)
+        self.assertEqual(fields["status"], "done")
+
+    def test_untouched_fields_copied_whole(self):
+        wi = self.make()
+        self.assertEqual(wi.fei.wfid, "1")
+        self.assertTrue(self.FIELDS in wi.to_json())
+
+    def test_nested_change_encoded(self):
+        wi = self.make()
+        wi.fields.build.target.arch = "armv7el"
+        reply = wi.to_json()
+        self.assertFalse(self.SPACED["build"] in reply)
+        self.assertTrue(self.SPACED["packages"] in reply)
+        self.assertEqual(codec.loads(reply)["fields"]["build"],
+                         {"target": {"arch": "armv7el"}, "project": "Trunk"})
+
+    def test_params_change_encoded(self):
+        wi = self.make()
+        wi.params.task = "test"
+        reply = wi.to_json()
+        self.assertFalse(self.SPACED["params"] in reply)
+        self.assertEqual(codec.loads(reply)["fields"]["params"],
+                         {"task": "test"})
+
+
+if __name__ == "__main__":
+    unittest.main()